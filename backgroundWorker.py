@@ -0,0 +1,107 @@
+#runs long image operations on a worker thread so the Tk loop stays responsive.
+#numpy, scipy and cv2 release the GIL while they crunch numbers, so a thread is enough.
+#Tk must only be touched from its own thread: progress, results and errors are queued here
+#and handed to the callbacks when the GUI calls poll() (from root.after)
+
+#native
+import concurrent.futures
+import queue
+import threading
+
+class TaskCancelled(Exception):
+    pass
+
+class Task:
+    def __init__(self, key, function, events, onDone=None, onProgress=None, onError=None, onCancel=None):
+        self.key = key
+        self.function = function
+        self.events = events
+        self.onDone = onDone
+        self.onProgress = onProgress
+        self.onError = onError
+        self.onCancel = onCancel
+        self.cancelEvent = threading.Event()
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def isCancelled(self):
+        return self.cancelEvent.is_set()
+
+    def checkCancelled(self):
+        #called by the task function between steps, cancelling takes effect at the next check
+        if self.isCancelled():
+            raise TaskCancelled()
+
+    def reportProgress(self, fraction, message="", partial=None):
+        #partial can carry an intermediate result for the GUI to show
+        self.checkCancelled()
+        self.events.put(('progress', self, (fraction, message, partial)))
+
+class BackgroundWorker:
+    def __init__(self, workers=1):
+        #one worker keeps the operations in the order they were submitted
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='imageWorker')
+        self.events = queue.Queue()
+        self.tasks = {}     #key -> task whose result has not been delivered yet
+
+    def submit(self, key, function, onDone=None, onProgress=None, onError=None, onCancel=None, replace=False):
+        #function(task) runs on the worker thread. while a task with the same key is pending, repeated submits are
+        #coalesced into it (None is returned), unless replace is set: then the pending task is cancelled for the new one
+        current = self.tasks.get(key)
+        if current is not None:
+            if not replace:
+                return None
+            current.cancel()
+        task = Task(key, function, self.events, onDone, onProgress, onError, onCancel)
+        self.tasks[key] = task
+        self.executor.submit(self.run, task)
+        return task
+
+    def run(self, task):
+        try:
+            task.checkCancelled()
+            result = task.function(task)
+            self.events.put(('done', task, result))
+        except TaskCancelled:
+            self.events.put(('cancelled', task, None))
+        except Exception as e:
+            self.events.put(('error', task, e))
+
+    def cancel(self, key=None):
+        tasks = list(self.tasks.values()) if key is None else [self.tasks[key]] if key in self.tasks else []
+        for task in tasks:
+            task.cancel()
+        return len(tasks)>0
+
+    def isBusy(self, key=None):
+        if key is None:
+            return len(self.tasks)>0
+        return key in self.tasks
+
+    def poll(self):
+        #must be called from the GUI thread, runs the callbacks of everything that happened since the last poll
+        while True:
+            try:
+                kind, task, value = self.events.get_nowait()
+            except queue.Empty:
+                return
+            if kind=='progress':
+                if not task.isCancelled() and task.onProgress is not None:
+                    task.onProgress(*value)
+                continue
+            if self.tasks.get(task.key) is task:
+                del self.tasks[task.key]
+            #a task cancelled after it finished is still reported as cancelled
+            if kind=='cancelled' or task.isCancelled():
+                if task.onCancel is not None:
+                    task.onCancel()
+            elif kind=='error':
+                if task.onError is not None:
+                    task.onError(value)
+            elif task.onDone is not None:
+                task.onDone(value)
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
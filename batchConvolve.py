@@ -0,0 +1,315 @@
+#command-line mode: applies a kernel pipeline to every image in a directory/glob on all cores.
+#example:
+#   python batchConvolve.py photos/ --kernel gaussian-blur --kernel sobel-X --normalize -o out/
+#   python batchConvolve.py "scans/*.png" --pipeline edges.json --padding 1 -o out/
+#   python batchConvolve.py photos/ --gabor-bank 8 --layers green -o features/
+#   python batchConvolve.py photos/ --edges magnitude --normalize -o edges/
+#   python batchConvolve.py scans/ --kernel sobel-X --float --format tif --tiff-depth float -o gradients/
+
+#external libraries (install using pip in your system terminal)
+import cv2                      #(pip install opencv-python)
+
+#native
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+
+import convolutionEngine
+import imageWriter
+import resultCache
+import profiling
+
+DEFAULT_CHUNK_SIZE = 4      #images a worker process handles in a row, encoding each one while it computes the next
+
+def findImages(inputs, supportedFileTypes=convolutionEngine.SUPPORTED_FILE_TYPES):
+    filePaths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            candidates = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+        else:
+            candidates = sorted(glob.glob(pattern))
+        for filePath in candidates:
+            if os.path.isfile(filePath) and filePath.lower().rsplit('.', 1)[-1] in supportedFileTypes:
+                filePaths.append(filePath)
+    return filePaths
+
+def getOutputPath(filePath, outputDir, bank=False, fileFormat=None):
+    #fileFormat replaces the extension of the input
+    imageName, imageExtension = os.path.splitext(os.path.basename(filePath))
+    if bank:
+        return os.path.join(outputDir, "{}-features.npy".format(imageName))
+    if fileFormat is not None:
+        imageExtension = ".{}".format(fileFormat)
+    return os.path.join(outputDir, "{}-modified{}".format(imageName, imageExtension))
+
+def getDefaultSettings():
+    return {
+        'kernels': [],
+        'layers': list(convolutionEngine.LAYER_NAMES),
+        'padding': 0,
+        'paddingMode': 'constant',
+        'stride': 1,
+        'normalize': False,
+        'separableTolerance': 0,
+        'method': 'auto',
+        'fuse': False,
+        'float': False,
+        'quantize': 'wrap',
+        'cacheDir': None,
+        'cacheSize': resultCache.DEFAULT_DISK_BUDGET,
+        'trace': False,
+        'bank': False,
+        'edges': None,
+        'format': None,
+        'pngCompression': imageWriter.DEFAULT_PNG_COMPRESSION,
+        'jpegQuality': imageWriter.DEFAULT_JPEG_QUALITY,
+        'tiffDepth': '8',
+    }
+
+def getLayersIdx(layers, bgr):
+    #cv2 keeps the channels in BGR order, so red is the last layer of a decoded image
+    layersIdx = [convolutionEngine.LAYER_NAMES.index(layer) for layer in layers]
+    if bgr:
+        layersIdx = [len(convolutionEngine.LAYER_NAMES)-1-idx for idx in layersIdx]
+    return layersIdx
+
+def getSaveOptions(settings):
+    return imageWriter.getSaveOptions(settings['pngCompression'], settings['jpegQuality'], settings['tiffDepth'], settings['quantize'])
+
+def convolveImage(image, layersIdx, settings, plans=None, cache=None, quantize=True):
+    #the whole pipeline of the settings (kernel chain, then the edge step) on one decoded image, quantized for saving
+    #unless quantize is False (float results are then left for the writer, which keeps them in float formats)
+    identicalGroups = convolutionEngine.findIdenticalGroups(image) if len(layersIdx)>1 else []
+    if settings['float']:
+        image = convolutionEngine.toWorkingBuffer(image)
+    for image in convolutionEngine.applyKernels(image, settings['kernels'], layersIdx, settings['padding'], settings['stride'], settings['normalize'],
+                                                settings['separableTolerance'], plans, settings['method'], settings['fuse'], settings['quantize'], identicalGroups, settings['paddingMode'], cache):
+        pass
+    if settings['edges'] is not None:
+        image = convolutionEngine.applyEdgeDetection(image, layersIdx, settings['edges'], settings['normalize'], settings['quantize'], identicalGroups)
+    if not quantize:
+        return image
+    return convolutionEngine.quantize(image, settings['quantize'])
+
+def saveResult(outputPath, image, settings, writer=None, onError=None, bgr=True):
+    #written now, or queued on the writer which reports failures to onError(outputPath, exception)
+    if writer is None:
+        imageWriter.writeImage(outputPath, image, getSaveOptions(settings), bgr)
+    else:
+        writer.submit(outputPath, image, getSaveOptions(settings), onError=onError, bgr=bgr)
+
+def processFile(filePath, outputDir, settings, writer=None, onWriteError=None):
+    #returns the output path and the methods used. with a writer the result is only queued for encoding
+    with profiling.span('decode', file=os.path.basename(filePath)) as span:
+        image = cv2.imread(filePath)
+        if image is None:
+            raise ValueError("{} could not be read".format(filePath))
+        span.addBytes(image.nbytes)
+    layersIdx = getLayersIdx(settings['layers'], bgr=True)
+    if settings['bank']:
+        return processFileBank(filePath, image, layersIdx, outputDir, settings, writer, onWriteError)
+    #the disk tier is shared by all the workers (and later runs), a memory tier would not outlive a single image
+    cache = resultCache.ResultCache(0, settings['cacheDir'], settings['cacheSize']) if settings['cacheDir'] else None
+    plans = []
+    image = convolveImage(image, layersIdx, settings, plans, cache, quantize=False)
+    outputPath = getOutputPath(filePath, outputDir, fileFormat=settings['format'])
+    saveResult(outputPath, image, settings, writer, onWriteError)
+    methods = [convolutionEngine.describePlan(plan) for plan in plans]
+    if settings['edges'] is not None:
+        methods.append("sobel {}".format(settings['edges']))
+    return outputPath, methods
+
+def processFileBank(filePath, image, layersIdx, outputDir, settings, writer=None, onWriteError=None):
+    #every kernel is applied to the decoded image and the float32 feature maps are saved as one rows x cols x (kernels*layers) stack
+    plans = []
+    for featureMaps in convolutionEngine.applyKernelBank(image, settings['kernels'], layersIdx, settings['padding'], settings['stride'], settings['normalize'],
+                                                         settings['separableTolerance'], plans, settings['method'], settings['paddingMode']):
+        pass
+    #the feature maps are not an image, their layers are written in the order of the bank
+    outputPath = getOutputPath(filePath, outputDir, bank=True)
+    saveResult(outputPath, featureMaps, settings, writer, onWriteError, bgr=False)
+    methods = sorted(set(convolutionEngine.describePlan(plan) for plan in plans))
+    return outputPath, ["{} kernels".format(len(plans))] + methods
+
+def processFiles(filePaths, outputDir, settings):
+    #the files of a chunk one after another in a worker process, every result is encoded on a writer thread while the
+    #next file is decoded and convolved. returns (filePath, outputPath, methods, error message) of every file and the
+    #profiling events of the chunk (empty unless settings['trace'])
+    if settings['trace']:
+        profiling.reset()
+        profiling.enable()
+    writeErrors = {}
+    def onWriteError(outputPath, e):
+        writeErrors[outputPath] = str(e)
+    #one result waits while another one is encoded, so a worker never holds more than three images
+    writer = imageWriter.ImageWriter(1)
+    results = []
+    try:
+        for filePath in filePaths:
+            try:
+                outputPath, methods = processFile(filePath, outputDir, settings, writer, onWriteError)
+                results.append((filePath, outputPath, methods, None))
+            except Exception as e:
+                results.append((filePath, None, [], str(e)))
+    finally:
+        writer.close()
+    results = [(filePath, outputPath, methods, writeErrors.get(outputPath, error)) for filePath, outputPath, methods, error in results]
+    events = []
+    if settings['trace']:
+        events = profiling.getEvents()
+        profiling.disable()
+    return results, events
+
+def runBatch(filePaths, outputDir, settings, workers=None, maxInFlight=None, log=print, events=None, chunkSize=DEFAULT_CHUNK_SIZE):
+    #the files are handed to the workers in chunks of up to chunkSize (fewer when there are not enough files to keep all
+    #workers busy). at most maxInFlight chunks are queued, so memory stays bounded no matter how many files there are.
+    #the profiling events of every file are added to events when a list is given
+    workers = workers or os.cpu_count() or 1
+    maxInFlight = maxInFlight or workers*2
+    chunkSize = max(min(chunkSize, -(-len(filePaths)//workers)), 1)
+    os.makedirs(outputDir, exist_ok=True)
+
+    failed = []
+    chunks = (filePaths[start:start+chunkSize] for start in range(0, len(filePaths), chunkSize))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        inFlight = {}
+        while True:
+            while len(inFlight)<maxInFlight:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                future = executor.submit(processFiles, chunk, outputDir, settings)
+                inFlight[future] = chunk
+            if len(inFlight)==0:
+                break
+            done, _ = concurrent.futures.wait(inFlight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                chunk = inFlight.pop(future)
+                try:
+                    results, chunkEvents = future.result()
+                except Exception as e:
+                    results = [(filePath, None, [], str(e)) for filePath in chunk]
+                    chunkEvents = []
+                if events is not None:
+                    events.extend(chunkEvents)
+                for filePath, outputPath, methods, error in results:
+                    if error is None:
+                        log("{} -> {} ({})".format(filePath, outputPath, ", ".join(methods)))
+                    else:
+                        log("{} failed: {}".format(filePath, error))
+                        failed.append(filePath)
+    return failed
+
+def addPipelineArguments(parser):
+    #kernel pipeline options shared by every command-line mode
+    parser.add_argument('-k', '--kernel', action='append', default=[], help="preset name ({}), a parametric blur like box:50 or gaussian:12.5 or a matrix like 1,0,-1;2,0,-2;1,0,-1. can be repeated".format(", ".join(convolutionEngine.getPresetKernels())))
+    parser.add_argument('--pipeline', help="json file of kernels saved from the GUI (applied before any --kernel)")
+    parser.add_argument('--layers', default=",".join(convolutionEngine.LAYER_NAMES), help="comma separated layers to convolve (default: all)")
+    parser.add_argument('--padding', type=int, default=0)
+    parser.add_argument('--padding-mode', choices=convolutionEngine.PADDING_MODES, default='constant', help="how the padding is filled (default: constant zeros)")
+    parser.add_argument('--stride', type=int, default=1)
+    parser.add_argument('--normalize', action='store_true', help="normalize every kernel before convolving (same as Norm+Conv)")
+    parser.add_argument('--separable-tolerance', type=float, default=0, help="relative error allowed when approximating a kernel with 1-D passes (default: exact only)")
+    parser.add_argument('--method', choices=convolutionEngine.METHODS, default='auto', help="how kernels are applied (default: cheapest for the image size)")
+    parser.add_argument('--fuse', action='store_true', help="compose the kernels into one before convolving when that does not change the result")
+    parser.add_argument('--float', action='store_true', help="keep a float32 working image through the whole pipeline and quantize only when saving")
+    parser.add_argument('--quantize', choices=convolutionEngine.QUANTIZE_MODES, default='wrap', help="how values outside 0-255 are stored (default: wrap, like casting)")
+    parser.add_argument('--edges', choices=convolutionEngine.EDGE_OUTPUTS, default=None, help="after the kernels (if any), replace the layers by their sobel gradient magnitude, edge orientation in degrees or non-maximum-suppressed edges, computed in float (--normalize scales the gradients by 1/8)")
+    parser.add_argument('--trace', default=None, help="profile every operation, print a summary and save a chrome trace (chrome://tracing, ui.perfetto.dev) to this json file")
+
+def getSettings(args, parser, bankKernels=()):
+    try:
+        kernels = []
+        if args.pipeline:
+            kernels.extend(convolutionEngine.loadPipeline(args.pipeline))
+        kernels.extend(convolutionEngine.parseKernel(spec) for spec in args.kernel)
+        kernels.extend(bankKernels)
+        #the edge step can be the whole pipeline
+        if args.edges is None or len(kernels)>0:
+            convolutionEngine.validateConvolveSettings(kernels, args.padding, args.stride)
+        elif args.padding!=0 or args.stride!=1:
+            raise ValueError("--padding and --stride need kernels")
+    except (ValueError, OSError, KeyError) as e:
+        parser.error(str(e))
+
+    layers = [layer.strip() for layer in args.layers.split(',') if layer.strip()]
+    for layer in layers:
+        if layer not in convolutionEngine.LAYER_NAMES:
+            parser.error("unknown layer '{}', choose from {}".format(layer, ", ".join(convolutionEngine.LAYER_NAMES)))
+
+    settings = getDefaultSettings()
+    settings.update({
+        'kernels': kernels,
+        'layers': layers,
+        'padding': args.padding,
+        'paddingMode': args.padding_mode,
+        'stride': args.stride,
+        'normalize': args.normalize,
+        'separableTolerance': args.separable_tolerance,
+        'method': args.method,
+        'fuse': args.fuse,
+        'float': args.float,
+        'quantize': args.quantize,
+        'trace': args.trace is not None,
+        'edges': args.edges,
+    })
+    return settings
+
+def saveTrace(filePath, events, log=print):
+    profiling.saveChromeTrace(filePath, events, {})
+    for line in profiling.formatSummary(events, {}):
+        log(line)
+    log("trace saved to {}".format(filePath))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply a kernel pipeline to png/jpg images in parallel.")
+    parser.add_argument('inputs', nargs='+', help="directories or glob patterns of images")
+    parser.add_argument('-o', '--output', required=True, help="directory to write the modified images to")
+    addPipelineArguments(parser)
+    parser.add_argument('-j', '--workers', type=int, default=None, help="number of processes (default: all cores)")
+    parser.add_argument('--max-in-flight', type=int, default=None, help="maximum number of chunks of images queued at once (default: 2 per worker)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help="images a worker handles in a row, encoding one while it computes the next (default: %(default)s)")
+    parser.add_argument('--format', choices=imageWriter.SAVE_FORMATS, default=None, help="format of the written images (default: the input's). npy and raw keep --float results as float32, raw buffers are RGB and carry no shape")
+    parser.add_argument('--png-compression', type=int, default=imageWriter.DEFAULT_PNG_COMPRESSION, help="zlib level 0-9 of png files, higher is smaller and slower (default: opencv's own, faster than any level)")
+    parser.add_argument('--jpeg-quality', type=int, default=imageWriter.DEFAULT_JPEG_QUALITY, help="quality 0-100 of jpg files (default: %(default)s)")
+    parser.add_argument('--tiff-depth', choices=imageWriter.TIFF_DEPTHS, default='8', help="bits of tif files: 8, 16 (0-255 scaled to 0-65535) or float (keeps --float results) (default: %(default)s)")
+    parser.add_argument('--cache-dir', default=None, help="directory to cache results (and intermediate results) in, re-running a known pipeline on the same images reads them back")
+    parser.add_argument('--cache-size', type=float, default=resultCache.DEFAULT_DISK_BUDGET/1024**2, help="size cap of --cache-dir in MB (default: %(default)s)")
+    parser.add_argument('--bank', action='store_true', help="apply every kernel to the input image instead of chaining them and save the feature maps as a float32 rows x cols x (kernels*layers) .npy stack")
+    parser.add_argument('--gabor-bank', type=int, default=0, metavar='ORIENTATIONS', help="add gabor kernels of 4, 8 and 16 pixel wavelengths at this many orientations to the bank (implies --bank)")
+    parser.add_argument('--sobel-bank', type=int, default=0, metavar='ORIENTATIONS', help="add sobel derivatives at this many orientations to the bank (implies --bank)")
+    args = parser.parse_args(argv)
+    bankKernels = list(convolutionEngine.makeGaborBank(args.gabor_bank).values()) + list(convolutionEngine.makeSobelBank(args.sobel_bank).values())
+    settings = getSettings(args, parser, bankKernels)
+    settings['bank'] = args.bank or len(bankKernels)>0
+    if settings['bank'] and (args.cache_dir or args.fuse or args.edges):
+        parser.error("--cache-dir, --fuse and --edges only apply to a kernel chain, not to a bank")
+    if settings['bank'] and args.format not in [None, 'npy']:
+        parser.error("feature maps are always saved as .npy")
+    settings['cacheDir'] = args.cache_dir
+    settings['cacheSize'] = int(args.cache_size*1024**2)
+    settings.update({
+        'format': args.format,
+        'pngCompression': args.png_compression,
+        'jpegQuality': args.jpeg_quality,
+        'tiffDepth': args.tiff_depth,
+    })
+    try:
+        imageWriter.validateSaveOptions(getSaveOptions(settings))
+    except ValueError as e:
+        parser.error(str(e))
+
+    filePaths = findImages(args.inputs)
+    if len(filePaths)==0:
+        parser.error("no {} files found".format("/".join(convolutionEngine.SUPPORTED_FILE_TYPES)))
+
+    events = [] if args.trace else None
+    failed = runBatch(filePaths, args.output, settings, args.workers, args.max_in_flight, events=events, chunkSize=max(args.chunk_size, 1))
+    if args.trace:
+        saveTrace(args.trace, events)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+#reproducible benchmarks of the hot paths on synthetic images: convolution with the preset kernels, padding,
+#flattening, layer moves and the display/transition path. results are printed and written as json, so runs
+#on different commits can be compared.
+#example:
+#   python benchmark.py -o before.json
+#   python benchmark.py --sizes 512,2048 --compare before.json -o after.json
+
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+import scipy                    #(pip install scipy)
+import cv2                      #(pip install opencv-python)
+
+#native
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import convolutionEngine
+import displayRendering
+
+OPERATIONS = ['convolve', 'pipeline', 'padding', 'flatten', 'move', 'display', 'transition']
+DEFAULT_SIZES = [512, 2048, 8192]
+DEFAULT_CHANNELS = [1, 3]
+DISPLAY_SIZE = 600      #maxCanvasSize of the GUI
+PARAMETRIC_KERNELS = ['box:50', 'gaussian:12.5']    #large blurs, timed alongside the preset kernels
+
+def makeImage(size, channels, seed=0):
+    #smooth gradients with noise on top, the same pixels on every run
+    rng = numpy.random.default_rng(seed)
+    rows, cols = numpy.ogrid[0:size, 0:size]
+    image = numpy.empty((size, size, channels), dtype='uint8')
+    for channel in range(channels):
+        gradient = (rows*(channel+1) + cols*(channels-channel))*(255/(size*(channels+1)))
+        image[:,:,channel] = numpy.clip(gradient + rng.normal(0, 20, (size, size)), 0, 255)
+    return image
+
+def timeFunction(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter()-start)
+    return times
+
+def measurePeakMemory(function):
+    #bytes allocated by numpy/python on top of what existed before the call (cv2 buffers are not traced)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def getCases(imageMatrix, kernels, operations):
+    #(operation, details, function) of everything to time on this image
+    channels = imageMatrix.shape[2]
+    layersIdx = list(range(channels))
+    cases = []
+    if 'convolve' in operations:
+        for name, kernel in kernels.items():
+            plan = convolutionEngine.planConvolution(kernel, imageShape=imageMatrix.shape)
+            details = {'kernel': name, 'method': convolutionEngine.describePlan(plan)}
+            cases.append(('convolve', details, lambda kernel=kernel, plan=plan: convolutionEngine.convolve(imageMatrix, kernel, layersIdx, 1, plan)))
+            workingBuffer = convolutionEngine.toWorkingBuffer(imageMatrix)
+            details = dict(details, dtype='float32')
+            cases.append(('convolve', details, lambda kernel=kernel, plan=plan, workingBuffer=workingBuffer: convolutionEngine.convolve(workingBuffer, kernel, layersIdx, 1, plan)))
+    if 'pipeline' in operations:
+        pipeline = [kernels[name] for name in ['gaussian-blur', 'sobel-X', 'sobel-Y'] if name in kernels]
+        for fuse in [False, True]:
+            cases.append(('pipeline', {'kernels': len(pipeline), 'fuse': fuse}, lambda fuse=fuse: list(convolutionEngine.applyKernels(imageMatrix, pipeline, layersIdx, 1, 1, True, fuse=fuse))))
+    if 'padding' in operations:
+        for mode in convolutionEngine.PADDING_MODES:
+            cases.append(('padding', {'padding': 15, 'mode': mode}, lambda mode=mode: convolutionEngine.padImage(imageMatrix, 15, mode)))
+    if 'flatten' in operations and channels>1:
+        for mode in convolutionEngine.FLATTEN_MODES:
+            cases.append(('flatten', {'layers': channels, 'mode': mode}, lambda mode=mode: convolutionEngine.flattenLayers(imageMatrix, layersIdx, mode)))
+    if 'move' in operations and channels==len(convolutionEngine.LAYER_NAMES):
+        #the GUI only reorders the layers it shows, the pixels stay where they are
+        names = convolutionEngine.LAYER_NAMES
+        def moveLayer():
+            displayOrder = convolutionEngine.getMovedLayerOrder(names, names[-1:], 'up')
+            return [displayRendering.DECODED_CHANNEL_ORDER[position] for position in displayOrder], [names[position] for position in displayOrder]
+        cases.append(('move', {'layers': 1}, moveLayer))
+    if 'display' in operations:
+        displaySize = displayRendering.getDisplaySize(imageMatrix.shape, 1, DISPLAY_SIZE)
+        pyramid = displayRendering.DisplayPyramid()
+        pyramid.update(imageMatrix)
+        def buildPyramid():
+            displayRendering.DisplayPyramid().update(imageMatrix)
+        def refreshLayer():
+            pyramid.invalidate([0])
+            pyramid.update(imageMatrix)
+        cases.append(('display', {'step': 'full resize'}, lambda: displayRendering.renderDisplayFrame(imageMatrix, displaySize)))
+        cases.append(('display', {'step': 'pyramid build'}, buildPyramid))
+        cases.append(('display', {'step': 'pyramid refresh 1 layer'}, refreshLayer))
+        cases.append(('display', {'step': 'pyramid frame'}, lambda: pyramid.getFrame(displaySize)))
+    if 'transition' in operations:
+        #one animation frame at display size, the megapixel rate refers to the full image it stands for
+        displaySize = displayRendering.getDisplaySize(imageMatrix.shape, 1, DISPLAY_SIZE)
+        oldFrame = displayRendering.renderDisplayFrame(imageMatrix, displaySize)
+        newFrame = 255-oldFrame
+        frame = numpy.empty_like(newFrame)
+        anchorRatios = displayRendering.getAnchorRatios(oldFrame, newFrame)
+        cases.append(('transition', {'blend': 'linear'}, lambda: displayRendering.blendFrames(oldFrame, newFrame, 0.5, frame)))
+        cases.append(('transition', {'blend': 'anchored'}, lambda: displayRendering.blendFramesAnchored(oldFrame, newFrame, 0.5, anchorRatios)))
+    return cases
+
+def runBenchmarks(sizes, channelCounts, operations=OPERATIONS, repeat=3, log=print):
+    kernels = convolutionEngine.getPresetKernels()
+    for spec in PARAMETRIC_KERNELS:
+        kernels[spec] = convolutionEngine.parseKernel(spec)
+    results = []
+    for size in sizes:
+        for channels in channelCounts:
+            imageMatrix = makeImage(size, channels)
+            megapixels = size*size/1e6
+            for operation, details, function in getCases(imageMatrix, kernels, operations):
+                function()  #warm up (imports, fft plans, caches)
+                times = timeFunction(function, repeat)
+                result = {
+                    'operation': operation,
+                    'size': size,
+                    'channels': channels,
+                    'dtype': 'uint8',
+                    'best': min(times),
+                    'median': float(numpy.median(times)),
+                    'megapixelsPerSecond': megapixels/min(times),
+                    'peakMemory': measurePeakMemory(function),
+                }
+                result.update(details)
+                results.append(result)
+                log(formatResult(result))
+    return results
+
+def getCaseName(result):
+    details = ["{}={}".format(key, value) for key, value in result.items() if key not in ['operation', 'size', 'channels', 'best', 'median', 'megapixelsPerSecond', 'peakMemory']]
+    return "{} {}x{}x{} {}".format(result['operation'], result['size'], result['size'], result['channels'], " ".join(details))
+
+def formatResult(result):
+    return "{:<70} {:>9.2f} ms {:>9.1f} MP/s {:>9.1f} MB".format(getCaseName(result), result['best']*1000, result['megapixelsPerSecond'], result['peakMemory']/1024**2)
+
+def getEnvironment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'scipy': scipy.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+def compareResults(results, baseline):
+    #speed of every case relative to the baseline run, above 1 is faster
+    baselineTimes = {getCaseName(result): result['best'] for result in baseline['results']}
+    lines = []
+    for result in results:
+        name = getCaseName(result)
+        if name in baselineTimes:
+            lines.append("{:<70} {:>6.2f}x".format(name, baselineTimes[name]/result['best']))
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time convolution, padding, flattening, layer moves and redraws on synthetic images.")
+    parser.add_argument('--sizes', default=",".join(str(size) for size in DEFAULT_SIZES), help="comma separated image sides in pixels (default: %(default)s)")
+    parser.add_argument('--channels', default=",".join(str(channels) for channels in DEFAULT_CHANNELS), help="comma separated channel counts (default: %(default)s)")
+    parser.add_argument('--operations', default=",".join(OPERATIONS), help="comma separated subset of {} (default: all)".format(", ".join(OPERATIONS)))
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs of every case, the best one is reported (default: %(default)s)")
+    parser.add_argument('-o', '--output', help="json file to write the results to")
+    parser.add_argument('--compare', help="json file of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    try:
+        sizes = [int(size) for size in args.sizes.split(',')]
+        channelCounts = [int(channels) for channels in args.channels.split(',')]
+    except ValueError:
+        parser.error("sizes and channels must be comma separated integers")
+    operations = [operation.strip() for operation in args.operations.split(',')]
+    for operation in operations:
+        if operation not in OPERATIONS:
+            parser.error("unknown operation '{}', choose from {}".format(operation, ", ".join(OPERATIONS)))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+    results = runBenchmarks(sizes, channelCounts, operations, max(args.repeat, 1))
+    report = {'environment': getEnvironment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if baseline is not None:
+        print("\nspeed relative to {} ({})".format(args.compare, baseline['environment'].get('commit', '')))
+        for line in compareResults(results, baseline):
+            print(line)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,12 @@
+#fixtures shared by the test_*.py modules next to the code, run them with: python -m pytest -q
+
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+import pytest                   #(pip install pytest)
+
+@pytest.fixture
+def makeImage():
+    #random pixels, always the same ones for a given shape and seed
+    def make(shape=(37, 41, 3), seed=0, dtype='uint8'):
+        return numpy.random.default_rng(seed).integers(0, 256, shape).astype(dtype)
+    return make
@@ -0,0 +1,952 @@
+#headless convolution engine. only depends on numpy and scipy so it can be imported
+#on machines without a display (batch workers, servers) and reused by the GUI.
+
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+from scipy import ndimage       #(pip install scipy)
+from scipy import fft
+from scipy import signal
+
+#native
+import collections
+import functools
+import json
+
+import resultCache
+import profiling
+
+LAYER_NAMES = ['red','green','blue']
+SUPPORTED_FILE_TYPES = ["png", "jpg"]
+SEPARABLE_EXACT_TOLERANCE = 1e-5    #relative error still treated as an exact separation
+METHODS = ['auto', 'direct', 'separable', 'fft', 'box']
+QUANTIZE_MODES = ['wrap', 'clip']
+PADDING_MODES = ['constant', 'reflect', 'edge', 'wrap']
+
+#cost model constants used to choose between the methods (nanoseconds)
+DIRECT_TAP_COST = 1.5
+SEPARABLE_TAP_COST = 1.2
+SEPARABLE_PASS_COST = 3
+FFT_COST = 0.75
+BOX_PASS_COST = 5.5
+
+MAX_BOX_PASSES = 4          #longest cascade of box filters the planner looks for along each axis
+BANK_GROUP_SIZE = 16        #feature maps copied into a kernel bank's stack at once (a cache line of float32 values)
+GAUSSIAN_BOX_PASSES = 3     #box filters whose cascade approximates a gaussian (parametric 'gaussian' preset)
+MIN_BOX_GAUSSIAN_SIGMA = 2  #below it the boxes are too narrow to approximate a gaussian, it is sampled instead
+PARAMETRIC_KERNELS = {'box': 'radius', 'gaussian': 'sigma'}
+EDGE_OUTPUTS = ['magnitude', 'orientation', 'edges']
+FLATTEN_MODES = ['rms', 'mean']
+FLATTEN_BAND_PIXELS = 1024**2  #pixels flattened at once, the scratch space needed does not grow with the image
+
+def getPresetKernels():
+    return {
+        'mean-blur': numpy.array([
+            [1, 1, 1],
+            [1, 1, 1],
+            [1 ,1 ,1]
+        ]),
+        'gaussian-blur': numpy.array([
+            [1, 2, 1],
+            [2, 3, 2],
+            [1 ,2 ,1]
+        ]),
+        'gaussian-blur bigger': numpy.array([
+            [0.023528,	0.033969,	0.038393,	0.033969,	0.023528],
+            [0.033969,	0.049045,	0.055432,	0.049045,	0.033969],
+            [0.038393,	0.055432,	0.062651,	0.055432,	0.038393],
+            [0.033969,	0.049045,	0.055432,	0.049045,	0.033969],
+            [0.023528,	0.033969,	0.038393,	0.033969,	0.023528]
+        ]),
+        'sobel-X': numpy.array([
+            [-1, 0, 1],
+            [-2, 0, 2],
+            [-1, 0, 1]
+        ]),
+        'sobel-Y': numpy.array([
+            [-1, -2, -1],
+            [ 0,  0,  0],
+            [ 1,  2,  1]
+        ]),
+    }
+
+def getBoxCascade(widths):
+    #1-D profile of boxes of the given widths applied one after the other, unscaled so it starts with 1
+    profile = numpy.ones(1)
+    for width in widths:
+        profile = numpy.convolve(profile, numpy.ones(width))
+    return profile
+
+def getGaussianBoxWidths(sigma, count=GAUSSIAN_BOX_PASSES):
+    #odd widths (so the cascade stays centred) whose cascade has the variance of a gaussian of this sigma, as in
+    #Kovesi's "fast almost-gaussian filtering": the first boxes are one width and the rest the next odd one
+    idealWidth = numpy.sqrt(12*sigma**2/count + 1)
+    lowerWidth = int(numpy.floor(idealWidth))
+    if lowerWidth%2==0:
+        lowerWidth -= 1
+    lowerWidth = max(lowerWidth, 1)
+    lowerCount = int(round((12*sigma**2 - count*lowerWidth**2 - 4*count*lowerWidth - 3*count)/(-4*lowerWidth - 4)))
+    lowerCount = min(max(lowerCount, 0), count)
+    return [lowerWidth]*lowerCount + [lowerWidth+2]*(count-lowerCount)
+
+def getSampledGaussian(sigma):
+    #1-D gaussian sampled over 3 sigmas on each side (at least one pixel), unscaled
+    radius = max(int(numpy.ceil(3*sigma)), 1)
+    positions = numpy.arange(-radius, radius+1)
+    return numpy.exp(-positions**2/(2*sigma**2))
+
+def makeParametricKernel(name, value):
+    #'box' is a (2*radius+1) square mean filter, 'gaussian' a cascade of boxes close to a gaussian of that sigma.
+    #both are normalised, and the planner applies them as running sums whatever their size. small gaussians
+    #(sigma under MIN_BOX_GAUSSIAN_SIGMA) are sampled: 3 narrow boxes would give a wider gaussian or none at all
+    if name=='box':
+        if value<0 or value!=int(value):
+            raise ValueError("The radius of a box filter must be a whole number of pixels")
+        width = 2*int(value)+1
+        return numpy.full((width, width), 1/width**2)
+    if name=='gaussian':
+        if not value>0:
+            raise ValueError("The sigma of a gaussian filter must be positive, got {:g}".format(value))
+        if value<MIN_BOX_GAUSSIAN_SIGMA:
+            profile = getSampledGaussian(value)
+        else:
+            profile = getBoxCascade(getGaussianBoxWidths(value))
+        profile /= numpy.sum(profile)
+        return numpy.outer(profile, profile)
+    raise ValueError("Unknown parametric kernel '{}' ({})".format(name, ", ".join(PARAMETRIC_KERNELS)))
+
+def makeGaborKernel(wavelength, orientation, sigma=None, aspectRatio=0.5, phase=0):
+    #cosine wave of the given wavelength (pixels) along the orientation (radians), under a gaussian envelope.
+    #sigma defaults to about half the wavelength (a one octave bandwidth). even kernels (phase 0) are made zero mean
+    #so flat regions give no response
+    if sigma is None:
+        sigma = 0.56*wavelength
+    radius = int(numpy.ceil(3*sigma))
+    rows, cols = numpy.mgrid[-radius:radius+1, -radius:radius+1]
+    along = cols*numpy.cos(orientation) + rows*numpy.sin(orientation)
+    across = -cols*numpy.sin(orientation) + rows*numpy.cos(orientation)
+    envelope = numpy.exp(-(along**2 + (aspectRatio*across)**2)/(2*sigma**2))
+    kernel = envelope*numpy.cos(2*numpy.pi*along/wavelength + phase)
+    if phase==0:
+        kernel -= envelope*numpy.sum(kernel)/numpy.sum(envelope)
+    return kernel
+
+def makeGaborBank(orientations=8, wavelengths=(4, 8, 16)):
+    #name -> kernel of every wavelength at evenly spaced orientations over half a turn
+    bank = {}
+    for wavelength in wavelengths:
+        for idx in range(orientations):
+            angle = 180*idx/orientations
+            bank['gabor {:g}px {:g}°'.format(wavelength, angle)] = makeGaborKernel(wavelength, numpy.radians(angle))
+    return bank
+
+def makeSobelBank(orientations=8):
+    #name -> first derivative along evenly spaced orientations over a full turn, steered from the two sobel kernels
+    presetKernels = getPresetKernels()
+    bank = {}
+    for idx in range(orientations):
+        angle = 360*idx/orientations
+        bank['sobel {:g}°'.format(angle)] = numpy.cos(numpy.radians(angle))*presetKernels['sobel-X'] + numpy.sin(numpy.radians(angle))*presetKernels['sobel-Y']
+    return bank
+
+def parseKernel(spec, presetKernels=None):
+    #a kernel is either a preset name, a parametric preset like "box:50" or "gaussian:12.5",
+    #or a matrix written as rows separated by ';' e.g. "1,0,-1;2,0,-2;1,0,-1"
+    if presetKernels is None:
+        presetKernels = getPresetKernels()
+    if spec in presetKernels:
+        return presetKernels[spec].astype('float64')
+    name, _, value = spec.partition(':')
+    if name in PARAMETRIC_KERNELS:
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError("'{}' needs a {} e.g. {}:5".format(name, PARAMETRIC_KERNELS[name], name))
+        return makeParametricKernel(name, value)
+    try:
+        rows = [[float(value) for value in row.split(',')] for row in spec.strip().split(';')]
+        kernel = numpy.array(rows, dtype='float64')
+    except ValueError:
+        raise ValueError("'{}' is neither a preset kernel ({}), a parametric one ({}) nor a matrix like 1,0,-1;2,0,-2;1,0,-1".format(
+            spec, ", ".join(presetKernels), ", ".join("{}:{}".format(name, param) for name, param in PARAMETRIC_KERNELS.items())))
+    if kernel.ndim!=2 or kernel.size==0:
+        raise ValueError("Every row of kernel '{}' must have the same number of values".format(spec))
+    return kernel
+
+def savePipeline(filePath, kernels):
+    with open(filePath, 'w') as f:
+        json.dump({'kernels': [kernel.tolist() for kernel in kernels]}, f, indent=4)
+
+def loadPipeline(filePath, presetKernels=None):
+    #entries of a saved pipeline can be matrices (nested lists) or preset names
+    with open(filePath) as f:
+        pipeline = json.load(f)
+    kernels = []
+    for entry in pipeline['kernels']:
+        if isinstance(entry, str):
+            kernels.append(parseKernel(entry, presetKernels))
+        else:
+            kernels.append(numpy.array(entry, dtype='float64'))
+    return kernels
+
+def normalizeKernel(kernel):
+    sum = numpy.sum(numpy.absolute(kernel))
+    if sum!=0:
+        return kernel/sum
+    return kernel
+
+def getMaxConvolPadding(kernels):
+    minKernelDim = float('inf')
+    for kernel in kernels:
+        minDim = min(kernel.shape)
+        if minDim<minKernelDim:
+            minKernelDim = minDim
+
+    maxPadding = (minKernelDim/2)-0.5
+    if maxPadding<0:
+        maxPadding=0
+
+    return maxPadding
+
+def calculateMaxStride(kernels):
+    minDimensionSize = float('inf')
+    for kernel in kernels:
+        shape = kernel.shape
+        if min(shape)<minDimensionSize:
+            minDimensionSize = min(shape)
+    return minDimensionSize-1
+
+def validateConvolveSettings(kernels, padding, stride):
+    if len(kernels)==0:
+        raise ValueError("Add a kernel to convolve with")
+    for kernel in kernels:
+        if numpy.isnan(kernel).any():
+            raise ValueError("An input field is missing")
+    if padding<0 or padding>getMaxConvolPadding(kernels):
+        raise ValueError("Padding must be from 0 to {} (half the size of your smallest kernel)".format(int(getMaxConvolPadding(kernels))))
+    if stride<=0 or stride>calculateMaxStride(kernels):
+        raise ValueError("Stride must be less or equal to the smallest kernel dimension minus 1")
+
+def padImage(imageMatrix, padding, mode='constant'):
+    #mode is one of PADDING_MODES ('constant' pads with zeros), all layers are padded with a single allocation
+    if padding==0:
+        return imageMatrix
+    if mode not in PADDING_MODES:
+        raise ValueError("Unknown padding mode '{}'".format(mode))
+    with profiling.span('padding', padding=padding, mode=mode) as span:
+        paddedImage = numpy.pad(imageMatrix, ((padding, padding), (padding, padding)) + ((0,0),)*(imageMatrix.ndim-2), mode=mode)
+        span.addBytes(paddedImage.nbytes)
+    return paddedImage
+
+def getStridedShape(shape, stride):
+    #like a CNN layer, a stride of s keeps every s-th pixel starting from the first one
+    return (-(-shape[0]//stride), -(-shape[1]//stride)) + tuple(shape[2:])
+
+def reshapeKernel(kernel, layers):
+    #a 2-D kernel gets a singleton axis per extra axis of a stack of layers so every layer is convolved on its own
+    return kernel.reshape(kernel.shape + (1,)*(layers.ndim-2))
+
+def getEdgePadWidth(kernelShapes, ndim):
+    #enough edge padding for every kernel to see the same pixels as mode='nearest'
+    top = max([(shape[0]-1)//2 for shape in kernelShapes])
+    bottom = max([shape[0]-1-(shape[0]-1)//2 for shape in kernelShapes])
+    left = max([(shape[1]-1)//2 for shape in kernelShapes])
+    right = max([shape[1]-1-(shape[1]-1)//2 for shape in kernelShapes])
+    return ((top, bottom), (left, right)) + ((0,0),)*(ndim-2)
+
+def convolveLayersStrided(layers, kernel, stride):
+    #gives the same pixels as ndimage.convolve(layers, kernel, mode='nearest')[::stride, ::stride]
+    #but only computes the pixels that survive the stride, one shifted slice per kernel value.
+    #layers is a single layer or a stack of layers along the last axis
+    kernelHeight, kernelWidth = kernel.shape
+    paddedLayer = numpy.pad(layers, getEdgePadWidth([kernel.shape], layers.ndim), mode='edge')
+
+    outShape = getStridedShape(layers.shape, stride)
+    outHeight, outWidth = outShape[0], outShape[1]
+    output = numpy.zeros(outShape, dtype='float32')
+    flippedKernel = kernel[::-1, ::-1].astype('float32')
+    for row in range(kernelHeight):
+        for col in range(kernelWidth):
+            weight = flippedKernel[row, col]
+            if weight==0:
+                continue
+            output += weight*paddedLayer[row:row+stride*(outHeight-1)+1:stride, col:col+stride*(outWidth-1)+1:stride]
+    return output
+
+def convolve1dStrided(layer, weights, axis, stride):
+    #1-D version of convolveLayerStrided, only strides along the given axis
+    size = len(weights)
+    before = (size-1)//2
+    padWidth = [(0,0)]*layer.ndim
+    padWidth[axis] = (before, size-1-before)
+    paddedLayer = numpy.pad(layer, padWidth, mode='edge')
+
+    outShape = list(layer.shape)
+    outShape[axis] = -(-layer.shape[axis]//stride)
+    output = numpy.zeros(outShape, dtype='float32')
+    flippedWeights = weights[::-1].astype('float32')
+    for idx in range(size):
+        if flippedWeights[idx]==0:
+            continue
+        index = [slice(None)]*layer.ndim
+        index[axis] = slice(idx, idx+stride*(outShape[axis]-1)+1, stride)
+        output += flippedWeights[idx]*paddedLayer[tuple(index)]
+    return output
+
+def separateKernel(kernel, tolerance=0):
+    #splits a kernel into the fewest (column, row) vector pairs whose outer products sum back to it,
+    #allowing a relative (frobenius) error of up to tolerance. returns the pairs and the error made
+    u, singularValues, vh = numpy.linalg.svd(kernel.astype('float64'))
+    norm = numpy.sqrt(numpy.sum(singularValues**2))
+    if norm==0:
+        return [(numpy.zeros(kernel.shape[0]), numpy.zeros(kernel.shape[1]))], 0.0
+    tolerance = max(tolerance, SEPARABLE_EXACT_TOLERANCE)
+    for rank in range(1, len(singularValues)+1):
+        error = numpy.sqrt(numpy.sum(singularValues[rank:]**2))/norm
+        if error<=tolerance:
+            break
+    pairs = []
+    for idx in range(rank):
+        scale = numpy.sqrt(singularValues[idx])
+        pairs.append((u[:,idx]*scale, vh[idx,:]*scale))
+    return pairs, error
+
+def findBoxWidths(weights, maxBoxes=MAX_BOX_PASSES):
+    #widths of the boxes whose cascade gives these 1-D weights (up to a scale), or None.
+    #a cascade of boxes w1..wn is s*prod(1-z^wi)/(1-z)^n as a polynomial, so after n differences only the integer
+    #coefficients of prod(1-z^wi) are left, which are divided by (1-z^w) for the smallest remaining w, n times
+    if weights[0]==0:
+        return None
+    profile = weights/weights[0]
+    differences = profile
+    for count in range(1, maxBoxes+1):
+        differences = numpy.convolve(differences, [1,-1])
+        remaining = numpy.round(differences)
+        if numpy.max(numpy.absolute(differences-remaining))>1e-6:
+            continue
+        widths = []
+        for _ in range(count):
+            nonzero = numpy.flatnonzero(remaining[1:])
+            if len(nonzero)==0:
+                break
+            width = nonzero[0]+1
+            #dividing by (1-z^width) is a running sum over every width-th coefficient
+            padded = numpy.zeros(-(-len(remaining)//width)*width)
+            padded[:len(remaining)] = remaining
+            remaining = numpy.cumsum(padded.reshape(-1, width), axis=0).ravel()[:len(remaining)]
+            widths.append(int(width))
+        if len(widths)==count:
+            cascade = getBoxCascade(widths)
+            if len(cascade)==len(profile) and numpy.allclose(cascade, profile, rtol=SEPARABLE_EXACT_TOLERANCE, atol=0):
+                return widths
+    return None
+
+def findBoxFactors(kernel, pairs=None):
+    #a kernel that is the outer product of two box cascades (any constant kernel, the parametric presets, [1,2,1]...)
+    #can be applied as running sums in O(1) per pixel whatever its size. returns (column widths, row widths, scale) or None
+    if pairs is None:
+        pairs, _ = separateKernel(kernel)
+    if len(pairs)!=1:
+        return None
+    column, row = pairs[0]
+    columnWidths = findBoxWidths(column)
+    rowWidths = None if columnWidths is None else findBoxWidths(row)
+    if rowWidths is None:
+        return None
+    scale = column[0]*row[0]
+    boxKernel = scale*numpy.outer(getBoxCascade(columnWidths), getBoxCascade(rowWidths))
+    if numpy.linalg.norm(boxKernel-kernel)>SEPARABLE_EXACT_TOLERANCE*numpy.linalg.norm(kernel):
+        return None
+    return columnWidths, rowWidths, scale
+
+def boxFilterLayers(layers, boxes, stride=1):
+    #applies a box cascade with one running sum (scipy's uniform_filter1d) per box and axis, i.e. a summed-area table
+    #built one axis at a time. gives the same pixels as ndimage.convolve(layers, kernel, mode='nearest')[::stride, ::stride]
+    columnWidths, rowWidths, scale = boxes
+    kernelShape = (sum(columnWidths)-len(columnWidths)+1, sum(rowWidths)-len(rowWidths)+1)
+    result = numpy.pad(layers, getEdgePadWidth([kernelShape], layers.ndim), mode='edge')
+    #a running sum of width w centred by ndimage spans w//2 before the pixel, after all of them the output starts at
+    #their total and no pass ever reads past the edge padding
+    for axis, widths in [(0, columnWidths), (1, rowWidths)]:
+        for width in widths:
+            if width>1:
+                ndimage.uniform_filter1d(result, width, axis=axis, output=result, mode='nearest')
+        start = sum(width//2 for width in widths)
+        index = [slice(None)]*result.ndim
+        index[axis] = slice(start, start+layers.shape[axis], stride)
+        result = result[tuple(index)]
+    result *= scale*numpy.prod(columnWidths)*numpy.prod(rowWidths)
+    return result
+
+def getImageSpectrum(layers, kernelShapes):
+    #edge pads the layers (same as mode='nearest') enough for every kernel shape given and transforms them once,
+    #so kernels that are applied to the same input can share the spectrum (applyKernelBank does)
+    padWidth = getEdgePadWidth(kernelShapes, layers.ndim)
+    paddedLayer = numpy.pad(layers.astype('float32', copy=False), padWidth, mode='edge')
+    fftShape = (fft.next_fast_len(paddedLayer.shape[0], True), fft.next_fast_len(paddedLayer.shape[1], True))
+    return {
+        'spectrum': fft.rfft2(paddedLayer, s=fftShape, axes=(0,1)),
+        'fftShape': fftShape,
+        'offset': (padWidth[0][0], padWidth[1][0]),
+        'shape': layers.shape,
+    }
+
+def convolveSpectrum(imageSpectrum, kernel, stride=1):
+    #the transforms are large enough that the circular wrap around never reaches the pixels that are kept
+    kernelHeight, kernelWidth = kernel.shape
+    kernelSpectrum = reshapeKernel(fft.rfft2(kernel.astype('float32'), s=imageSpectrum['fftShape']), imageSpectrum['spectrum'])
+    output = fft.irfft2(imageSpectrum['spectrum']*kernelSpectrum, s=imageSpectrum['fftShape'], axes=(0,1))
+    rowStart = kernelHeight-1 + imageSpectrum['offset'][0]-(kernelHeight-1)//2
+    colStart = kernelWidth-1 + imageSpectrum['offset'][1]-(kernelWidth-1)//2
+    height, width = imageSpectrum['shape'][0], imageSpectrum['shape'][1]
+    return output[rowStart:rowStart+height:stride, colStart:colStart+width:stride].astype('float32')
+
+def estimateConvolutionCosts(kernel, imageShape, stride=1, rank=None, boxes=None, sharedSpectra=1):
+    #rough cost (in nanoseconds per layer) of every method, the constants were measured with numpy/scipy on a 1024x1024 image.
+    #sharedSpectra is the number of kernels the transform of the image is shared by (a kernel bank)
+    kernelHeight, kernelWidth = kernel.shape
+    height, width = imageShape[0], imageShape[1]
+    outHeight, outWidth = getStridedShape((height, width), stride)
+    costs = {'direct': DIRECT_TAP_COST*outHeight*outWidth*kernel.size}
+    if rank is not None:
+        columnPass = (SEPARABLE_TAP_COST*kernelHeight + SEPARABLE_PASS_COST)*outHeight*width
+        rowPass = (SEPARABLE_TAP_COST*kernelWidth + SEPARABLE_PASS_COST)*outHeight*outWidth
+        costs['separable'] = rank*(columnPass + rowPass)
+    fftSize = fft.next_fast_len(height+kernelHeight-1, True)*fft.next_fast_len(width+kernelWidth-1, True)
+    costs['fft'] = FFT_COST*(2 + 1/sharedSpectra)*fftSize*numpy.log2(fftSize)   #image, kernel and inverse transform
+    if boxes is not None:
+        columnWidths, rowWidths, _ = boxes
+        paddedSize = (height+kernelHeight-1)*(width+kernelWidth-1)
+        costs['box'] = BOX_PASS_COST*paddedSize*len(columnWidths) + BOX_PASS_COST*outHeight*(width+kernelWidth-1)*len(rowWidths)
+    return costs
+
+def planConvolution(kernel, separableTolerance=0, imageShape=None, stride=1, method='auto', sharedSpectra=1):
+    #picks how a kernel is applied. a rank r kernel costs r*(rows+cols) per pixel as 1-D passes
+    #instead of rows*cols as a full 2-D convolution, and big kernels are cheaper to apply with an fft.
+    #without an imageShape the fft is never picked automatically.
+    #cascades of box filters (mean filters, the parametric presets) cost the same whatever their size as running sums
+    #integer weights give integers on uint8 layers, whatever noise the fft or the separated factors add
+    plan = {'method': 'direct', 'rank': None, 'error': 0.0, 'factors': None, 'costs': None, 'boxes': None,
+            'integer': bool(numpy.array_equal(kernel, numpy.round(kernel)))}
+    pairs = None
+    if min(kernel.shape)>1:
+        pairs, error = separateKernel(kernel, separableTolerance)
+        plan['rank'] = len(pairs)
+        if len(pairs)*(kernel.shape[0]+kernel.shape[1]) < kernel.size:
+            plan['error'] = error
+            plan['factors'] = pairs
+    if kernel.size>1:
+        plan['boxes'] = findBoxFactors(kernel, pairs if separableTolerance==0 else None)
+
+    if method=='auto':
+        if imageShape is not None:
+            plan['costs'] = estimateConvolutionCosts(kernel, imageShape, stride, plan['rank'] if plan['factors'] is not None else None, plan['boxes'], sharedSpectra)
+            plan['method'] = min(plan['costs'], key=plan['costs'].get)
+        elif plan['boxes'] is not None:
+            plan['method'] = 'box'
+        elif plan['factors'] is not None:
+            plan['method'] = 'separable'
+    elif method=='separable' and plan['factors'] is None:
+        raise ValueError("Kernel is not separable within the given tolerance")
+    elif method=='box' and plan['boxes'] is None:
+        raise ValueError("Kernel is not a box filter or a cascade of them")
+    elif method in ['direct', 'separable', 'fft', 'box']:
+        plan['method'] = method
+    else:
+        raise ValueError("Unknown convolution method '{}'".format(method))
+
+    if plan['method']!='separable':
+        plan['error'] = 0.0
+    return plan
+
+def describePlan(plan):
+    if plan['method']=='separable':
+        description = "separable (rank {})".format(plan['rank'])
+        if plan['error']>SEPARABLE_EXACT_TOLERANCE:
+            description += ", approximation error {:.2%}".format(plan['error'])
+    elif plan['method']=='box':
+        columnWidths, rowWidths, _ = plan['boxes']
+        description = "box ({} running sums)".format(len([width for width in columnWidths+rowWidths if width>1]))
+    else:
+        description = plan['method']
+    if plan.get('fused'):
+        description = "{} kernels fused, {}".format(plan['fused'], description)
+    return description
+
+def convolveLayers(layers, kernel, stride, plan, imageSpectrum=None, output=None):
+    #layers is a single layer or a stack of layers along the last axis, all of them are convolved in one call.
+    #output can be a preallocated float32 array (e.g. layers of the working buffer) to write the result into
+    if layers.dtype!=numpy.float32:
+        with profiling.span('cast', dtype='float32') as span:
+            layers = layers.astype('float32')
+            span.addBytes(layers.nbytes)
+    if plan['method']=='fft':
+        if imageSpectrum is None:
+            imageSpectrum = getImageSpectrum(layers, [kernel.shape])
+        result = convolveSpectrum(imageSpectrum, kernel, stride)
+    elif plan['method']=='box':
+        result = boxFilterLayers(layers, plan['boxes'], stride)
+    elif plan['method']=='separable':
+        result = None
+        for column, row in plan['factors']:
+            if stride==1:
+                passOutput = ndimage.convolve1d(layers, column.astype('float32'), axis=0, mode='nearest')
+                if result is None and output is not None:
+                    ndimage.convolve1d(passOutput, row.astype('float32'), axis=1, output=output, mode='nearest')
+                    result = output
+                    continue
+                passOutput = ndimage.convolve1d(passOutput, row.astype('float32'), axis=1, mode='nearest')
+            else:
+                passOutput = convolve1dStrided(layers, column, 0, stride)
+                passOutput = convolve1dStrided(passOutput, row, 1, stride)
+            if result is None:
+                result = passOutput
+            else:
+                result += passOutput
+    elif stride==1:
+        if output is not None:
+            ndimage.convolve(layers, reshapeKernel(kernel.astype('float32'), layers), output=output, mode='nearest')
+            return output
+        result = ndimage.convolve(layers, reshapeKernel(kernel.astype('float32'), layers), mode='nearest')
+    else:
+        result = convolveLayersStrided(layers, kernel, stride)
+
+    if output is not None and result is not output:
+        output[...] = result
+        return output
+    return result
+
+def quantize(imageMatrix, mode='wrap'):
+    #turns a float working buffer into displayable/savable uint8 pixels.
+    #'wrap' keeps the old behaviour of casting (-1 becomes 255), 'clip' saturates to [0,255]
+    if imageMatrix.dtype==numpy.uint8:
+        return imageMatrix
+    if mode not in QUANTIZE_MODES:
+        raise ValueError("Unknown quantize mode '{}'".format(mode))
+    with profiling.span('quantize', mode=mode) as span:
+        if mode=='clip':
+            quantized = numpy.clip(imageMatrix, 0, 255).astype('uint8')
+        else:
+            #casting to int truncates towards zero, the cast to uint8 then keeps the low byte (mod 256)
+            quantized = imageMatrix.astype('int64').astype('uint8')
+        span.addBytes(quantized.nbytes)
+    return quantized
+
+def toWorkingBuffer(imageMatrix):
+    #float32 copy of the image that keeps negative and >255 results between operations
+    with profiling.span('cast', dtype='float32') as span:
+        workingBuffer = imageMatrix.astype('float32')
+        span.addBytes(workingBuffer.nbytes)
+    return workingBuffer
+
+def isWorkingBuffer(imageMatrix):
+    return imageMatrix.dtype.kind=='f'
+
+def groupIdenticalLayers(layersIdx, identicalGroups=None):
+    #splits the layers to convolve into groups of layers holding the same pixels, only the first of each group is convolved
+    groups = []
+    grouped = set()
+    for layer in layersIdx:
+        if layer in grouped:
+            continue
+        group = [layer]
+        for identicalGroup in identicalGroups or []:
+            if layer in identicalGroup:
+                group += [l for l in layersIdx if l in identicalGroup and l!=layer and l not in grouped]
+                break
+        grouped.update(group)
+        groups.append(group)
+    return groups
+
+def getIdenticalGroups(identicalLayers, layers):
+    #turns the GUI's identicalLayers bookkeeping (layer names) into groups of layer indexes
+    groups = []
+    for key in identicalLayers:
+        group = sorted([layers.index(layer) for layer in identicalLayers[key]])
+        if len(group)>1 and group not in groups:
+            groups.append(group)
+    return groups
+
+def findIdenticalGroups(imageMatrix):
+    #compares the layers of an image, e.g. a greyscale file that was decoded into three equal layers
+    groups = []
+    for layer in range(imageMatrix.shape[2]):
+        for group in groups:
+            if numpy.array_equal(imageMatrix[:,:,group[0]], imageMatrix[:,:,layer]):
+                group.append(layer)
+                break
+        else:
+            groups.append([layer])
+    return [group for group in groups if len(group)>1]
+
+def selectLayers(layersIdx):
+    #a run of neighbouring layers can be selected with a slice, which is a view instead of a copy
+    layersIdx = sorted(layersIdx)
+    if layersIdx==list(range(layersIdx[0], layersIdx[-1]+1)):
+        return slice(layersIdx[0], layersIdx[-1]+1)
+    return layersIdx
+
+def copyIdenticalLayers(newImg, groups):
+    for group in groups:
+        for layer in group[1:]:
+            newImg[:,:,layer] = newImg[:,:,group[0]]
+
+def convolve(imageMatrix, kernel, layersIdx, stride=1, plan=None, quantizeMode='wrap', identicalGroups=None):
+    #uint8 images are quantized after every kernel, float working buffers stay float.
+    #layers in the same identicalGroups entry are convolved once and the result is copied to the others
+    if plan is None:
+        plan = planConvolution(kernel, imageShape=imageMatrix.shape, stride=stride)
+    with profiling.span('convolve', kernel="{}x{}".format(*kernel.shape), method=plan['method'], stride=stride) as span:
+        newImg = convolveSelectedLayers(imageMatrix, kernel, layersIdx, stride, plan, quantizeMode, identicalGroups)
+        span.addBytes(newImg.nbytes)
+    return newImg
+
+def convolveSelectedLayers(imageMatrix, kernel, layersIdx, stride, plan, quantizeMode, identicalGroups):
+    if stride==1:
+        newImg = imageMatrix.copy()
+    else:
+        #layers that are not convolved are downsampled too so the image keeps a single shape
+        newImg = imageMatrix[::stride, ::stride].copy()
+    if len(layersIdx)==0:
+        return newImg
+    groups = groupIdenticalLayers(layersIdx, identicalGroups)
+    selection = selectLayers([group[0] for group in groups])
+    if newImg.dtype==numpy.float32 and isinstance(selection, slice):
+        convolveLayers(imageMatrix[:,:,selection], kernel, stride, plan, output=newImg[:,:,selection])
+    else:
+        result = convolveLayers(imageMatrix[:,:,selection], kernel, stride, plan)
+        if isWorkingBuffer(newImg):
+            newImg[:,:,selection] = result
+        else:
+            if plan.get('integer'):
+                #the exact result is an integer, float noise must not be truncated away by the cast (2.9999 would become 2)
+                numpy.rint(result, out=result)
+            newImg[:,:,selection] = quantize(result, quantizeMode)
+    copyIdenticalLayers(newImg, groups)
+    return newImg
+
+def composeKernels(kernels):
+    #convolving with a then b is the same as convolving once with a convolved with b
+    composedKernel = kernels[0].astype('float64')
+    for kernel in kernels[1:]:
+        composedKernel = signal.convolve(composedKernel, kernel.astype('float64'), mode='full')
+    return composedKernel
+
+def getChainMargin(kernels):
+    #rows/cols next to the borders where a chain and its fused kernel can differ: every kernel of the chain repeats the
+    #edge pixels of its own input, the fused kernel only those of the image
+    return sum(max(kernel.shape)-1 for kernel in kernels)
+
+def canFuseKernels(kernels, valueRange, stride=1, imageShape=None):
+    #fusing gives the pixels of the chain (up to float32 rounding) only when nothing happens between the kernels:
+    #no stride, kernels of odd sizes (the centre of an even kernel is off by half a pixel, the chain's offsets do not add up
+    #like the fused kernel's) and no intermediate result rounded, wrapped or clipped. a uint8 chain is cast after every
+    #kernel, so it needs integer weights and a worst case bound (through the positive and negative weights of every kernel
+    #but the last) that stays in [0,255]. valueRange is None for a float working buffer, which is never cast between kernels.
+    #the borders are recomputed with the chain (see convolveChainBorders), which needs an image of imageShape big enough
+    if len(kernels)<=1:
+        return False, "only one kernel"
+    if stride!=1:
+        return False, "every kernel downsamples with a stride of {}".format(stride)
+    if any(size%2==0 for kernel in kernels for size in kernel.shape):
+        return False, "a kernel has an even size"
+    if imageShape is not None and min(imageShape[0], imageShape[1])<=4*getChainMargin(kernels):
+        return False, "the image is too small"
+    if valueRange is None:
+        return True, ""
+    if any(not numpy.array_equal(kernel, numpy.round(kernel)) for kernel in kernels):
+        return False, "results would be rounded between kernels"
+    low, high = valueRange
+    for kernel in kernels[:-1]:
+        positiveSum = numpy.sum(kernel[kernel>0])
+        negativeSum = numpy.sum(kernel[kernel<0])
+        low, high = low*positiveSum + high*negativeSum, high*positiveSum + low*negativeSum
+        if low<0 or high>255:
+            return False, "intermediate results would be clipped"
+    return True, ""
+
+def convolveChainBorders(imageMatrix, result, kernels, layersIdx, separableTolerance=0, method='auto', quantizeMode='wrap', identicalGroups=None):
+    #replaces the border bands of a fused result by what the chain gives there. the chain runs on a strip of twice the
+    #margin along every border, the inner half of which only serves as context (it sees the strip's own cut edge)
+    margin = getChainMargin(kernels)
+    height, width = imageMatrix.shape[0], imageMatrix.shape[1]
+    strips = [((0, 2*margin), (0, width), (0, margin), (0, width)),
+              ((height-2*margin, height), (0, width), (height-margin, height), (0, width)),
+              ((0, height), (0, 2*margin), (0, height), (0, margin)),
+              ((0, height), (width-2*margin, width), (0, height), (width-margin, width))]
+    with profiling.span('fused borders', margin=margin):
+        for (rowStart, rowStop), (colStart, colStop), (keepRowStart, keepRowStop), (keepColStart, keepColStop) in strips:
+            strip = imageMatrix[rowStart:rowStop, colStart:colStop]
+            for kernel in kernels:
+                plan = planConvolution(kernel, separableTolerance, strip.shape, 1, method)
+                strip = convolve(strip, kernel, layersIdx, 1, plan, quantizeMode, identicalGroups)
+            result[keepRowStart:keepRowStop, keepColStart:keepColStop] = strip[keepRowStart-rowStart:keepRowStop-rowStart, keepColStart-colStart:keepColStop-colStart]
+    return result
+
+def applyKernels(imageMatrix, kernels, layersIdx, padding=0, stride=1, normalize=True, separableTolerance=0, plans=None, method='auto', fuse=False, quantizeMode='wrap', identicalGroups=None, paddingMode='constant', cache=None):
+    #runs the whole kernel chain and yields the image after every kernel (the GUI animates each step).
+    #the plan used for each kernel is appended to plans when a list is given.
+    #with fuse, kernels are composed into one when that does not change the result (see canFuseKernels), and a single
+    #image is yielded.
+    #with a cache (resultCache.ResultCache), the chain continues from its longest cached prefix: that result is yielded
+    #once for all the cached steps (their plans are {'method': 'cached'}) and every computed step is added to the cache
+    if normalize:
+        kernels = [normalizeKernel(kernel) for kernel in kernels]
+    stepKeys = [None]*len(kernels)
+    if cache is not None and len(kernels)>0:
+        stepKeys = resultCache.getChainKeys(cache.getImageKey(imageMatrix), kernels, layersIdx, padding, paddingMode, stride, separableTolerance, method, fuse, quantizeMode)
+        cachedSteps, cachedImage = cache.findLongestPrefix(stepKeys)
+        if cachedSteps>0:
+            if plans is not None:
+                plans.extend([{'method': 'cached'} for _ in range(cachedSteps)])
+            yield cachedImage
+            imageMatrix, kernels, stepKeys, padding = cachedImage, kernels[cachedSteps:], stepKeys[cachedSteps:], 0
+            if len(kernels)==0:
+                return
+
+    imageMatrix = padImage(imageMatrix, padding, paddingMode)
+    fused = False
+    if fuse and len(layersIdx)>0:
+        if isWorkingBuffer(imageMatrix):
+            valueRange = None
+        else:
+            selectedLayers = imageMatrix[:,:,layersIdx]
+            valueRange = (selectedLayers.min(), selectedLayers.max())
+        fused, _ = canFuseKernels(kernels, valueRange, stride, imageMatrix.shape)
+    if fused:
+        fusedCount = len(kernels)
+        chain = kernels
+        kernels = [composeKernels(kernels)]
+        stepKeys = stepKeys[-1:]
+    for kernel, stepKey in zip(kernels, stepKeys):
+        plan = planConvolution(kernel, separableTolerance, imageMatrix.shape, stride, method)
+        if fused:
+            plan['fused'] = fusedCount
+        if plans is not None:
+            plans.append(plan)
+        newImg = convolve(imageMatrix, kernel, layersIdx, stride, plan, quantizeMode, identicalGroups)
+        if fused:
+            convolveChainBorders(imageMatrix, newImg, chain, layersIdx, separableTolerance, method, quantizeMode, identicalGroups)
+        imageMatrix = newImg
+        if stepKey is not None:
+            cache.put(stepKey, imageMatrix)
+        yield imageMatrix
+
+def applyKernelBank(imageMatrix, kernels, layersIdx, padding=0, stride=1, normalize=True, separableTolerance=0, plans=None, method='auto', paddingMode='constant'):
+    #applies every kernel to the same input, like a convolutional layer, into a float32 stack of feature maps of shape
+    #(rows, cols, kernels*layers): the maps of the selected layers for the first kernel, then for the second...
+    #so a single layer gives rows x cols x kernels. the layers are selected, padded and cast once, every kernel writes
+    #straight into its slice of the stack and the kernels that go through the fft share one transform of the input.
+    #the stack is yielded after every kernel (the same array, complete after the last one) so callers can report progress
+    if normalize:
+        kernels = [normalizeKernel(kernel) for kernel in kernels]
+    layers = padImage(imageMatrix[:,:,layersIdx], padding, paddingMode)
+    if layers.dtype!=numpy.float32:
+        with profiling.span('cast', dtype='float32') as span:
+            layers = layers.astype('float32')
+            span.addBytes(layers.nbytes)
+    outShape = getStridedShape(layers.shape, stride)
+    with profiling.span('feature maps', kernels=len(kernels)) as span:
+        stack = numpy.empty(outShape[:2] + (len(kernels), len(layersIdx)), dtype='float32')
+        span.addBytes(stack.nbytes)
+    #a transform padded for a bigger kernel costs more than it saves, so only kernels of the same shape share one
+    shapeCounts = collections.Counter(kernel.shape for kernel in kernels)
+    bankPlans = [planConvolution(kernel, separableTolerance, layers.shape, stride, method, sharedSpectra=shapeCounts[kernel.shape]) for kernel in kernels]
+    if plans is not None:
+        plans.extend(bankPlans)
+    imageSpectra = {}
+
+    #the maps of one kernel are interleaved with the others in the stack, writing them there one kernel at a time would
+    #go through the whole stack for every kernel. they are computed contiguously and copied a group of kernels at a time
+    groupSize = min(BANK_GROUP_SIZE, len(kernels))
+    group = numpy.empty((groupSize,) + outShape, dtype='float32')
+    featureMaps = stack.reshape(outShape[:2] + (len(kernels)*len(layersIdx),))
+    for idx, (kernel, plan) in enumerate(zip(kernels, bankPlans)):
+        imageSpectrum = None
+        if plan['method']=='fft':
+            if kernel.shape not in imageSpectra:
+                with profiling.span('fft', kernel="{}x{}".format(*kernel.shape)):
+                    imageSpectra[kernel.shape] = getImageSpectrum(layers, [kernel.shape])
+            imageSpectrum = imageSpectra[kernel.shape]
+        with profiling.span('convolve', kernel="{}x{}".format(*kernel.shape), method=plan['method'], stride=stride, bank=idx):
+            convolveLayers(layers, kernel, stride, plan, imageSpectrum, output=group[idx%groupSize])
+        if idx%groupSize==groupSize-1 or idx==len(kernels)-1:
+            start = idx-idx%groupSize
+            stack[:,:,start:idx+1] = numpy.moveaxis(group[:idx+1-start], 0, 2)
+        yield featureMaps
+
+def sobelGradients(layers, normalize=True):
+    #horizontal and vertical derivatives (towards increasing columns/rows) of a layer or a stack of layers, in float32.
+    #the sobel kernels are separable: both come out of one edge padded copy of the layers through shifted slices,
+    #a smoothing and a difference pass each instead of two 3x3 convolutions.
+    #normalize scales them like normalizeKernel does the sobel presets (by 1/8)
+    padded = numpy.pad(layers.astype('float32', copy=False), ((1,1), (1,1)) + ((0,0),)*(layers.ndim-2), mode='edge')
+    smoothed = padded[1:-1]*2
+    smoothed += padded[:-2]
+    smoothed += padded[2:]
+    gradientX = smoothed[:,2:] - smoothed[:,:-2]
+    differentiated = padded[2:] - padded[:-2]
+    gradientY = differentiated[:,1:-1]*2
+    gradientY += differentiated[:,:-2]
+    gradientY += differentiated[:,2:]
+    if normalize:
+        gradientX /= 8
+        gradientY /= 8
+    return gradientX, gradientY
+
+def getGradientMagnitude(gradientX, gradientY):
+    magnitude = gradientX*gradientX
+    magnitude += gradientY*gradientY
+    return numpy.sqrt(magnitude, out=magnitude)
+
+def suppressNonMaxima(magnitude, gradientX, gradientY):
+    #keeps the pixels whose magnitude is at least that of both neighbours across the edge (along the gradient, rounded
+    #to 0, 45, 90 or 135 degrees by comparing the slope with tan(22.5) and tan(67.5)) and zeroes the rest,
+    #leaving one pixel wide edges
+    absoluteX, absoluteY = numpy.absolute(gradientX), numpy.absolute(gradientY)
+    horizontal = absoluteY<=absoluteX*numpy.tan(numpy.radians(22.5))
+    vertical = absoluteY>absoluteX*numpy.tan(numpy.radians(67.5))
+    diagonal = ~(horizontal | vertical)
+    rising = (gradientX>0)==(gradientY>0)
+    directions = [horizontal, diagonal & rising, vertical, diagonal & ~rising]
+    padded = numpy.pad(magnitude, ((1,1), (1,1)) + ((0,0),)*(magnitude.ndim-2), mode='edge')
+    height, width = magnitude.shape[0], magnitude.shape[1]
+    keep = numpy.zeros(magnitude.shape, dtype=bool)
+    for direction, (rowStep, colStep) in zip(directions, [(0,1), (1,1), (1,0), (1,-1)]):
+        forward = padded[1+rowStep:1+rowStep+height, 1+colStep:1+colStep+width]
+        backward = padded[1-rowStep:1-rowStep+height, 1-colStep:1-colStep+width]
+        keep |= direction & (magnitude>=forward) & (magnitude>=backward)
+    magnitude[~keep] = 0
+    return magnitude
+
+def detectEdges(layers, output='magnitude', normalize=True):
+    #one of EDGE_OUTPUTS for a layer or a stack of layers, in float32: the gradient magnitude, the edge orientation
+    #in degrees [0,180) (the direction of the gradient, either way along it) or the non-maximum-suppressed magnitude
+    if output not in EDGE_OUTPUTS:
+        raise ValueError("Unknown edge output '{}', choose from {}".format(output, ", ".join(EDGE_OUTPUTS)))
+    gradientX, gradientY = sobelGradients(layers, normalize)
+    if output=='orientation':
+        return (numpy.degrees(numpy.arctan2(gradientY, gradientX))%180).astype('float32')
+    magnitude = getGradientMagnitude(gradientX, gradientY)
+    if output=='edges':
+        return suppressNonMaxima(magnitude, gradientX, gradientY)
+    return magnitude
+
+def applyEdgeDetection(imageMatrix, layersIdx, output='magnitude', normalize=True, quantizeMode='wrap', identicalGroups=None):
+    #replaces the selected layers by detectEdges of them. the gradients stay in float until the result is stored,
+    #unlike applying sobel-X and sobel-Y one after the other to a uint8 image (which wraps the negative responses)
+    newImg = imageMatrix.copy()
+    if len(layersIdx)==0:
+        return newImg
+    groups = groupIdenticalLayers(layersIdx, identicalGroups)
+    selection = selectLayers([group[0] for group in groups])
+    with profiling.span('edges', output=output) as span:
+        result = detectEdges(imageMatrix[:,:,selection], output, normalize)
+        newImg[:,:,selection] = result if isWorkingBuffer(newImg) else quantize(result, quantizeMode)
+        span.addBytes(result.nbytes)
+    copyIdenticalLayers(newImg, groups)
+    return newImg
+
+def convolveIdenticalLayers(identicalLayers, layersConvolved):
+    #layers that were identical stop being identical once only some of them are convolved
+    newIdenticalLayers = {key: list(identicalLayers[key]) for key in identicalLayers}
+    if len(identicalLayers['red'])==3 and len(layersConvolved)==3:  #if they are both 3, then we are convolving all layers and they are already identical. skip
+        return newIdenticalLayers
+    for layer in layersConvolved:
+        identical = list(set(identicalLayers[layer])-{layer})
+        for l in identical:
+            if l not in layersConvolved:
+                newIdenticalLayers[l].remove(layer)
+                newIdenticalLayers[layer].remove(l)
+    return newIdenticalLayers
+
+@functools.lru_cache(maxsize=None)
+def getFlattenTable(mode, count):
+    #uint8 result of flattening count layers, indexed by the sum of their values (mean) or of their squares (rms).
+    #computed with the same float32 steps as the float path, so both give the same pixels
+    if mode=='mean':
+        sums = numpy.arange(255*count+1, dtype='float32')
+        return numpy.divide(sums, count).astype('uint8')
+    sums = numpy.arange(255**2*count+1, dtype='float32')
+    return numpy.power(numpy.divide(sums, count), 0.5).astype('uint8')
+
+SQUARES_TABLE = numpy.arange(256, dtype='uint32')**2
+
+def flattenBand(band, layersIdx, mode, sums, values):
+    #flattens the layers of a band of rows into values, sums is scratch space of the same shape
+    if band.dtype==numpy.uint8:
+        #integer sums of the values (or of their squares, looked up) index a table of the results
+        if mode=='mean':
+            numpy.copyto(sums, band[:,:,layersIdx[0]])
+            for layer in layersIdx[1:]:
+                numpy.add(sums, band[:,:,layer], out=sums)
+        else:
+            numpy.take(SQUARES_TABLE, band[:,:,layersIdx[0]], out=sums)
+            for layer in layersIdx[1:]:
+                sums += SQUARES_TABLE[band[:,:,layer]]
+        numpy.take(getFlattenTable(mode, len(layersIdx)), sums, out=values)
+        return values
+    numpy.copyto(sums, band[:,:,layersIdx[0]])
+    if mode=='rms':
+        numpy.square(sums, out=sums)
+    for layer in layersIdx[1:]:
+        sums += band[:,:,layer]**2 if mode=='rms' else band[:,:,layer]
+    numpy.divide(sums, len(layersIdx), out=sums)
+    if mode=='rms':
+        numpy.sqrt(sums, out=sums)
+    numpy.copyto(values, sums, casting='unsafe')
+    return values
+
+def flattenLayers(imageMatrix, layersIdx, mode='rms', output=None):
+    #replaces the layers by their root mean square ('rms', how bright they are together) or their mean.
+    #output can be a preallocated image of the same shape and dtype, or imageMatrix itself to flatten in place.
+    #the image is processed in bands of rows, so besides the output only a few rows of scratch space are allocated
+    if mode not in FLATTEN_MODES:
+        raise ValueError("Unknown flatten mode '{}', choose from {}".format(mode, ", ".join(FLATTEN_MODES)))
+    if output is None:
+        output = numpy.empty_like(imageMatrix)
+    if output is not imageMatrix:
+        otherLayers = [layer for layer in range(imageMatrix.shape[2]) if layer not in layersIdx]
+        if len(otherLayers)>0:
+            output[:,:,otherLayers] = imageMatrix[:,:,otherLayers]
+    height, width = imageMatrix.shape[0], imageMatrix.shape[1]
+    bandRows = max(FLATTEN_BAND_PIXELS//max(width, 1), 1)
+    isUint8 = imageMatrix.dtype==numpy.uint8
+    sums = numpy.empty((min(bandRows, height), width), dtype=('uint16' if mode=='mean' else 'uint32') if isUint8 else 'float32')
+    values = numpy.empty(sums.shape, dtype=imageMatrix.dtype)
+    with profiling.span('flatten', mode=mode, layers=len(layersIdx)):
+        for start in range(0, height, bandRows):
+            stop = min(start+bandRows, height)
+            flattened = flattenBand(imageMatrix[start:stop], layersIdx, mode, sums[:stop-start], values[:stop-start])
+            for layer in layersIdx:
+                output[start:stop,:,layer] = flattened
+    return output
+
+def flattenIdenticalLayers(layersToCombine):
+    newIdenticalLayers = {'red':['red'], 'green': ['green'], 'blue':['blue']}
+    for key in newIdenticalLayers:
+        layer = newIdenticalLayers[key][0]
+        if layer in layersToCombine:
+            newIdenticalLayers[key] = list(layersToCombine)
+    return newIdenticalLayers
+
+def getMovedLayerOrder(layers, layersToMove, direction):
+    #new position of every layer after moving layersToMove one step up or down: the moved image is imageMatrix[:,:,order]
+    order = list(range(len(layers)))
+    layersToMove = list(layersToMove)
+
+    if direction=='down':
+        layersToMove.reverse()
+
+    for layer in layersToMove:
+        idx = [layers[i] for i in order].index(layer)
+        if direction=='up':
+            if idx==0:
+                continue
+            order[idx-1], order[idx] = order[idx], order[idx-1]
+        elif direction=='down':
+            if idx==len(layers)-1:
+                continue
+            order[idx], order[idx+1] = order[idx+1], order[idx]
+        else:
+            raise ValueError("direction must be 'up' or 'down'")
+    return order
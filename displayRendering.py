@@ -0,0 +1,172 @@
+#display side helpers of the GUI that do not need Tk: sizing, downscaling and blending frames.
+#everything here works on display resolution buffers (at most maxCanvasSize pixels wide/high)
+
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+import cv2                      #(pip install opencv-python)
+import PIL.Image                #(pip install Pillow)
+
+import convolutionEngine
+import profiling
+
+MIN_PYRAMID_LEVEL_SIZE = 300    #levels are halved until the next one would be smaller than this
+DECODED_CHANNEL_ORDER = [2,1,0] #cv2 decodes to BGR, frames are shown in RGB
+REDUCED_READ_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+def getDisplaySize(imageShape, minSize, maxSize):
+    #fits the image inside maxSize and makes sure it is at least minSize, keeping the aspect ratio. returns (width, height)
+    width, height = imageShape[1], imageShape[0]
+    if width>maxSize:
+        width, height = maxSize, int(maxSize*(height/width))
+    if height>maxSize:
+        width, height = int(maxSize*(width/height)), maxSize
+    if width<minSize:
+        width, height = minSize, int(minSize*(height/width))
+    if height<minSize:
+        width, height = int(minSize*(width/height)), minSize
+    return max(width, 1), max(height, 1)
+
+def resizeForDisplay(imageMatrix, displaySize):
+    #a single resize straight to the display size, area averaging when shrinking avoids aliasing
+    if (imageMatrix.shape[1], imageMatrix.shape[0])==tuple(displaySize):
+        return imageMatrix
+    shrinking = displaySize[0]<imageMatrix.shape[1]
+    with profiling.span('resize', size="{}x{}".format(*displaySize)):
+        return cv2.resize(imageMatrix, tuple(displaySize), interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+
+def getPreviewProxy(imageMatrix, maxSize):
+    #downsampled copy (same dtype) to run kernels on while they are being edited. returns the proxy and its scale
+    displaySize = getDisplaySize(imageMatrix.shape, 1, maxSize)
+    if displaySize[0]>=imageMatrix.shape[1]:
+        return imageMatrix, 1
+    proxy = cv2.resize(imageMatrix, displaySize, interpolation=cv2.INTER_AREA)
+    return proxy.reshape(proxy.shape[:2]+imageMatrix.shape[2:]), displaySize[0]/imageMatrix.shape[1]
+
+def renderDisplayFrame(imageMatrix, displaySize, quantizeMode='wrap', channelOrder=None):
+    return orderChannels(resizeForDisplay(convolutionEngine.quantize(imageMatrix, quantizeMode), displaySize), channelOrder)
+
+def orderChannels(frame, channelOrder=None):
+    #images keep the channel order they were decoded in, only display sized frames are put in display order
+    if channelOrder is None or list(channelOrder)==list(range(frame.shape[2])):
+        return frame
+    return frame[:,:,channelOrder]
+
+def readReducedImage(filePath, minSize):
+    #jpegs can be decoded at 1/2, 1/4 or 1/8 of their resolution much faster (the decoder skips most of the DCT).
+    #returns the smallest of those that is still at least minSize on its shorter side and the reduction factor,
+    #or (None, 1) when the file is not a jpeg or too small to gain anything
+    if not filePath.lower().endswith(('.jpg', '.jpeg')):
+        return None, 1
+    try:
+        with PIL.Image.open(filePath) as image:    #only reads the header
+            width, height = image.size
+    except OSError:
+        return None, 1
+    for factor, flag in REDUCED_READ_FLAGS:
+        if min(width, height)//factor>=minSize:
+            return cv2.imread(filePath, flag), factor
+    return None, 1
+
+def blendFrames(oldFrame, newFrame, ratio, out=None):
+    #ratio 0 gives the old frame and 1 the new one
+    return cv2.addWeighted(oldFrame, 1-ratio, newFrame, ratio, 0, dst=out)
+
+def getAnchorRatios(oldFrame, newFrame):
+    #pixels that change less reach their final value sooner, so every pixel arrives together with the biggest change
+    absoluteDiffMat = numpy.absolute(newFrame.astype('int16')-oldFrame.astype('int16'))
+    #to prevent 0 division error when finding ratio max(absoluteDiffMat)/absoluteDiffMat,
+    #change absolute differences smaller than 1 to 1
+    absoluteDiffMat[absoluteDiffMat<1] = 1
+    return (numpy.max(absoluteDiffMat)/absoluteDiffMat).astype('float32')
+
+def blendFramesAnchored(oldFrame, newFrame, ratio, anchorRatios):
+    ratios = numpy.minimum(anchorRatios*ratio, 1)
+    return (oldFrame + (newFrame.astype('float32')-oldFrame)*ratios).astype('uint8')
+
+class DisplayPyramid:
+    #cached previews of the image at 1/2, 1/4, 1/8... resolution, so a redraw only resizes the smallest level
+    #that is still bigger than the canvas. operations mark the layers/region they changed with invalidate()
+    #and the next update() only recomputes that part of every level
+    def __init__(self, minLevelSize=MIN_PYRAMID_LEVEL_SIZE):
+        self.minLevelSize = minLevelSize
+        self.levels = []
+        self.source = None
+        self.quantizeMode = None
+        self.dirtyLayers = set()
+        self.dirtyRegion = None
+        self.invalidate()
+
+    def invalidate(self, layers=None, rows=None, cols=None):
+        #layers/rows/cols left as None mean all of them. rows and cols are (start, stop) ranges of the full image
+        if layers is None:
+            self.dirtyLayers = None
+        elif self.dirtyLayers is not None:
+            self.dirtyLayers.update(layers)
+        region = (rows or (0, None), cols or (0, None))
+        if self.dirtyRegion is None:
+            self.dirtyRegion = region
+        else:
+            self.dirtyRegion = tuple(mergeRanges(old, new) for old, new in zip(self.dirtyRegion, region))
+
+    def isDirty(self):
+        return self.dirtyLayers is None or len(self.dirtyLayers)>0
+
+    def update(self, imageMatrix, quantizeMode='wrap'):
+        if imageMatrix.size==0:
+            self.levels = []
+            return
+        if len(self.levels)==0 or self.levels[0].shape!=imageMatrix.shape or self.quantizeMode!=quantizeMode or self.source.dtype!=imageMatrix.dtype:
+            self.invalidate()
+        self.source = imageMatrix
+        self.quantizeMode = quantizeMode
+        if not self.isDirty():
+            return
+        with profiling.span('display pyramid', full=self.dirtyLayers is None):
+            if self.dirtyLayers is None:
+                self.build(imageMatrix)
+            else:
+                self.refresh(imageMatrix)
+        self.dirtyLayers = set()
+        self.dirtyRegion = None
+
+    def build(self, imageMatrix):
+        #uint8 images are used as the first level directly, float working buffers are quantized once
+        self.levels = [imageMatrix if imageMatrix.dtype==numpy.uint8 else convolutionEngine.quantize(imageMatrix, self.quantizeMode)]
+        while min(self.levels[-1].shape[:2])>=2*self.minLevelSize:
+            self.levels.append(halveLevel(self.levels[-1]))
+
+    def refresh(self, imageMatrix):
+        layers = sorted(self.dirtyLayers)
+        (rowStart, rowStop), (colStart, colStop) = self.dirtyRegion
+        rowStop = imageMatrix.shape[0] if rowStop is None else rowStop
+        colStop = imageMatrix.shape[1] if colStop is None else colStop
+        if imageMatrix.dtype==numpy.uint8:
+            self.levels[0] = imageMatrix
+        else:
+            self.levels[0][rowStart:rowStop, colStart:colStop, layers] = convolutionEngine.quantize(imageMatrix[rowStart:rowStop, colStart:colStop, layers], self.quantizeMode)
+        for level in range(1, len(self.levels)):
+            #a pixel of the next level averages a 2x2 block of this one
+            rowStart, rowStop = rowStart//2, min(-(-rowStop//2), self.levels[level].shape[0])
+            colStart, colStop = colStart//2, min(-(-colStop//2), self.levels[level].shape[1])
+            block = self.levels[level-1][2*rowStart:2*rowStop, 2*colStart:2*colStop, layers]
+            self.levels[level][rowStart:rowStop, colStart:colStop, layers] = halveLevel(block)
+
+    def getFrame(self, displaySize, channelOrder=None):
+        #smallest cached level that is at least as big as the canvas, resized once
+        level = self.levels[0]
+        for candidate in self.levels[1:]:
+            if candidate.shape[1]<displaySize[0] or candidate.shape[0]<displaySize[1]:
+                break
+            level = candidate
+        return orderChannels(resizeForDisplay(level, displaySize), channelOrder)
+
+def halveLevel(level):
+    #an exact 2x area resize averages every 2x2 block, an odd last row/col is dropped
+    height, width = level.shape[0]//2, level.shape[1]//2
+    halved = cv2.resize(numpy.ascontiguousarray(level[:2*height, :2*width]), (width, height), interpolation=cv2.INTER_AREA)
+    return halved.reshape((height, width) + level.shape[2:])
+
+def mergeRanges(old, new):
+    start = min(old[0], new[0])
+    stop = None if old[1] is None or new[1] is None else max(old[1], new[1])
+    return (start, stop)
@@ -0,0 +1,116 @@
+#undo/redo history of the image operations, bounded by a memory budget.
+#every entry only keeps what is needed to get to the neighbouring state:
+#   state       - the pixels did not change (layers shown in another order...), only the caller's state is stored
+#   layers      - only some layers changed, the other side's pixels of those layers are stored. they are swapped with
+#                 those of the current image in place, or of a copy of it when it is shared (held by a snapshot entry,
+#                 or by the caller's cache...), so arrays held elsewhere never change
+#   snapshot    - the shape or dtype changed, the whole other image is stored
+#entries swap their data with the current image when they are applied, so undo followed by redo never copies more than the delta.
+#the budget can be changed at any time with setMemoryBudget
+
+DEFAULT_HISTORY_BUDGET = 1024**3    #bytes of pixel data kept for undo/redo
+
+class HistoryEntry:
+    def __init__(self, kind, state, data=None, layersIdx=None):
+        self.kind = kind
+        self.state = state      #whatever the caller needs besides the pixels (layer names...), of the other side
+        self.data = data
+        self.layersIdx = layersIdx
+        self.lastUsed = 0
+
+    def getMemoryUsage(self):
+        return 0 if self.data is None else self.data.nbytes
+
+    def swap(self, image, state, shared=False):
+        #returns the image/state on the other side of the entry and keeps the current ones in exchange
+        if self.kind=='state':
+            otherImage = image
+        elif self.kind=='layers':
+            otherImage = image.copy() if shared else image
+            currentLayers = image[:,:,self.layersIdx]
+            otherImage[:,:,self.layersIdx] = self.data
+            self.data = currentLayers
+        else:
+            otherImage, self.data = self.data, image
+        otherState, self.state = self.state, state
+        return otherImage, otherState
+
+class ImageHistory:
+    def __init__(self, memoryBudget=DEFAULT_HISTORY_BUDGET):
+        self.memoryBudget = memoryBudget
+        self.clear()
+
+    def setMemoryBudget(self, memoryBudget):
+        self.memoryBudget = memoryBudget
+        self.evict()
+
+    def clear(self):
+        self.undoEntries = []   #oldest first
+        self.redoEntries = []   #furthest last
+        self.clock = 0
+
+    def record(self, oldImage, newImage, oldState, layersIdx=None):
+        #layersIdx: only these layers differ between oldImage and newImage
+        if newImage is oldImage:
+            entry = HistoryEntry('state', oldState)
+        elif layersIdx is not None and oldImage.shape==newImage.shape and oldImage.dtype==newImage.dtype and len(layersIdx)<oldImage.shape[2]:
+            layersIdx = sorted(layersIdx)
+            entry = HistoryEntry('layers', oldState, oldImage[:,:,layersIdx], layersIdx)
+        else:
+            entry = HistoryEntry('snapshot', oldState, oldImage)
+        self.undoEntries.append(entry)
+        self.redoEntries = []
+        self.touch(entry)
+        self.evict()
+
+    def canUndo(self):
+        return len(self.undoEntries)>0
+
+    def canRedo(self):
+        return len(self.redoEntries)>0
+
+    def getChangedLayers(self, redo=False):
+        #what the next undo (or redo) changes: layers it writes into the current image in place, [] when the image stays
+        #the same and None when another image is returned
+        entry = (self.redoEntries if redo else self.undoEntries)[-1]
+        if entry.kind=='layers':
+            return list(entry.layersIdx)
+        if entry.kind=='state':
+            return []
+        return None
+
+    def holds(self, image):
+        #whether image is kept by a snapshot entry, it must not be modified in place then
+        return any(entry.data is image for entry in self.undoEntries+self.redoEntries)
+
+    def undo(self, image, state, shared=False):
+        #shared: something besides the history holds on to image
+        entry = self.undoEntries.pop()
+        image, state = entry.swap(image, state, shared or self.holds(image))
+        self.redoEntries.append(entry)
+        self.touch(entry)
+        return image, state
+
+    def redo(self, image, state, shared=False):
+        entry = self.redoEntries.pop()
+        image, state = entry.swap(image, state, shared or self.holds(image))
+        self.undoEntries.append(entry)
+        self.touch(entry)
+        return image, state
+
+    def touch(self, entry):
+        self.clock += 1
+        entry.lastUsed = self.clock
+
+    def getMemoryUsage(self):
+        return sum(entry.getMemoryUsage() for entry in self.undoEntries+self.redoEntries)
+
+    def evict(self):
+        #only the two ends of the history can go without cutting the chain of states, the least recently used end goes first
+        usage = self.getMemoryUsage()
+        while usage>self.memoryBudget and (self.undoEntries or self.redoEntries):
+            if not self.redoEntries or (self.undoEntries and self.undoEntries[0].lastUsed<=self.redoEntries[-1].lastUsed):
+                entry = self.undoEntries.pop(0)
+            else:
+                entry = self.redoEntries.pop()
+            usage -= entry.getMemoryUsage()
@@ -1,7 +1,6 @@
 #external libraries (install using pip in your system terminal)
 import PIL.Image, PIL.ImageTk   #(pip install Pillow)
 import numpy                    #(pip install numpy)
-from scipy import ndimage       #(pip install scipy)
 from cv2 import cv2             #(pip install opencv-python)
 
 #native
@@ -9,27 +8,57 @@ import tkinter as tk
 import tkinter.font as tkFont
 from tkinter import filedialog
 import time
-import copy
 import os.path
 
+import convolutionEngine
+import displayRendering
+import backgroundWorker
+import imageHistory
+import imageWriter
+import resultCache
+import profiling
+import batchConvolve
+import streamConvolution
+
 class App: 
     def __init__(self, root):
         self.root = root
         self.imageMatrix = numpy.array([]).astype('uint8')
         self.imagePath = ""
-        self.supportedFileTypes = ["png", "jpg"]
+        self.supportedFileTypes = convolutionEngine.SUPPORTED_FILE_TYPES
         self.layers = ['red','green','blue']
+        self.channelOrder = list(displayRendering.DECODED_CHANNEL_ORDER)  #imageMatrix layer shown at every display position (layers are kept in decode order)
+        self.pendingDecode = None   #file whose full resolution is not decoded yet, imageMatrix then holds a reduced decode
         self.identicalLayers = {}
-        self.layerIsMoving = False
+
+        #heavy image operations run on a worker thread, their results are picked up every workerPollInterval ms
+        self.worker = backgroundWorker.BackgroundWorker()
+        self.workerPollInterval = 50
+        self.workerJob = None
+        #saves are encoded on a writer thread of their own, so editing can go on while a big png is written
+        self.imageWriter = imageWriter.ImageWriter(deliverOnPoll=True)
+        self.writerJob = None
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+
+        #undo/redo keeps at most DEFAULT_HISTORY_BUDGET bytes of pixels (self.history.setMemoryBudget changes it),
+        #the decoded original is kept for Restore Image
+        self.history = imageHistory.ImageHistory(imageHistory.DEFAULT_HISTORY_BUDGET)
+        self.originalImage = None
+        #results of every kernel chain step, so re-running a known pipeline on the same image skips the work
+        self.resultCache = resultCache.ResultCache(resultCache.DEFAULT_MEMORY_BUDGET)
+        self.root.bind('<Control-z>', lambda event: self.undo())
+        self.root.bind('<Control-y>', lambda event: self.redo())
         
         self.kernels = []
-        self.maxKernelSize = (5,5)
+        self.maxKernelSize = (31,31)
         self.maxKernelCount = 5
 
         self.getPresetKernels()
 
         self.defaultConvolvePadding = 0
         self.defaultConvolveStride = 1
+        self.separableTolerance = 0     #relative error allowed when splitting a kernel into 1-D passes
+        self.convolutionMethod = 'auto' #one of convolutionEngine.METHODS
         
         self.settings = tk.Frame(root)
         self.settings.grid(row=0,column=0, sticky='n')
@@ -39,6 +68,20 @@ class App:
         self.isTransitionEnabled = True
         self.transitionDuration = .2
         self.transitionCurve = lambda x: x**1.2
+        self.transitionFrameRate = 30
+        self.transitionJob = None
+        self.displayFrame = None
+        self.displayPyramid = displayRendering.DisplayPyramid()   #downscaled copies of imageMatrix, see invalidateDisplay
+
+        #live preview of the kernels on a display sized copy of the image, refreshed previewDelay ms after the last edit
+        self.previewDelay = 40
+        self.previewJob = None
+        self.previewSource = None
+        self.previewProxy = None
+        self.previewNormalize = True    #follows the last convolve button used
+
+        self.profileRefreshInterval = 500   #ms between updates of the profile summary
+        self.profileSummaryLength = 8       #operations listed in the summary
 
         self.paddingSmall = 5
         self.paddingMedium = 10
@@ -56,48 +99,10 @@ class App:
         self.packSettingsWidgets()
     
     def getPresetKernels(self):
-        self.presetKernels = {
-            'mean-blur': numpy.array([
-                [1, 1, 1],
-                [1, 1, 1],
-                [1 ,1 ,1]
-            ]),
-            'gaussian-blur': numpy.array([
-                [1, 2, 1],
-                [2, 3, 2],
-                [1 ,2 ,1]
-            ]),
-            'gaussian-blur bigger': numpy.array([
-                [0.023528,	0.033969,	0.038393,	0.033969,	0.023528],
-                [0.033969,	0.049045,	0.055432,	0.049045,	0.033969],
-                [0.038393,	0.055432,	0.062651,	0.055432,	0.038393],
-                [0.033969,	0.049045,	0.055432,	0.049045,	0.033969],
-                [0.023528,	0.033969,	0.038393,	0.033969,	0.023528]
-            ]),
-            'sobel-X': numpy.array([
-                [-1, 0, 1],
-                [-2, 0, 2],
-                [-1, 0, 1]
-            ]),
-            'sobel-Y': numpy.array([
-                [-1, -2, -1],
-                [ 0,  0,  0],
-                [ 1,  2,  1]
-            ]),
-        }
+        self.presetKernels = convolutionEngine.getPresetKernels()
     
     def getMaxConvolPadding(self):
-        minKernelDim = float('inf')
-        for kernel in self.kernels:
-            minDim = min(kernel.shape)
-            if minDim<minKernelDim:
-                minKernelDim = minDim
-        
-        maxPadding = (minKernelDim/2)-0.5
-        if maxPadding<0:
-            maxPadding=0
-        
-        return maxPadding
+        return convolutionEngine.getMaxConvolPadding(self.kernels)
 
     
     def packDisplayWidgets(self, defaultWidth, defaultHeight, minSize=100, maxSize=600):
@@ -107,6 +112,7 @@ class App:
         self.canvasFrame = tk.Frame(self.display)
         self.canvasFrame.grid(row=0, column=0)
         self.canvas = tk.Canvas(self.canvasFrame, width=defaultWidth, height=defaultHeight, background='white')
+        self.canvasImage = None
         self.canvas.pack(side='top', padx=self.paddingSmall, pady=(self.paddingSmall,self.paddingSmall/2))
         
         selectImageBttnFrame = tk.Frame(self.display)
@@ -115,11 +121,37 @@ class App:
         selectImageBttn = tk.Button(selectImageBttnFrame, text="Select Image", command=self.loadImage)
         selectImageBttn.grid(row=0, column=0, padx=self.paddingSmall, pady=(0,self.paddingSmall/2))
         
-        restoreImageBttn = tk.Button(selectImageBttnFrame, text="Restore Image", command=lambda: self.loadImage(self.imagePath))
+        restoreImageBttn = tk.Button(selectImageBttnFrame, text="Restore Image", command=self.restoreImage)
         restoreImageBttn.grid(row=0, column=1, padx=self.paddingSmall, pady=(0,self.paddingSmall/2))
         
         saveImageBttn = tk.Button(selectImageBttnFrame, text="Save Image", command=lambda: self.saveImage())
         saveImageBttn.grid(row=0, column=2, padx=self.paddingSmall, pady=(0,self.paddingSmall/2))
+
+        undoBttn = tk.Button(selectImageBttnFrame, text="Undo", command=self.undo)
+        undoBttn.grid(row=0, column=3, padx=(self.paddingSmall,0), pady=(0,self.paddingSmall/2))
+
+        redoBttn = tk.Button(selectImageBttnFrame, text="Redo", command=self.redo)
+        redoBttn.grid(row=0, column=4, padx=(0,self.paddingSmall), pady=(0,self.paddingSmall/2))
+
+        saveOptionsFrame = tk.Frame(self.display)
+        saveOptionsFrame.grid(row=2, column=0)
+
+        png_compression_text = tk.Label(saveOptionsFrame, text="png level:", font=self.smallFont)
+        png_compression_text.grid(row=0, column=0)
+        self.pngCompression = tk.Entry(saveOptionsFrame, width=self.numberEntrySize)
+        self.pngCompression.grid(row=0, column=1, padx=(0,self.paddingSmall))
+
+        jpeg_quality_text = tk.Label(saveOptionsFrame, text="jpg quality:", font=self.smallFont)
+        jpeg_quality_text.grid(row=0, column=2)
+        self.jpegQuality = tk.Entry(saveOptionsFrame, width=self.numberEntrySize)
+        self.jpegQuality.grid(row=0, column=3, padx=(0,self.paddingSmall))
+        self.jpegQuality.insert(0, imageWriter.DEFAULT_JPEG_QUALITY)
+
+        tiff_depth_text = tk.Label(saveOptionsFrame, text="tif bits:", font=self.smallFont)
+        tiff_depth_text.grid(row=0, column=4)
+        self.tiffDepth = tk.StringVar(value=imageWriter.TIFF_DEPTHS[0])
+        tiff_depth_options = tk.OptionMenu(saveOptionsFrame, self.tiffDepth, *imageWriter.TIFF_DEPTHS)
+        tiff_depth_options.grid(row=0, column=5)
     
     def packSettingsWidgets(self):
         self.layersFrame = tk.Frame(self.settings)
@@ -136,6 +168,17 @@ class App:
         self.error_msg_label = tk.Label(self.settings, textvariable=self.error_msg_var, foreground='red', wraplength=150)
         self.error_msg_label.grid(row=3, column=0, padx=self.paddingSmall, pady=self.paddingSmall/2, sticky='s')
 
+        self.status_msg_var = tk.StringVar()
+        self.status_msg_var.set("")
+        self.status_msg_label = tk.Label(self.settings, textvariable=self.status_msg_var, foreground='grey', font=self.smallFont, wraplength=150, justify='left')
+        self.status_msg_label.grid(row=4, column=0, padx=self.paddingSmall, pady=self.paddingSmall/2, sticky='sw')
+
+        #where the time went, only shown while profiling
+        self.profile_msg_var = tk.StringVar()
+        self.profile_msg_var.set("")
+        self.profile_msg_label = tk.Label(self.settings, textvariable=self.profile_msg_var, foreground='grey', font=self.smallFont, wraplength=150, justify='left')
+        self.profile_msg_label.grid(row=5, column=0, padx=self.paddingSmall, pady=self.paddingSmall/2, sticky='sw')
+
         self.packLayersWidgets(self.layersFrame)
         self.packKernelWidgets(self.kernelFrame)
         self.packConvolveWidgets(self.convolveFrame)
@@ -162,7 +205,10 @@ class App:
         move_down['font'] = self.boldSmallFont
         move_down.grid(row=1, column=0, pady=self.paddingSmall/2)
         flatten = tk.Button(self.buttons, text="Flatten", command=lambda: self.flattenLayers(self.getSelectedLayers()))
-        flatten.grid(row=0, column=1, rowspan=2, padx=(self.paddingSmall*2,0))
+        flatten.grid(row=0, column=1, padx=(self.paddingSmall*2,0))
+        self.flattenMode = tk.StringVar(value=convolutionEngine.FLATTEN_MODES[0])
+        flatten_mode_options = tk.OptionMenu(self.buttons, self.flattenMode, *convolutionEngine.FLATTEN_MODES)
+        flatten_mode_options.grid(row=1, column=1, padx=(self.paddingSmall*2,0))
 
     def packConvolveWidgets(self, parent):
         self.convolveTitle = tk.Frame(parent)
@@ -189,6 +235,11 @@ class App:
         self.convolveStride.delete(0,'end')
         self.convolveStride.insert(0,self.defaultConvolveStride)
 
+        self.paddingMode = tk.StringVar(value=convolutionEngine.PADDING_MODES[0])
+        padding_mode_options = tk.OptionMenu(self.convolveSettingsFrame, self.paddingMode, *convolutionEngine.PADDING_MODES)
+        padding_mode_options['font'] = self.smallFont
+        padding_mode_options.grid(row=0, column=4, padx=(self.paddingSmall,0))
+
         reg = self.convolveSettingsFrame.register(self.isanInteger)
         self.convolvePadding['validatecommand'] = (reg,'%P')
         self.convolveStride['validatecommand'] = (reg,'%P')
@@ -201,6 +252,45 @@ class App:
         self.convolve_bttn2['font'] = self.smallFont
         self.convolve_bttn2.grid(row=1, column=2, columnspan=2, padx=self.paddingSmall, pady=self.paddingSmall)
 
+        self.cancel_bttn = tk.Button(self.convolveSettingsFrame, text="Cancel", command=self.cancelOperation, state='disabled')
+        self.cancel_bttn['font'] = self.smallFont
+        self.cancel_bttn.grid(row=1, column=4, padx=self.paddingSmall, pady=self.paddingSmall)
+
+        self.fuseKernels = tk.BooleanVar(value=False)
+        fuse_kernels_check = tk.Checkbutton(self.convolveSettingsFrame, text="fuse kernels", variable=self.fuseKernels, font=self.normalFont)
+        fuse_kernels_check.grid(row=2, column=0, columnspan=4, sticky='w')
+
+        self.useWorkingBuffer = tk.BooleanVar(value=False)
+        working_buffer_check = tk.Checkbutton(self.convolveSettingsFrame, text="float buffer", variable=self.useWorkingBuffer, font=self.normalFont, command=self.toggleWorkingBuffer)
+        working_buffer_check.grid(row=3, column=0, columnspan=2, sticky='w')
+
+        self.quantizeMode = tk.StringVar(value=convolutionEngine.QUANTIZE_MODES[0])
+        quantize_options = tk.OptionMenu(self.convolveSettingsFrame, self.quantizeMode, *convolutionEngine.QUANTIZE_MODES, command=lambda mode: self.drawCanvas())
+        quantize_options['font'] = self.smallFont
+        quantize_options.grid(row=3, column=2, columnspan=2, sticky='w')
+
+        self.livePreview = tk.BooleanVar(value=False)
+        live_preview_check = tk.Checkbutton(self.convolveSettingsFrame, text="live preview", variable=self.livePreview, font=self.normalFont, command=self.toggleLivePreview)
+        live_preview_check.grid(row=4, column=0, columnspan=4, sticky='w')
+
+        self.profileOperations = tk.BooleanVar(value=False)
+        profile_check = tk.Checkbutton(self.convolveSettingsFrame, text="profile", variable=self.profileOperations, font=self.normalFont, command=self.toggleProfiling)
+        profile_check.grid(row=5, column=0, columnspan=2, sticky='w')
+
+        save_trace_bttn = tk.Button(self.convolveSettingsFrame, text="Save Trace", command=self.saveTrace)
+        save_trace_bttn['font'] = self.smallFont
+        save_trace_bttn.grid(row=5, column=2, columnspan=2, sticky='w')
+
+        #sobel gradients in one float pass, instead of sobel-Y, sobel-X and a flatten
+        edges_bttn = tk.Button(self.convolveSettingsFrame, text="Edges", command=self.detectEdges)
+        edges_bttn['font'] = self.smallFont
+        edges_bttn.grid(row=6, column=0, columnspan=2, padx=self.paddingSmall, pady=self.paddingSmall)
+
+        self.edgeOutput = tk.StringVar(value=convolutionEngine.EDGE_OUTPUTS[0])
+        edge_output_options = tk.OptionMenu(self.convolveSettingsFrame, self.edgeOutput, *convolutionEngine.EDGE_OUTPUTS)
+        edge_output_options['font'] = self.smallFont
+        edge_output_options.grid(row=6, column=2, columnspan=2, sticky='w')
+
     def isanInteger(self, value):
         try:
             int(value)
@@ -210,78 +300,235 @@ class App:
                 return True
             return False
 
-    def parseConvolve(self, normalize=True):
+    def getConvolveSettings(self):
+        #padding, stride and layer indexes to convolve, or None once the problem is shown
         if self.missingKernelFieldsExist() or self.missingConvolveFieldsExist():
             self.error("An input field is missing")
-            return
+            return None
         try:
             padding = int(self.convolvePadding.get())
             stride = int(self.convolveStride.get())
-            if padding<0 or padding>self.getMaxConvolPadding():
-                self.error("Padding must be from 0 to {} (half the size of your smallest kernel)".format(int(self.getMaxConvolPadding())))
-                return
-            if stride<=0 or stride>self.calculateMaxStride():
-                self.error("Stride must be less or equal to the smallest kernel dimension minus 1")
-                return
         except ValueError:
             self.error("Kernel size must be an integer")
-            return
+            return None
+        try:
+            convolutionEngine.validateConvolveSettings(self.kernels, padding, stride)
+        except ValueError as e:
+            self.error(str(e))
+            return None
+        if self.imageMatrix.size==0:
+            self.error("No image on display")
+            return None
+        layersIdx = self.getSelectedLayersIdx()
+        if len(layersIdx)==0:
+            self.error("Select the RGB layers to apply filter on")
+            return None
         self.error("")
+        return padding, stride, layersIdx
 
-        
-        if padding != 0:
-            image_shape = self.imageMatrix.shape
-            paddedImg = numpy.zeros((image_shape[0] + padding*2, image_shape[1] + padding*2, 3))
-            for layer in range(self.imageMatrix.shape[2]):
-                layerPadded = numpy.zeros((image_shape[0] + padding*2, image_shape[1] + padding*2))
-                layerPadded[int(padding):int(-1 * padding), int(padding):int(-1 * padding)] = self.imageMatrix[:,:,layer]
-                paddedImg[:,:,layer] = layerPadded
-            self.imageMatrix = paddedImg
-        
-        for kernel in self.kernels:
-            if normalize:
-                kernel = self.normalizeKernel(kernel=kernel)
-            newImg = self.convolve(kernel, padding, stride)
+    def parseConvolve(self, normalize=True):
+        settings = self.getConvolveSettings()
+        if settings is None:
+            return
+        padding, stride, layersIdx = settings
+        if not self.ensureFullImage(lambda: self.parseConvolve(normalize)):
+            return
 
-            self.transition(newImg, self.transitionDuration, self.transitionCurve)
-    
-    def convolve(self, kernel, padding=0, stride=1):
-        newImg = self.imageMatrix.copy()
+        self.previewNormalize = normalize
+        self.cancelPreview()
 
+        #everything the worker needs is copied now, the kernel entries can be edited while it runs
+        image = self.imageMatrix
+        oldState = self.getHistoryState()
+        kernels = [kernel.copy() for kernel in self.kernels]
         layers = self.getSelectedLayers()
-        layersIdx = [self.layers.index(i) for i in layers]
+        identicalGroups = convolutionEngine.getIdenticalGroups(self.identicalLayers, self.getStorageLayers())
+        separableTolerance, method, fuse = self.separableTolerance, self.convolutionMethod, self.fuseKernels.get()
+        paddingMode, quantizeMode = self.paddingMode.get(), self.quantizeMode.get()
+        plans = []
+        shownSteps = []
+
+        def run(task):
+            task.reportProgress(0, "Convolving: kernel 1/{}".format(len(kernels)))
+            for newImg in convolutionEngine.applyKernels(image, kernels, layersIdx, padding, stride, normalize, separableTolerance, plans, method, fuse, quantizeMode, identicalGroups, paddingMode, self.resultCache):
+                #the intermediate images are shown while the next kernel runs. cached steps come out together
+                stepsDone = len(plans)
+                task.reportProgress(stepsDone/len(kernels), "Convolving: kernel {}/{}".format(min(stepsDone+1, len(kernels)), len(kernels)), newImg)
+            return newImg
+
+        def showStep(fraction, message, newImg):
+            self.status(message)
+            if newImg is not None:
+                shownSteps.append(newImg)
+                self.invalidateDisplay(layersIdx)
+                self.transition(newImg, self.transitionDuration, self.transitionCurve)
+
+        def done(newImg):
+            self.history.record(image, newImg, oldState, layersIdx)
+            self.resetIdenticalLayers(identical=convolutionEngine.convolveIdenticalLayers(self.identicalLayers, layers))
+            if self.imageMatrix is not newImg:
+                self.invalidateDisplay(layersIdx)
+                self.transition(newImg, self.transitionDuration, self.transitionCurve)
+            status = ["kernel {}: {}".format(idx+1, convolutionEngine.describePlan(plan)) for idx, plan in enumerate(plans)]
+            #cached steps were not run at all, only a chain of computed steps was run unfused
+            if fuse and len([plan for plan in plans if plan['method']!='cached'])>1:
+                status.append("kernels were not fused (stride above 1, even sized kernels or rounding between kernels)")
+            self.status("\n".join(status))
+
+        def cancelled():
+            #intermediate results are dropped, unless another image was loaded in the meantime
+            if len(shownSteps)>0 and self.imageMatrix is shownSteps[-1]:
+                self.invalidateDisplay()
+                self.transition(image, self.transitionDuration, self.transitionCurve)
+            self.status("Convolution cancelled")
+
+        self.runInBackground(run, done, showStep, cancelled)
+
+    def detectEdges(self):
+        #the gradients are scaled like Norm+Conv scales the sobel kernels, so the magnitude stays within 0-255
+        if self.imageMatrix.size==0:
+            self.error("No image on display")
+            return
+        layersIdx = self.getSelectedLayersIdx()
         if len(layersIdx)==0:
             self.error("Select the RGB layers to apply filter on")
-        for layer in layersIdx:
-            newImg[:,:,layer] = ndimage.convolve(newImg[:,:,layer].astype('float32'), kernel.astype('float32'), mode='nearest')
-        
-        newIdenticalLayers = copy.deepcopy(self.identicalLayers)
-        #fix for some random addressing problem in the array that i have no idea why it's happening
-        for key in newIdenticalLayers:
-            newIdenticalLayers[key] = [newIdenticalLayers[key][idx] for idx in range(len(newIdenticalLayers[key]))]
-
-        layersConvolved = layers
-        if not (len(self.identicalLayers['red'])==3 and len(layersConvolved)==3):  #if they are both 3, then we are convolving all layers and they are already identical. skip
-            for layer in layersConvolved:
-                identical = list(set(self.identicalLayers[layer])-{layer})
-                for l in identical:
-                    if l not in layersConvolved:
-                        newIdenticalLayers[l].remove(layer)
-                        newIdenticalLayers[layer].remove(l)
-            
-            self.resetIdenticalLayers(identical=newIdenticalLayers)
-        
+            return
+        self.error("")
+        if not self.ensureFullImage(self.detectEdges):
+            return
+        self.cancelPreview()
+        image = self.imageMatrix
+        oldState = self.getHistoryState()
+        layers = self.getSelectedLayers()
+        output, quantizeMode = self.edgeOutput.get(), self.quantizeMode.get()
+        identicalGroups = convolutionEngine.getIdenticalGroups(self.identicalLayers, self.getStorageLayers())
 
-        return newImg.astype('uint8')
+        def done(newImg):
+            self.history.record(image, newImg, oldState, layersIdx)
+            self.resetIdenticalLayers(identical=convolutionEngine.convolveIdenticalLayers(self.identicalLayers, layers))
+            self.invalidateDisplay(layersIdx)
+            self.transition(newImg, self.transitionDuration, self.transitionCurve)
+            self.status("")
+
+        self.status("Detecting edges...")
+        self.runInBackground(lambda task: convolutionEngine.applyEdgeDetection(image, layersIdx, output, True, quantizeMode, identicalGroups), done,
+                             onCancel=lambda: self.status("Edge detection cancelled"))
+
+    def saveFeatureMaps(self):
+        #applies every kernel to the image as it is (a kernel bank, like a convolutional layer) and saves the float32
+        #feature maps as a rows x cols x (kernels*layers) .npy stack, the image itself is left unchanged.
+        #kernels are normalized when the last convolution was a Norm+Conv, like the preview (and --normalize in batchConvolve)
+        settings = self.getConvolveSettings()
+        if settings is None:
+            return
+        padding, stride, layersIdx = settings
+        if not self.ensureFullImage(self.saveFeatureMaps):
+            return
+        filePath = tk.filedialog.asksaveasfilename(defaultextension=".npy", filetypes=[("Feature Maps","*.npy")])
+        if filePath is None or filePath=='':
+            return
+        image = self.imageMatrix
+        kernels = [kernel.copy() for kernel in self.kernels]
+        separableTolerance, method, paddingMode, normalize = self.separableTolerance, self.convolutionMethod, self.paddingMode.get(), self.previewNormalize
+
+        def run(task):
+            for idx, featureMaps in enumerate(convolutionEngine.applyKernelBank(image, kernels, layersIdx, padding, stride, normalize, separableTolerance, None, method, paddingMode)):
+                task.reportProgress((idx+1)/len(kernels), "Feature maps: kernel {}/{}".format(idx+1, len(kernels)))
+            numpy.save(filePath, featureMaps)
+            return featureMaps.shape
+
+        def done(shape):
+            self.status("Saved {}x{}x{} feature maps to {}".format(*shape, os.path.basename(filePath)))
+
+        self.runInBackground(run, done, lambda fraction, message, partial: self.status(message), lambda: self.status("Feature maps cancelled"))
+
+    def processVideo(self):
+        #streams every frame of a video (or frame sequence) through the kernels as they are entered, with the convolution
+        #settings and selected layers, into a new video. the image on display is left alone
+        if self.missingKernelFieldsExist() or self.missingConvolveFieldsExist():
+            self.error("An input field is missing")
+            return
+        try:
+            padding = int(self.convolvePadding.get())
+            stride = int(self.convolveStride.get())
+            convolutionEngine.validateConvolveSettings(self.kernels, padding, stride)
+        except ValueError as e:
+            self.error(str(e))
+            return
+        layers = self.getSelectedLayers()
+        if len(layers)==0:
+            self.error("Select the RGB layers to apply filter on")
+            return
+        self.error("")
+        inputPath = tk.filedialog.askopenfilename(filetypes=[("Video","*.mp4 *.avi *.mov *.mkv"), ("All files","*")])
+        if inputPath is None or inputPath=='':
+            return
+        outputPath = tk.filedialog.asksaveasfilename(defaultextension=".mp4", filetypes=[("Video","*.mp4 *.avi")])
+        if outputPath is None or outputPath=='':
+            return
+
+        settings = batchConvolve.getDefaultSettings()
+        settings.update({
+            'kernels': [kernel.copy() for kernel in self.kernels],
+            'layers': layers,
+            'padding': padding,
+            'paddingMode': self.paddingMode.get(),
+            'stride': stride,
+            'separableTolerance': self.separableTolerance,
+            'method': self.convolutionMethod,
+            'fuse': self.fuseKernels.get(),
+            'float': self.useWorkingBuffer.get(),
+            'quantize': self.quantizeMode.get(),
+        })
+
+        def run(task):
+            def showFrame(framesWritten, frameCount):
+                #raises once the task is cancelled, which stops every stage of the stream
+                task.reportProgress(framesWritten/frameCount if frameCount else 0, "Video: frame {}/{}".format(framesWritten, frameCount or "?"))
+            return streamConvolution.processStream(inputPath, outputPath, settings, onFrame=showFrame)
+
+        def done(framesWritten):
+            self.status("Wrote {} frames to {}".format(framesWritten, os.path.basename(outputPath)))
+
+        self.runInBackground(run, done, lambda fraction, message, partial: self.status(message), lambda: self.status("Video processing cancelled"))
+
+    def toggleWorkingBuffer(self):
+        #a float working buffer keeps negative/overflowing results between operations, quantizing only for display and saving
+        if self.imageMatrix.size==0:
+            return
+        if self.worker.isBusy():
+            #the running operation gives a result of the current dtype, the checkbox is put back to match it
+            self.useWorkingBuffer.set(convolutionEngine.isWorkingBuffer(self.imageMatrix))
+            self.status("Still working on the previous operation, cancel it to start a new one")
+            return
+        self.history.record(self.imageMatrix, None, self.getHistoryState())
+        if self.useWorkingBuffer.get():
+            self.imageMatrix = convolutionEngine.toWorkingBuffer(self.imageMatrix)
+        else:
+            self.imageMatrix = convolutionEngine.quantize(self.imageMatrix, self.quantizeMode.get())
+        self.drawCanvas()
+
+    def getSaveMatrix(self):
+        #cv2 writes BGR, which is the order the layers were decoded in, so this is usually not a copy.
+        #a float working buffer stays float, the writer quantizes it for the formats that need it
+        bgrOrder = [self.channelOrder[idx] for idx in reversed(range(len(self.channelOrder)))]
+        return displayRendering.orderChannels(self.imageMatrix, bgrOrder)
 
+    def getSaveOptions(self):
+        #None when an entry is not valid (the error is shown)
+        try:
+            pngCompression = int(self.pngCompression.get()) if self.pngCompression.get().strip()!="" else imageWriter.DEFAULT_PNG_COMPRESSION
+            jpegQuality = int(self.jpegQuality.get())
+            options = imageWriter.getSaveOptions(pngCompression, jpegQuality, self.tiffDepth.get(), self.quantizeMode.get())
+            imageWriter.validateSaveOptions(options)
+        except ValueError as e:
+            self.error(str(e) if "must be" in str(e) else "PNG level and JPG quality must be integers")
+            return None
+        self.error("")
+        return options
 
     def calculateMaxStride(self):
-        minDimensionSize = float('inf')
-        for kernel in self.kernels:
-            shape = kernel.shape
-            if min(shape)<minDimensionSize:
-                minDimensionSize = min(shape)
-        return minDimensionSize-1
+        return convolutionEngine.calculateMaxStride(self.kernels)
     
     def missingConvolveFieldsExist(self):
         field1 = self.convolvePadding.get()
@@ -336,6 +583,41 @@ class App:
         self.presetOptions = tk.OptionMenu(self.presetFiltersFrame, self.selectedPreset, *self.presetKernels.keys(), command=lambda name: self.addKernel(kernel=self.presetKernels[name]))
         self.presetOptions.grid(row=0, column=1)
 
+        #blurs of any size, applied as running sums (a dense kernel this big would not fit the input grid)
+        self.selectedParametricPreset = tk.StringVar(self.presetFiltersFrame, value='gaussian')
+        parametricOptions = tk.OptionMenu(self.presetFiltersFrame, self.selectedParametricPreset, *convolutionEngine.PARAMETRIC_KERNELS.keys(),
+                                          command=lambda name: self.parametricPresetText.config(text=convolutionEngine.PARAMETRIC_KERNELS[name]+":"))
+        parametricOptions.grid(row=0, column=2, padx=(self.paddingSmall,0))
+
+        self.parametricPresetText = tk.Label(self.presetFiltersFrame, text=convolutionEngine.PARAMETRIC_KERNELS['gaussian']+":", font=self.normalFont)
+        self.parametricPresetText.grid(row=0, column=3)
+
+        self.parametric_preset_value = tk.Entry(self.presetFiltersFrame, width=self.numberEntrySize)
+        self.parametric_preset_value.grid(row=0, column=4)
+
+        add_parametric_bttn = tk.Button(self.presetFiltersFrame, text="🡆", command=self.addParametricKernel)
+        add_parametric_bttn['font'] = self.normalFont
+        add_parametric_bttn.grid(row=0, column=5, padx=self.paddingSmall)
+
+        self.pipelineFrame = tk.Frame(parent)
+        self.pipelineFrame.grid(row=3, column=0, pady=self.paddingSmall/4, sticky='nw')
+
+        save_pipeline_bttn = tk.Button(self.pipelineFrame, text="Save Kernels", command=self.savePipeline)
+        save_pipeline_bttn['font'] = self.smallFont
+        save_pipeline_bttn.grid(row=0, column=0, padx=(0,self.paddingSmall))
+
+        load_pipeline_bttn = tk.Button(self.pipelineFrame, text="Load Kernels", command=self.loadPipeline)
+        load_pipeline_bttn['font'] = self.smallFont
+        load_pipeline_bttn.grid(row=0, column=1)
+
+        feature_maps_bttn = tk.Button(self.pipelineFrame, text="Save Feature Maps", command=self.saveFeatureMaps)
+        feature_maps_bttn['font'] = self.smallFont
+        feature_maps_bttn.grid(row=0, column=2, padx=(self.paddingSmall,0))
+
+        process_video_bttn = tk.Button(self.pipelineFrame, text="Process Video", command=self.processVideo)
+        process_video_bttn['font'] = self.smallFont
+        process_video_bttn.grid(row=0, column=3, padx=(self.paddingSmall,0))
+
     def addKernel(self, kernel=None, size=None):
         if len(self.kernels)>=self.maxKernelCount:
             self.error("You can only have a maximum of {} kernels at once".format(self.maxKernelCount))
@@ -361,11 +643,24 @@ class App:
         self.packKernelGridWidgets(self.kernelGridFrame)
 
 
+    def addParametricKernel(self):
+        name = self.selectedParametricPreset.get()
+        try:
+            kernel = convolutionEngine.makeParametricKernel(name, float(self.parametric_preset_value.get()))
+        except ValueError as e:
+            self.error(str(e) if self.parametric_preset_value.get()!="" else "Enter the {} of the {} filter".format(convolutionEngine.PARAMETRIC_KERNELS[name], name))
+            return
+        self.error("")
+        self.addKernel(kernel=kernel)
+
     def error(self, message=None):
         self.error_msg_var.set(message)
         if message!="":
             self.errorBlink()
 
+    def status(self, message=""):
+        self.status_msg_var.set(message)
+
     def errorExists(self):
         exists = self.error_msg_var
         return exists!=""
@@ -378,7 +673,6 @@ class App:
     
     def changeErrorColor(self, color):
         self.error_msg_label.config(fg=color)
-        self.root.update()
 
     def packKernelGridWidgets(self, parent):
         for child in parent.winfo_children():
@@ -405,6 +699,11 @@ class App:
     
     def packKernelInputGridWidgets(self, parent, kernelIdx):
         kernel = self.kernels[kernelIdx]
+        if kernel.shape[0]>self.maxKernelSize[0] or kernel.shape[1]>self.maxKernelSize[1]:
+            #parametric presets can be far too big to edit value by value
+            kernelText = tk.Label(parent, text="{}×{}\nkernel".format(*kernel.shape), font=self.normalFont)
+            kernelText.grid(row=0, column=0, padx=self.paddingSmall, pady=self.paddingSmall)
+            return
         for row in range(kernel.shape[0]):
             for col in range(kernel.shape[1]):
                 inputField = tk.Entry(parent, width=4, validate='key')
@@ -452,10 +751,114 @@ class App:
     
     def setKernelIndexValue(self, kernelIdx, valueIdx, value):
         self.kernels[kernelIdx][valueIdx[0],valueIdx[1]] = value
+        self.schedulePreview()
+
+    def toggleProfiling(self):
+        #timings are collected from the moment the box is checked
+        if self.profileOperations.get():
+            profiling.reset()
+            profiling.enable()
+            self.refreshProfile()
+        else:
+            profiling.disable()
+            self.profile_msg_var.set("")
+
+    def refreshProfile(self):
+        if not self.profileOperations.get():
+            return
+        self.profile_msg_var.set("\n".join(profiling.formatSummary(limit=self.profileSummaryLength)))
+        self.root.after(self.profileRefreshInterval, self.refreshProfile)
+
+    def saveTrace(self):
+        filePath = tk.filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("Chrome Trace","*.json")])
+        if filePath is None or filePath=='':
+            return
+        profiling.saveChromeTrace(filePath)
+
+    def toggleLivePreview(self):
+        if self.livePreview.get():
+            self.schedulePreview()
+        else:
+            self.cancelPreview()
+            self.drawCanvas()
+
+    def schedulePreview(self):
+        #every keystroke pushes the preview back, so it is only computed once the edits pause
+        if not self.livePreview.get():
+            return
+        self.cancelPreview()
+        self.previewJob = self.root.after(self.previewDelay, self.showPreview)
+
+    def cancelPreview(self):
+        if self.previewJob is not None:
+            self.root.after_cancel(self.previewJob)
+            self.previewJob = None
+
+    def getPreviewProxy(self):
+        if self.previewSource is not self.imageMatrix:
+            self.previewProxy = displayRendering.getPreviewProxy(self.imageMatrix, self.maxCanvasSize)
+            self.previewSource = self.imageMatrix
+        return self.previewProxy
+
+    def showPreview(self):
+        #applies the kernels to the display sized proxy and shows it without touching imageMatrix, Convolve commits at full resolution
+        self.previewJob = None
+        if self.imageMatrix.size==0 or self.worker.isBusy():
+            return
+        layersIdx = self.getSelectedLayersIdx()
+        if len(self.kernels)==0 or len(layersIdx)==0:
+            self.drawCanvas()
+            return
+        try:
+            padding = int(self.convolvePadding.get())
+            stride = int(self.convolveStride.get())
+            convolutionEngine.validateConvolveSettings(self.kernels, padding, stride)
+        except ValueError:
+            return
+        if self.missingKernelFieldsExist():
+            return
+
+        proxy, scale = self.getPreviewProxy()
+        previewImg = convolutionEngine.padImage(proxy, int(round(padding*scale)), self.paddingMode.get())
+        identicalGroups = convolutionEngine.getIdenticalGroups(self.identicalLayers, self.getStorageLayers())
+        for previewImg in convolutionEngine.applyKernels(previewImg, self.kernels, layersIdx, 0, stride, self.previewNormalize, self.separableTolerance, None,
+                                                         self.convolutionMethod, self.fuseKernels.get(), self.quantizeMode.get(), identicalGroups):
+            pass
+        self.cancelTransition()
+        displaySize = displayRendering.getDisplaySize(previewImg.shape, self.minCanvasSize, self.maxCanvasSize)
+        self.showFrame(displayRendering.renderDisplayFrame(previewImg, displaySize, self.quantizeMode.get(), self.channelOrder))
+        self.status("Preview, Convolve applies it at full resolution")
+
+    def savePipeline(self):
+        if self.missingKernelFieldsExist():
+            self.error("An input field is missing")
+            return
+        filePath = tk.filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("Kernel Pipeline","*.json")])
+        if filePath is None or filePath=='':
+            return
+        convolutionEngine.savePipeline(filePath, self.kernels)
+        self.error("")
+
+    def loadPipeline(self):
+        filePath = tk.filedialog.askopenfilename(filetypes=[("Kernel Pipeline","*.json")])
+        if filePath is None or filePath=='':
+            return
+        try:
+            kernels = convolutionEngine.loadPipeline(filePath, self.presetKernels)
+        except (ValueError, OSError, KeyError):
+            self.error("File is not a kernel pipeline")
+            return
+        if len(kernels)>self.maxKernelCount:
+            self.error("You can only have a maximum of {} kernels at once".format(self.maxKernelCount))
+            return
+        self.error("")
+        self.kernels = kernels
+        self.packKernelGridWidgets(self.kernelGridFrame)
 
     def removeKernel(self, kernelIdx):
         self.kernels.pop(kernelIdx)
         self.packKernelGridWidgets(self.kernelGridFrame)
+        self.schedulePreview()
     
     def normalizeKernel(self, kernelIdx=None, kernel=None):
         if kernelIdx is None and kernel is None:
@@ -469,10 +872,7 @@ class App:
                 self.kernels[kernelIdx] = self.kernels[kernelIdx]/sum
                 self.packKernelGridWidgets(self.kernelGridFrame)
         elif kernel is not None:
-            sum = numpy.sum(numpy.absolute(kernel))
-            if sum!=0:
-                kernel = kernel/sum
-                return kernel
+            return convolutionEngine.normalizeKernel(kernel)
         return
 
 
@@ -483,24 +883,75 @@ class App:
             if filePath is None or filePath=='':
                 return
             self.imagePath = filePath
+        #whatever was running on the previous image is of no use anymore
+        self.worker.cancel()
+        #big jpegs are shown from a reduced decode first, the full resolution is decoded once an operation needs it
         try:
-            image = cv2.imread(filePath)
+            with profiling.span('decode', file=os.path.basename(filePath), reduced=True) as span:
+                image, factor = displayRendering.readReducedImage(filePath, self.maxCanvasSize)
+                if image is not None:
+                    span.addBytes(image.nbytes)
+            if image is None:
+                with profiling.span('decode', file=os.path.basename(filePath)) as span:
+                    image = cv2.imread(filePath)
+                    if image is not None:
+                        span.addBytes(image.nbytes)
             if image is None:
                 raise Exception
-            self.imageMatrix = image
         except Exception:
             self.error("File does not exist")
             return
-        self.imageMatrix = cv2.cvtColor(self.imageMatrix, cv2.COLOR_BGR2RGB)
-        self.layers = ['red','green','blue']
-        self.resetIdenticalLayers()
+        self.pendingDecode = filePath if factor>1 else None
+        self.setImage(image)
+
+    def setImage(self, image, layers=None, channelOrder=None):
+        #image as decoded by cv2 (BGR). the layers stay in that order, only display frames are put in RGB order.
+        #layers/channelOrder keep an order the layers were moved into (on a reduced decode of the same file)
+        self.originalImage = image
+        self.history.clear()
+        self.imageMatrix = image
+        if self.useWorkingBuffer.get():
+            self.imageMatrix = convolutionEngine.toWorkingBuffer(self.imageMatrix)
+        self.layers = ['red','green','blue'] if layers is None else list(layers)
+        self.channelOrder = list(displayRendering.DECODED_CHANNEL_ORDER) if channelOrder is None else list(channelOrder)
+        self.resetIdenticalLayers(identical=self.findIdenticalLayers())
         self.updateLayersListBox()
+        self.invalidateDisplay()
         self.drawCanvas()
+
+    def ensureFullImage(self, then):
+        #True when imageMatrix is the full resolution image. otherwise its decode is started on the worker,
+        #then() is called once it is loaded and False is returned
+        if self.pendingDecode is None:
+            return True
+        filePath = self.pendingDecode
+
+        def decode(task):
+            with profiling.span('decode', file=os.path.basename(filePath)) as span:
+                image = cv2.imread(filePath)
+                if image is None:
+                    raise ValueError("File does not exist")
+                span.addBytes(image.nbytes)
+            return image
+
+        def done(image):
+            if self.pendingDecode!=filePath:
+                return
+            self.pendingDecode = None
+            self.status("")
+            self.setImage(image, self.layers, self.channelOrder)
+            then()
+
+        if self.runInBackground(decode, done) is not None:
+            self.status("Decoding the full resolution image...")
+        return False
     
     def saveImage(self):
         if self.imageMatrix.size==0:
             self.error("No image on display")
             return
+        if not self.ensureFullImage(self.saveImage):
+            return
                 
         imageName = os.path.basename(self.imagePath)
         imageExtension = ""
@@ -510,12 +961,41 @@ class App:
                 imageExtension = fileType
                 break
         imageName = "{}-modified.{}".format(imageName, imageExtension)
+        options = self.getSaveOptions()
+        if options is None:
+            return
         
         currentImgDir = os.path.dirname(os.path.abspath(self.imagePath))
-        fileSaveFolder = tk.filedialog.askdirectory(initialdir=currentImgDir)
-        imagePath = os.path.join(fileSaveFolder, imageName)
-        cv2.imwrite(imagePath, self.imageMatrix)
-        
+        fileTypes = [(fileFormat.upper(), "*.{}".format(fileFormat)) for fileFormat in imageWriter.SAVE_FORMATS]
+        imagePath = tk.filedialog.asksaveasfilename(initialdir=currentImgDir, initialfile=imageName, defaultextension=".{}".format(imageExtension), filetypes=fileTypes)
+        if imagePath is None or imagePath=='':
+            return
+        try:
+            imageWriter.getFormat(imagePath)
+        except ValueError as e:
+            self.error(str(e))
+            return
+
+        #imageMatrix is never modified in place, so the writer can encode it while the next operation runs
+        fileName = os.path.basename(imagePath)
+        def done(filePath):
+            self.status("Saved {}".format(fileName))
+        def failed(filePath, exception):
+            self.status("")
+            self.error(str(exception))
+        if not self.imageWriter.submit(imagePath, self.getSaveMatrix(), options, done, failed, block=False):
+            self.status("Still saving the previous images, try again in a moment")
+            return
+        self.status("Saving {}...".format(fileName))
+        if self.writerJob is None:
+            self.pollWriter()
+
+    def pollWriter(self):
+        self.writerJob = None
+        self.imageWriter.poll()
+        if self.imageWriter.isBusy():
+            self.writerJob = self.root.after(self.workerPollInterval, self.pollWriter)
+
 
     def flattenLayers(self,layersToCombine):
         if len(layersToCombine)<=1:
@@ -524,67 +1004,144 @@ class App:
         if len(self.identicalLayers['red'])==3: #that means that all three (red, green and blue) are equal, so flattening does nothing
             return
         
-        layersIdx = [self.layers.index(layer) for layer in layersToCombine]
-        
-        newImg = self.imageMatrix.copy()
-        matLayers = newImg[:,:,layersIdx].astype('float32')
-        matLayers = numpy.power(matLayers, 2)
-        matLayers = numpy.sum(matLayers, axis=2)
-        matLayers = numpy.divide(matLayers, len(layersIdx))
-        matLayers = numpy.power(matLayers, 0.5).astype('uint8')
-        matLayers = numpy.repeat(matLayers[:,:,numpy.newaxis], len(layersIdx),axis=2)
-        
-        newImg[:,:,layersIdx] = matLayers
+        if not self.ensureFullImage(lambda: self.flattenLayers(layersToCombine)):
+            return
+        layersIdx = [self.getLayerIdx(layer) for layer in layersToCombine]
+        image = self.imageMatrix
+        mode = self.flattenMode.get()
+        oldState = self.getHistoryState()
 
-        newIdenticalLayers = {'red':['red'], 'green': ['green'], 'blue':['blue']}
-        for key in newIdenticalLayers:
-            layer = newIdenticalLayers[key][0]
-            if layer in layersToCombine:
-                newIdenticalLayers[key] = layersToCombine
-        
-        self.resetIdenticalLayers(identical=newIdenticalLayers)
-        
-        if self.isTransitionEnabled:
-            self.transition(newImg, self.transitionDuration, self.transitionCurve)
-        else:
-            self.imageMatrix = newImg.copy()
-            self.drawCanvas()
+        def done(newImg):
+            self.history.record(image, newImg, oldState, layersIdx)
+            self.resetIdenticalLayers(identical=convolutionEngine.flattenIdenticalLayers(layersToCombine))
+            self.invalidateDisplay(layersIdx)
+            self.showResult(newImg)
+
+        self.runInBackground(lambda task: convolutionEngine.flattenLayers(image, layersIdx, mode), done)
 
     def moveLayers(self, layers, direction):
-        if self.imageMatrix.size==0 or self.layerIsMoving:
+        if self.imageMatrix.size==0:
             return
-         
-        self.layerIsMoving = True
-        newImg = self.imageMatrix.copy()
-        
-        if direction=='down':
-            layers.reverse()
-        
-        for layer in layers:
-            idx = self.layers.index(layer)
-            if direction=='up':
-                if idx==0:
-                    continue
-                newOrder = list(range(0,len(self.layers)))
-                newOrder[idx] = newOrder[idx-1]
-                newOrder[idx-1] = idx
-            elif direction=='down':
-                if idx==len(self.layers)-1:
-                    continue
-                newOrder = list(range(0,len(self.layers)))
-                newOrder[idx] = newOrder[idx+1]
-                newOrder[idx+1] = idx
-            
-            newImg[:,:,:] = newImg[:,:,newOrder]
-            self.layers = [self.layers[i] for i in newOrder]
-        
+        if self.worker.isBusy():
+            self.status("Still working on the previous operation, cancel it to start a new one")
+            return
+        #no pixels are moved: only the order in which imageMatrix layers are shown changes, it is applied when a
+        #frame is rendered or the image is saved. the history stores that order instead of pixels.
+        #a reduced decode can be reordered too, the full resolution image takes the order over when it is loaded
+        oldState = self.getHistoryState()
+        displayOrder = convolutionEngine.getMovedLayerOrder(self.layers, layers, direction)
+        self.layers = [self.layers[position] for position in displayOrder]
+        self.channelOrder = [self.channelOrder[position] for position in displayOrder]
+        self.history.record(self.imageMatrix, self.imageMatrix, oldState)
+        self.updateLayersListBox()
+        self.showResult(self.imageMatrix)
+
+    def getHistoryState(self):
+        #what has to be restored along with the pixels
+        return {'layers': list(self.layers), 'channelOrder': list(self.channelOrder),
+                'identicalLayers': {key: list(self.identicalLayers[key]) for key in self.identicalLayers}}
+
+    def setHistoryState(self, state):
+        self.layers = state['layers']
+        self.channelOrder = state['channelOrder']
         self.updateLayersListBox()
+        self.resetIdenticalLayers(identical=state['identicalLayers'])
+
+    def undo(self):
+        self.stepHistory(self.history.canUndo, self.history.undo, "Nothing to undo", False)
+
+    def redo(self):
+        self.stepHistory(self.history.canRedo, self.history.redo, "Nothing to redo", True)
+
+    def stepHistory(self, canStep, step, emptyMessage, redo):
+        if self.worker.isBusy():
+            self.status("Still working on the previous operation, cancel it to start a new one")
+            return
+        if not canStep():
+            self.status(emptyMessage)
+            return
+        changedLayers = self.history.getChangedLayers(redo)
+        shared = False
+        if changedLayers:
+            #those layers are written into imageMatrix in place. when the original, the cache or the writer still holds
+            #on to it, they are written into a copy instead (the history checks its own snapshots)
+            shared = self.imageMatrix is self.originalImage or self.resultCache.holds(self.imageMatrix) or self.imageWriter.isBusy()
+            if not shared:
+                self.resultCache.discard(self.imageMatrix)
+        newImg, state = step(self.imageMatrix, self.getHistoryState(), shared)
+        self.setHistoryState(state)
+        if changedLayers is None:
+            self.invalidateDisplay()
+        elif changedLayers:
+            self.invalidateDisplay(changedLayers)
+        #undoing a switch to or from the float buffer switches the checkbox back too
+        self.useWorkingBuffer.set(convolutionEngine.isWorkingBuffer(newImg))
+        self.showResult(newImg)
+        self.status("")
+
+    def restoreImage(self):
+        #the decoded original is kept in memory, restoring does not read the file again and can be undone
+        if self.originalImage is None:
+            self.error("No image on display")
+            return
+        if self.pendingDecode is not None:
+            #only the layers can have been moved on a reduced decode, its pixels are still the decoded ones
+            if self.layers==['red','green','blue'] and self.channelOrder==list(displayRendering.DECODED_CHANNEL_ORDER):
+                return
+            newImg = self.imageMatrix
+        else:
+            newImg = self.originalImage
+            if self.useWorkingBuffer.get():
+                newImg = convolutionEngine.toWorkingBuffer(newImg)
+        if self.worker.isBusy():
+            self.worker.cancel()
+        self.history.record(self.imageMatrix, newImg, self.getHistoryState())
+        self.layers = ['red','green','blue']
+        self.channelOrder = list(displayRendering.DECODED_CHANNEL_ORDER)
+        self.updateLayersListBox()
+        self.invalidateDisplay()
+        self.showResult(newImg)
+        self.resetIdenticalLayers(identical=self.findIdenticalLayers())
+
+    def showResult(self, newImg):
         if self.isTransitionEnabled:
             self.transition(newImg, self.transitionDuration, self.transitionCurve)
         else:
-            self.imageMatrix = newImg.copy()
+            self.imageMatrix = newImg
             self.drawCanvas()
-        self.layerIsMoving = False
+
+    def runInBackground(self, function, onDone, onProgress=None, onCancel=None):
+        #image operations run one at a time, clicks that arrive while one is running are coalesced into it
+        task = self.worker.submit('image', function, onDone, onProgress, self.operationFailed, onCancel)
+        if task is None:
+            self.status("Still working on the previous operation, cancel it to start a new one")
+            return None
+        self.cancel_bttn.config(state='normal')
+        if self.workerJob is None:
+            self.pollWorker()
+        return task
+
+    def pollWorker(self):
+        self.workerJob = None
+        self.worker.poll()
+        if self.worker.isBusy():
+            self.workerJob = self.root.after(self.workerPollInterval, self.pollWorker)
+        else:
+            self.cancel_bttn.config(state='disabled')
+
+    def operationFailed(self, exception):
+        self.status("")
+        self.error(str(exception))
+
+    def cancelOperation(self):
+        if self.worker.cancel():
+            self.status("Cancelling...")
+
+    def close(self):
+        #images that are being saved are written before the window goes
+        self.worker.shutdown()
+        self.imageWriter.close()
+        self.root.destroy()
     
     def transition(self, newMat, duration, curve, anchor=False):
         for i in numpy.arange(0,1,0.01):
@@ -597,62 +1154,80 @@ class App:
                 self.imageMatrix = newMat.copy()
                 self.drawCanvas()
                 raise RuntimeWarning("Function is not continuous")
-        
-        oldMat = self.imageMatrix.copy()
-        differenceMat = numpy.subtract(newMat.astype('int16'),oldMat.astype('int16'))
 
-        #---------------------------------------------------------
+        oldMat = self.imageMatrix
+        self.imageMatrix = newMat
+        self.cancelTransition()
+        #a strided convolution shrinks the image, so there is nothing to blend between
+        if oldMat.size==0 or newMat.shape!=oldMat.shape or duration<=0:
+            self.drawCanvas()
+            return
+
+        #frames are blended at display resolution. when a transition is interrupted the next one starts from what is on screen
+        displaySize = displayRendering.getDisplaySize(newMat.shape, self.minCanvasSize, self.maxCanvasSize)
+        if self.displayFrame is not None and self.displayFrame.shape[:2]==(displaySize[1], displaySize[0]):
+            oldFrame = self.displayFrame
+        elif self.displayPyramid.source is oldMat and not self.displayPyramid.isDirty():
+            oldFrame = self.displayPyramid.getFrame(displaySize, self.channelOrder)
+        else:
+            oldFrame = displayRendering.renderDisplayFrame(oldMat, displaySize, self.quantizeMode.get(), self.channelOrder)
+        newFrame = self.renderFrame(displaySize)
         if anchor:
-            absoluteDiffMat = numpy.absolute(differenceMat)
-            #to prevent 0 division error when finding ratio max(absoluteDiffMat)/absoluteDiffMat,
-            #since the max difference is 255 and min is 1, we want to change
-            #absolute difference values in absoluteDiffMat which are smaller than than 1 to 1.
-            absoluteDiffMat[absoluteDiffMat<1] = 1
-            diffRatioMat = numpy.max(absoluteDiffMat)*numpy.power(absoluteDiffMat.astype('float16'),-1)
-        #----------------------------------------------------------
-
-        elapsed = 0
+            anchorRatios = displayRendering.getAnchorRatios(oldFrame, newFrame)
+        frame = numpy.empty_like(newFrame)
+
         startTime = time.time()
-        while elapsed<duration:
-            timeRatio = elapsed/duration
-            transitionRatio = curve(timeRatio)
-            if transitionRatio>1:
-                transitionRatio=1
-            
-            if anchor:
-                transitionRatioMat = diffRatioMat*numpy.float16(transitionRatio)
-                transitionRatioMat[transitionRatioMat>1] = 1
-                increment = numpy.multiply(differenceMat,transitionRatioMat)
-            else:
-                increment = differenceMat*numpy.float16(transitionRatio)
-
-            self.imageMatrix = numpy.add(oldMat.astype('int16'), increment.astype('int16')).astype('uint8')
-            self.drawCanvas()
-        
+        frameInterval = int(1000/self.transitionFrameRate)
+        def showNextFrame():
+            #the blend follows the clock, so frames that can not be drawn in time are dropped instead of slowing the animation
             elapsed = time.time() - startTime
+            if elapsed>=duration:
+                self.transitionJob = None
+                self.showFrame(newFrame)
+                return
+            transitionRatio = min(curve(elapsed/duration), 1)
+            with profiling.span('transition frame', anchor=anchor):
+                if anchor:
+                    self.showFrame(displayRendering.blendFramesAnchored(oldFrame, newFrame, transitionRatio, anchorRatios))
+                else:
+                    self.showFrame(displayRendering.blendFrames(oldFrame, newFrame, transitionRatio, frame))
+            profiling.count('transition frames')
+            self.transitionJob = self.root.after(frameInterval, showNextFrame)
+        showNextFrame()
 
-        self.imageMatrix = newMat
-        self.drawCanvas()
+    def cancelTransition(self):
+        if self.transitionJob is not None:
+            self.root.after_cancel(self.transitionJob)
+            self.transitionJob = None
 
     def drawCanvas(self):
         if self.imageMatrix.size==0:
             return
-        image = PIL.Image.fromarray(self.imageMatrix.astype('uint8'))
-
-        if image.size[0]>self.maxCanvasSize:
-            image = image.resize((self.maxCanvasSize, int(self.maxCanvasSize*(image.size[1]/image.size[0]))))
-        if image.size[1]>self.maxCanvasSize:
-            image = image.resize((int((self.maxCanvasSize*(image.size[0]/image.size[1])), self.maxCanvasSize)))
-        
-        if image.size[0]<self.minCanvasSize:
-            image = image.resize((self.minCanvasSize, int(self.minCanvasSize*(image.size[1]/image.size[0]))))
-        if image.size[1]<self.minCanvasSize:
-            image = image.resize((int((self.minCanvasSize*(image.size[0]/image.size[1])), self.minCanvasSize)))
-
-        self.photo = PIL.ImageTk.PhotoImage(image = image)
-        self.canvas.config(width=image.size[0], height=image.size[1])
-        self.canvas.create_image(0,0,anchor="nw", image=self.photo)
-        self.canvas.update()
+        self.cancelTransition()
+        with profiling.span('drawCanvas'):
+            displaySize = displayRendering.getDisplaySize(self.imageMatrix.shape, self.minCanvasSize, self.maxCanvasSize)
+            self.showFrame(self.renderFrame(displaySize))
+
+    def invalidateDisplay(self, layersIdx=None, rows=None, cols=None):
+        #every change to the pixels of imageMatrix has to be reported here, the next frame only recomputes those layers/rows/cols
+        #of the cached display pyramid. changes of shape, dtype or quantize mode are picked up without it
+        self.displayPyramid.invalidate(layersIdx, rows, cols)
+        self.previewSource = None
+        self.previewProxy = None
+
+    def renderFrame(self, displaySize):
+        self.displayPyramid.update(self.imageMatrix, self.quantizeMode.get())
+        return self.displayPyramid.getFrame(displaySize, self.channelOrder)
+
+    def showFrame(self, frame):
+        self.displayFrame = frame
+        profiling.count('frames rendered')
+        self.photo = PIL.ImageTk.PhotoImage(image = PIL.Image.fromarray(frame))
+        self.canvas.config(width=frame.shape[1], height=frame.shape[0])
+        if self.canvasImage is None:
+            self.canvasImage = self.canvas.create_image(0,0,anchor="nw", image=self.photo)
+        else:
+            self.canvas.itemconfig(self.canvasImage, image=self.photo)
 
     def updateLayersListBox(self):
         selectedLayers = self.getSelectedLayers()
@@ -672,10 +1247,34 @@ class App:
     def getSelectedLayers(self):
         selectedLayers = [self.layersListBox.get(idx) for idx in self.layersListBox.curselection()]
         return selectedLayers
+
+    def getSelectedLayersIdx(self):
+        return [self.getLayerIdx(layer) for layer in self.getSelectedLayers()]
+
+    def getLayerIdx(self, layer):
+        #index in imageMatrix of a layer, self.layers lists them in display order
+        return self.channelOrder[self.layers.index(layer)]
+
+    def getStorageLayers(self):
+        #layer names in imageMatrix order
+        storageLayers = list(self.layers)
+        for position, idx in enumerate(self.channelOrder):
+            storageLayers[idx] = self.layers[position]
+        return storageLayers
     
     def clearLayersSelection(self):
         self.layersListBox.selection_clear(0, "end")
 
+    def findIdenticalLayers(self):
+        #greyscale files are decoded into three equal layers, which only need to be convolved once
+        identical = {layer: [layer] for layer in self.layers}
+        storageLayers = self.getStorageLayers()
+        for group in convolutionEngine.findIdenticalGroups(self.imageMatrix):
+            groupLayers = [storageLayers[idx] for idx in group]
+            for layer in groupLayers:
+                identical[layer] = groupLayers
+        return identical
+
     def resetIdenticalLayers(self, identical=None):
         if identical is None:
             self.identicalLayers = {'red':['red'], 'green': ['green'], 'blue':['blue']} #they are each only identical to themselves
@@ -696,6 +1295,7 @@ class App:
                     colored.append(layer)
         
 
-root = tk.Tk()
-myApp = App(root)
-root.mainloop()
+if __name__ == '__main__':
+    root = tk.Tk()
+    myApp = App(root)
+    root.mainloop()
@@ -0,0 +1,150 @@
+#saving results: png with a chosen compression level, jpg with a chosen quality, 8 bit, 16 bit or float tiff and lossless
+#.npy or raw buffers (which keep float results as they are). an ImageWriter encodes on its own thread behind a bounded
+#queue, so the GUI or the computation of the next image does not wait for the encoder.
+#images are handed over in cv2's BGR order, buffers are written in RGB order like tiledConvolution expects them
+
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+import cv2                      #(pip install opencv-python)
+
+#native
+import os
+import queue
+import threading
+
+import convolutionEngine
+import profiling
+
+SAVE_FORMATS = ['png', 'jpg', 'tif', 'npy', 'raw']
+FORMAT_ALIASES = {'jpeg': 'jpg', 'tiff': 'tif'}
+TIFF_DEPTHS = ['8', '16', 'float']
+DEFAULT_PNG_COMPRESSION = None  #opencv's own setting, faster here than any zlib level (higher levels take several times longer for a few percent)
+DEFAULT_JPEG_QUALITY = 95
+DEFAULT_QUEUE_SIZE = 2          #images waiting for the writer, on top of the one being encoded
+
+def getSaveOptions(pngCompression=DEFAULT_PNG_COMPRESSION, jpegQuality=DEFAULT_JPEG_QUALITY, tiffDepth='8', quantizeMode='wrap'):
+    return {'pngCompression': pngCompression, 'jpegQuality': jpegQuality, 'tiffDepth': tiffDepth, 'quantize': quantizeMode}
+
+def validateSaveOptions(options):
+    if options['pngCompression'] is not None and not 0<=options['pngCompression']<=9:
+        raise ValueError("PNG compression must be between 0 and 9")
+    if not 0<=options['jpegQuality']<=100:
+        raise ValueError("JPEG quality must be between 0 and 100")
+    if options['tiffDepth'] not in TIFF_DEPTHS:
+        raise ValueError("Unknown tiff depth '{}', choose from {}".format(options['tiffDepth'], ", ".join(TIFF_DEPTHS)))
+
+def getFormat(filePath):
+    fileFormat = filePath.lower().rsplit('.', 1)[-1]
+    fileFormat = FORMAT_ALIASES.get(fileFormat, fileFormat)
+    if fileFormat not in SAVE_FORMATS:
+        raise ValueError("{} can not be saved, choose one of {}".format(os.path.basename(filePath), "/".join(SAVE_FORMATS)))
+    return fileFormat
+
+def getEncodeParams(fileFormat, options):
+    if fileFormat=='png' and options['pngCompression'] is not None:
+        return [cv2.IMWRITE_PNG_COMPRESSION, int(options['pngCompression'])]
+    if fileFormat=='jpg':
+        return [cv2.IMWRITE_JPEG_QUALITY, int(options['jpegQuality'])]
+    return []
+
+def prepareImage(imageMatrix, fileFormat, options, bgr=True):
+    #the pixels as they are written: buffers keep the dtype (float results stay float), 16 bit tiffs scale 0-255 to
+    #0-65535 and clip, float tiffs are float32 and everything else is quantized to 8 bits
+    if fileFormat in ['npy', 'raw']:
+        if bgr and imageMatrix.ndim==3 and imageMatrix.shape[2]==3:
+            imageMatrix = imageMatrix[:,:,::-1]
+        return numpy.ascontiguousarray(imageMatrix)
+    if fileFormat=='tif' and options['tiffDepth']=='float':
+        return imageMatrix.astype('float32', copy=False)
+    if fileFormat=='tif' and options['tiffDepth']=='16':
+        if imageMatrix.dtype==numpy.uint8:
+            return numpy.multiply(imageMatrix, 257, dtype='uint16')
+        scaled = numpy.multiply(imageMatrix, 257, dtype='float32')
+        return numpy.clip(scaled, 0, 65535, out=scaled).astype('uint16')
+    return convolutionEngine.quantize(imageMatrix, options['quantize'])
+
+def writeImage(filePath, imageMatrix, options=None, bgr=True):
+    #writes now, on the calling thread. raw buffers only hold the pixels: open them with their shape and dtype
+    #(numpy.memmap, or tiledConvolution --raw-shape/--raw-dtype)
+    options = getSaveOptions() if options is None else options
+    fileFormat = getFormat(filePath)
+    image = prepareImage(imageMatrix, fileFormat, options, bgr)
+    with profiling.span('encode', file=os.path.basename(filePath), format=fileFormat) as span:
+        if fileFormat=='npy':
+            numpy.save(filePath, image)
+        elif fileFormat=='raw':
+            image.tofile(filePath)
+        elif not cv2.imwrite(filePath, image, getEncodeParams(fileFormat, options)):
+            raise ValueError("{} could not be written".format(filePath))
+        span.addBytes(image.nbytes)
+    return filePath
+
+class ImageWriter:
+    #writes images one after another on a thread. submitted images are not copied, they must not be modified afterwards.
+    #onDone(filePath)/onError(filePath, exception) are called on the writer thread, unless a results queue is polled:
+    #with deliverOnPoll they are kept until poll() is called (from the Tk thread, like BackgroundWorker.poll)
+    def __init__(self, queueSize=DEFAULT_QUEUE_SIZE, deliverOnPoll=False):
+        self.requests = queue.Queue(maxsize=queueSize)
+        self.results = queue.Queue() if deliverOnPoll else None
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='imageWriter', daemon=True)
+        self.thread.start()
+
+    def submit(self, filePath, imageMatrix, options=None, onDone=None, onError=None, bgr=True, block=True):
+        #blocks while the queue is full, so whoever produces the images can not get more than the queue ahead of the encoder.
+        #with block=False nothing is queued and False is returned instead
+        with self.lock:
+            self.pending += 1
+        try:
+            self.requests.put((filePath, imageMatrix, options, onDone, onError, bgr), block=block)
+        except queue.Full:
+            with self.lock:
+                self.pending -= 1
+            return False
+        return True
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                self.requests.task_done()
+                return
+            filePath, imageMatrix, options, onDone, onError, bgr = request
+            del request
+            try:
+                writeImage(filePath, imageMatrix, options, bgr)
+                callback, args = onDone, (filePath,)
+            except Exception as e:
+                callback, args = onError, (filePath, e)
+            del imageMatrix
+            #delivered before the image stops counting as pending, so a poll after isBusy() is False gets it
+            if callback is not None:
+                if self.results is None:
+                    callback(*args)
+                else:
+                    self.results.put((callback, args))
+            with self.lock:
+                self.pending -= 1
+            self.requests.task_done()
+
+    def isBusy(self):
+        with self.lock:
+            return self.pending>0
+
+    def poll(self):
+        while True:
+            try:
+                callback, args = self.results.get_nowait()
+            except queue.Empty:
+                return
+            callback(*args)
+
+    def wait(self):
+        #until everything submitted so far is written
+        self.requests.join()
+
+    def close(self):
+        #writes what is still queued and stops the thread
+        self.requests.put(None)
+        self.thread.join()
@@ -0,0 +1,135 @@
+#optional instrumentation of where the time goes: wall time of every operation (decode, colour conversion, padding,
+#convolution, casts, redraws...), the bytes it allocated and how many frames were rendered.
+#recording is off by default and costs a single check per operation then. the events can be summarised for
+#the GUI status line or saved in chrome trace format (open in chrome://tracing or https://ui.perfetto.dev)
+
+#native
+import json
+import os
+import threading
+import time
+
+class Span:
+    #one timed operation, use through profiling.span()
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+        self.bytes = 0
+
+    def addBytes(self, count):
+        self.bytes += count
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.recorder.addEvent(self.name, self.start, time.perf_counter()-self.start, self.bytes, self.args)
+        return False
+
+class NullSpan:
+    #stands in for a span while recording is off
+    def addBytes(self, count):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Recorder:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+            self.counters = {}
+
+    def addEvent(self, name, start, duration, byteCount, args):
+        #perf_counter is a system wide monotonic clock, so events of different processes line up
+        event = {'name': name, 'start': start, 'duration': duration, 'bytes': byteCount, 'args': args,
+                 'pid': os.getpid(), 'tid': threading.get_ident()}
+        with self.lock:
+            self.events.append(event)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+recorder = Recorder()
+
+def enable():
+    recorder.enabled = True
+
+def disable():
+    recorder.enabled = False
+
+def isEnabled():
+    return recorder.enabled
+
+def reset():
+    recorder.reset()
+
+def span(name, **args):
+    #with profiling.span('convolve', kernel='3x3') as s: ... s.addBytes(result.nbytes)
+    if not recorder.enabled:
+        return NULL_SPAN
+    return Span(recorder, name, args)
+
+def count(name, amount=1):
+    if recorder.enabled:
+        recorder.count(name, amount)
+
+def getEvents():
+    with recorder.lock:
+        return list(recorder.events)
+
+def getCounters():
+    with recorder.lock:
+        return dict(recorder.counters)
+
+def getSummary(events=None):
+    #total time, calls and bytes per operation name, most expensive first
+    summary = {}
+    for event in getEvents() if events is None else events:
+        entry = summary.setdefault(event['name'], {'name': event['name'], 'calls': 0, 'seconds': 0, 'bytes': 0})
+        entry['calls'] += 1
+        entry['seconds'] += event['duration']
+        entry['bytes'] += event['bytes']
+    return sorted(summary.values(), key=lambda entry: entry['seconds'], reverse=True)
+
+def formatSummary(events=None, counters=None, limit=None):
+    lines = []
+    for entry in getSummary(events)[:limit]:
+        line = "{} {}x {:.1f} ms".format(entry['name'], entry['calls'], entry['seconds']*1000)
+        if entry['bytes']:
+            line += " {:.1f} MB".format(entry['bytes']/1024**2)
+        lines.append(line)
+    for name, value in sorted((getCounters() if counters is None else counters).items()):
+        lines.append("{} {}".format(name, value))
+    return lines
+
+def getChromeTrace(events=None, counters=None):
+    events = getEvents() if events is None else events
+    origin = min([event['start'] for event in events], default=0)
+    traceEvents = []
+    for event in events:
+        args = dict(event['args'])
+        if event['bytes']:
+            args['bytes'] = event['bytes']
+        traceEvents.append({'name': event['name'], 'ph': 'X', 'ts': (event['start']-origin)*1e6, 'dur': event['duration']*1e6,
+                            'pid': event['pid'], 'tid': event['tid'], 'args': args})
+    for name, value in (getCounters() if counters is None else counters).items():
+        traceEvents.append({'name': name, 'ph': 'C', 'ts': 0, 'pid': os.getpid(), 'tid': 0, 'args': {name: value}})
+    return {'traceEvents': traceEvents, 'displayTimeUnit': 'ms'}
+
+def saveChromeTrace(filePath, events=None, counters=None):
+    with open(filePath, 'w') as file:
+        json.dump(getChromeTrace(events, counters), file)
@@ -0,0 +1,163 @@
+#content addressed cache of convolution results.
+#the input image is keyed on a hash of its pixels, and every step of a kernel chain is keyed on the key of its input
+#chained with everything that changes its output (normalised kernel, layers, padding, stride...). so every prefix of a
+#chain has its own key, and a chain that was run before (or one that starts the same way) continues from the longest
+#cached prefix. there is an in-memory LRU tier and an optional on-disk tier of .npy files, each with a size cap
+
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+
+#native
+import collections
+import hashlib
+import os
+import tempfile
+import weakref
+
+DEFAULT_MEMORY_BUDGET = 512*1024**2
+DEFAULT_DISK_BUDGET = 4*1024**3
+
+def hashImage(imageMatrix):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((imageMatrix.shape, imageMatrix.dtype.str)).encode())
+    digest.update(numpy.ascontiguousarray(imageMatrix).data)
+    return digest.hexdigest()
+
+def chainKey(key, *params):
+    #key of a step applied to the image with the given key. arrays (kernels) are hashed by shape and float64 bytes
+    digest = hashlib.blake2b(key.encode(), digest_size=16)
+    for param in params:
+        if isinstance(param, numpy.ndarray):
+            digest.update(repr(param.shape).encode())
+            digest.update(numpy.ascontiguousarray(param, dtype='float64').data)
+        else:
+            digest.update(repr(param).encode())
+    return digest.hexdigest()
+
+def getChainKeys(imageKey, kernels, layersIdx, padding=0, paddingMode='constant', stride=1, separableTolerance=0, method='auto', fuse=False, quantizeMode='wrap'):
+    #one key per kernel of the chain. kernels must already be normalised if they are going to be.
+    #a fused chain has no intermediate results, so only its last entry has a key
+    key = chainKey(imageKey, 'padding', padding, paddingMode)
+    params = (sorted(layersIdx), stride, separableTolerance, method, quantizeMode)
+    if fuse:
+        return [None]*(len(kernels)-1) + [chainKey(key, 'fused', *kernels, *params)]
+    keys = []
+    for kernel in kernels:
+        key = chainKey(key, kernel, *params)
+        keys.append(key)
+    return keys
+
+class ResultCache:
+    #arrays handed to or returned by the cache are shared, they must not be modified in place
+    def __init__(self, memoryBudget=DEFAULT_MEMORY_BUDGET, cacheDir=None, diskBudget=DEFAULT_DISK_BUDGET):
+        self.memoryBudget = memoryBudget
+        self.memory = collections.OrderedDict()     #key -> array, least recently used first
+        self.memoryUsage = 0
+        self.cacheDir = cacheDir
+        self.diskBudget = diskBudget
+        self.imageKeys = {}                         #id(array) -> (weakref, key) of arrays whose key is already known
+        if cacheDir is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+
+    def getImageKey(self, imageMatrix):
+        known = self.imageKeys.get(id(imageMatrix))
+        if known is not None and known[0]() is imageMatrix:
+            return known[1]
+        key = hashImage(imageMatrix)
+        self.rememberImageKey(imageMatrix, key)
+        return key
+
+    def rememberImageKey(self, imageMatrix, key):
+        #a cached result is identified by its chain key, so convolving it again does not need to hash its pixels
+        idx = id(imageMatrix)
+        def forget(ref):
+            if self.imageKeys.get(idx, (None,))[0] is ref:
+                del self.imageKeys[idx]
+        self.imageKeys[idx] = (weakref.ref(imageMatrix, forget), key)
+
+    def discard(self, imageMatrix):
+        #before imageMatrix is modified in place: it is no longer the result of its key, nor is its key known
+        known = self.imageKeys.pop(id(imageMatrix), None)
+        for key in [key for key, result in self.memory.items() if result is imageMatrix]:
+            self.memoryUsage -= self.memory.pop(key).nbytes
+        return known is not None
+
+    def holds(self, imageMatrix):
+        #whether imageMatrix is a result kept in memory, it must not be modified in place then
+        return any(result is imageMatrix for result in self.memory.values())
+
+    def getFilePath(self, key):
+        return os.path.join(self.cacheDir, key+'.npy')
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.cacheDir is None:
+            return None
+        filePath = self.getFilePath(key)
+        try:
+            result = numpy.load(filePath)
+            os.utime(filePath)
+        except (OSError, ValueError):
+            return None
+        self.rememberImageKey(result, key)
+        self.putInMemory(key, result)
+        return result
+
+    def findLongestPrefix(self, keys):
+        #returns how many steps of the chain are cached and the result of the last of them
+        for count in range(len(keys), 0, -1):
+            if keys[count-1] is None:
+                continue
+            result = self.get(keys[count-1])
+            if result is not None:
+                return count, result
+        return 0, None
+
+    def put(self, key, result):
+        self.rememberImageKey(result, key)
+        self.putInMemory(key, result)
+        if self.cacheDir is not None and result.nbytes<=self.diskBudget:
+            #written under a temporary name first, so other processes never load half a file
+            fileDescriptor, temporaryPath = tempfile.mkstemp(suffix='.npy', dir=self.cacheDir)
+            with os.fdopen(fileDescriptor, 'wb') as file:
+                numpy.save(file, result)
+            os.replace(temporaryPath, self.getFilePath(key))
+            self.evictDisk()
+
+    def putInMemory(self, key, result):
+        if result.nbytes>self.memoryBudget:
+            return
+        if key in self.memory:
+            self.memoryUsage -= self.memory.pop(key).nbytes
+        self.memory[key] = result
+        self.memoryUsage += result.nbytes
+        while self.memoryUsage>self.memoryBudget:
+            _, evicted = self.memory.popitem(last=False)
+            self.memoryUsage -= evicted.nbytes
+
+    def evictDisk(self):
+        #least recently used files (by modification time, refreshed on every hit) go first
+        files = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cacheDir, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        usage = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if usage<=self.diskBudget:
+                break
+            try:
+                os.remove(os.path.join(self.cacheDir, name))
+            except OSError:
+                pass
+            usage -= size
+
+    def clear(self):
+        self.memory.clear()
+        self.memoryUsage = 0
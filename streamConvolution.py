@@ -0,0 +1,194 @@
+#streaming mode: applies a kernel pipeline to every frame of a video file or of a numbered frame sequence.
+#decoding, convolving and encoding run as overlapping stages connected by bounded queues, so the memory used
+#stays the same however long the stream is.
+#example:
+#   python streamConvolution.py inspection.mp4 inspection-edges.mp4 -k gaussian:1.5 --edges magnitude --normalize
+#   python streamConvolution.py "frames/%05d.png" "out/%05d.png" --pipeline edges.json -j 4
+
+#external libraries (install using pip in your system terminal)
+import cv2                      #(pip install opencv-python)
+
+#native
+import argparse
+import collections
+import concurrent.futures
+import os
+import queue
+import sys
+import threading
+
+import convolutionEngine
+import batchConvolve
+import profiling
+
+DEFAULT_QUEUE_SIZE = 8      #frames each stage may run ahead of the next one
+DEFAULT_CODEC = 'mp4v'
+DEFAULT_FPS = 30            #frame sequences carry no frame rate
+STAGE_POLL_INTERVAL = 0.1   #seconds a blocked stage waits before checking whether the stream was stopped
+
+def isFrameSequence(path):
+    #printf style patterns like frames/%05d.png, as understood by cv2.VideoCapture and cv2.VideoWriter
+    return '%' in os.path.basename(path)
+
+def openCapture(inputPath):
+    capture = cv2.VideoCapture(inputPath)
+    if not capture.isOpened():
+        raise ValueError("{} could not be opened as a video or frame sequence".format(inputPath))
+    return capture
+
+def getFrameCount(capture):
+    #0 when the container does not tell
+    return max(int(capture.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+
+def openWriter(outputPath, frame, fps, codec=DEFAULT_CODEC):
+    #frame sequences are written one image file per frame, whatever the codec
+    height, width = frame.shape[0], frame.shape[1]
+    isColor = frame.ndim==3 and frame.shape[2]>1
+    if isFrameSequence(outputPath):
+        writer = cv2.VideoWriter(outputPath, 0, 0, (width, height), isColor)
+    else:
+        writer = cv2.VideoWriter(outputPath, cv2.VideoWriter_fourcc(*codec), fps, (width, height), isColor)
+    if not writer.isOpened():
+        raise ValueError("{} could not be opened for writing with codec {}".format(outputPath, codec))
+    return writer
+
+def readFrames(capture):
+    while True:
+        with profiling.span('decode') as span:
+            ok, frame = capture.read()
+            if ok:
+                span.addBytes(frame.nbytes)
+        if not ok:
+            return
+        yield frame
+
+def prefetch(items, size=DEFAULT_QUEUE_SIZE):
+    #runs a generator on its own thread, at most size items ahead of whoever consumes them.
+    #its exceptions are raised in the consumer, and it stops when the consumer stops (closes this generator):
+    #closing returns only once the thread has finished, so what the generator reads from can be released afterwards
+    buffer = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(message):
+        while not stopped.is_set():
+            try:
+                buffer.put(message, timeout=STAGE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((True, item)):
+                    return
+        except Exception as e:
+            put((False, e))
+            return
+        put((False, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            isItem, value = buffer.get()
+            if not isItem:
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        #a producer blocked on the full queue sees stopped within STAGE_POLL_INTERVAL, one in the middle of reading an
+        #item finishes it first
+        stopped.set()
+        thread.join()
+        while not buffer.empty():
+            buffer.get_nowait()
+
+def convolveFrames(frames, layersIdx, settings, workers=1, size=DEFAULT_QUEUE_SIZE, plans=None):
+    #frames are convolved by a pool of threads (numpy/scipy release the GIL) and come out in their original order,
+    #with at most size frames in flight. the plans of the first frame are added to plans when a list is given
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='streamWorker')
+    pending = collections.deque()
+    try:
+        for idx, frame in enumerate(frames):
+            framePlans = plans if idx==0 else None
+            pending.append(executor.submit(batchConvolve.convolveImage, frame, layersIdx, settings, framePlans))
+            if len(pending)>=size:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+def processStream(inputPath, outputPath, settings, workers=1, queueSize=DEFAULT_QUEUE_SIZE, codec=DEFAULT_CODEC, fps=None, plans=None, onFrame=None):
+    #decode (thread) -> convolve (pool of workers) -> encode (calling thread). returns the number of frames written.
+    #onFrame(framesWritten, frameCount) is called after every frame, frameCount is 0 when unknown. raising from it stops the stream
+    capture = openCapture(inputPath)
+    if fps is None:
+        fps = capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+    frameCount = getFrameCount(capture)
+    layersIdx = batchConvolve.getLayersIdx(settings['layers'], bgr=True)
+    frames = prefetch(readFrames(capture), queueSize)
+    results = convolveFrames(frames, layersIdx, settings, workers, queueSize, plans)
+    writer = None
+    framesWritten = 0
+    try:
+        for frame in results:
+            if writer is None:
+                outputDir = os.path.dirname(outputPath)
+                if outputDir:
+                    os.makedirs(outputDir, exist_ok=True)
+                writer = openWriter(outputPath, frame, fps, codec)
+            with profiling.span('encode') as span:
+                writer.write(frame)
+                span.addBytes(frame.nbytes)
+            framesWritten += 1
+            if onFrame is not None:
+                onFrame(framesWritten, frameCount)
+    finally:
+        #the decode thread is joined when frames is closed, only then nothing reads from the capture any more
+        results.close()
+        frames.close()
+        capture.release()
+        if writer is not None:
+            writer.release()
+    return framesWritten
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply a kernel pipeline to every frame of a video or frame sequence with constant memory.")
+    parser.add_argument('input', help="video file or frame sequence pattern like frames/%%05d.png")
+    parser.add_argument('output', help="video file or frame sequence pattern to write")
+    batchConvolve.addPipelineArguments(parser)
+    parser.add_argument('-j', '--workers', type=int, default=1, help="threads convolving frames at once (default: %(default)s)")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help="frames every stage may run ahead of the next one (default: %(default)s)")
+    parser.add_argument('--codec', default=DEFAULT_CODEC, help="fourcc of the output video (default: %(default)s)")
+    parser.add_argument('--fps', type=float, default=None, help="frame rate of the output video (default: the input's, or {} for frame sequences)".format(DEFAULT_FPS))
+    args = parser.parse_args(argv)
+    settings = batchConvolve.getSettings(args, parser)
+    if len(args.codec)!=4:
+        parser.error("--codec must be a fourcc of 4 characters, e.g. mp4v or MJPG")
+    if settings['trace']:
+        profiling.enable()
+
+    plans = []
+    def showProgress(framesWritten, frameCount):
+        if framesWritten%100==0 or framesWritten==frameCount:
+            print("{}/{} frames".format(framesWritten, frameCount or "?"), file=sys.stderr)
+    try:
+        framesWritten = processStream(args.input, args.output, settings, max(args.workers, 1), max(args.queue_size, 1), args.codec, args.fps, plans, showProgress)
+    except ValueError as e:
+        parser.error(str(e))
+    methods = [convolutionEngine.describePlan(plan) for plan in plans]
+    if settings['edges'] is not None:
+        methods.append("sobel {}".format(settings['edges']))
+    print("{} -> {} ({} frames, {})".format(args.input, args.output, framesWritten, ", ".join(methods)))
+    if settings['trace']:
+        batchConvolve.saveTrace(args.trace, profiling.getEvents())
+    return 0 if framesWritten>0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+import pytest                   #(pip install pytest)
+from scipy import ndimage       #(pip install scipy)
+
+import convolutionEngine
+
+def assertMatchesScipy(layers, kernel, method, stride):
+    plan = convolutionEngine.planConvolution(kernel, imageShape=layers.shape, stride=stride, method=method)
+    assert plan['method']==method
+    result = convolutionEngine.convolveLayers(layers, kernel, stride, plan)
+    expected = ndimage.convolve(layers.astype('float64'), kernel[:,:,None], mode='nearest')[::stride, ::stride]
+    assert result.shape==expected.shape
+    numpy.testing.assert_allclose(result, expected, atol=1e-3*max(numpy.abs(expected).max(), 1))
+
+@pytest.mark.parametrize('stride', [1, 2, 3])
+@pytest.mark.parametrize('kernelName', ['sobel-X', 'gaussian-blur bigger'])
+def testDirectMatchesScipy(kernelName, stride, makeImage):
+    kernel = convolutionEngine.getPresetKernels()[kernelName].astype('float64')
+    assertMatchesScipy(makeImage().astype('float32'), kernel, 'direct', stride)
+
+@pytest.mark.parametrize('stride', [1, 2, 3])
+def testConvolveKeepsUnselectedLayers(stride, makeImage):
+    image = makeImage()
+    kernel = convolutionEngine.getPresetKernels()['sobel-Y'].astype('float64')
+    newImg = convolutionEngine.convolve(image, kernel, [1], stride)
+    assert newImg.shape==convolutionEngine.getStridedShape(image.shape, stride)
+    numpy.testing.assert_array_equal(newImg[:,:,[0,2]], image[::stride, ::stride][:,:,[0,2]])
+
+@pytest.mark.parametrize('stride', [1, 2, 3])
+def testSeparableMatchesScipy(stride, makeImage):
+    assertMatchesScipy(makeImage().astype('float32'), numpy.outer([1, 2, 1], [1, 4, 6, 4, 1])/64, 'separable', stride)
+
+def testLowRankKernelIsSplit():
+    kernel = numpy.outer([1, 2, 1], [1, 0, -1]) + numpy.outer([0, 1, 0], [1, 1, 1])
+    pairs, error = convolutionEngine.separateKernel(kernel)
+    assert len(pairs)==2 and error<1e-9
+    numpy.testing.assert_allclose(sum(numpy.outer(column, row) for column, row in pairs), kernel, atol=1e-9)
+
+@pytest.mark.parametrize('stride', [1, 2, 3])
+@pytest.mark.parametrize('kernelShape', [(5, 7), (15, 15)])
+def testFftMatchesScipy(kernelShape, stride, makeImage):
+    kernel = numpy.random.default_rng(1).normal(size=kernelShape)
+    assertMatchesScipy(makeImage().astype('float32'), kernel, 'fft', stride)
+
+def testLargeKernelsPickTheFft():
+    plan = convolutionEngine.planConvolution(numpy.random.default_rng(1).normal(size=(31, 31)), imageShape=(1000, 1000, 3))
+    assert plan['method']=='fft'
+    plan = convolutionEngine.planConvolution(numpy.random.default_rng(1).normal(size=(3, 3)), imageShape=(1000, 1000, 3))
+    assert plan['method']!='fft'
+
+def testIntegerKernelIsExactWithEveryMethod(makeImage):
+    image = makeImage()
+    kernel = numpy.outer([1, 2, 1], [1, 2, 1]).astype('float64')
+    expected = convolutionEngine.convolve(image, kernel, [0,1,2], plan=convolutionEngine.planConvolution(kernel, method='direct'))
+    for method in ['separable', 'fft']:
+        plan = convolutionEngine.planConvolution(kernel, method=method)
+        numpy.testing.assert_array_equal(convolutionEngine.convolve(image, kernel, [0,1,2], plan=plan), expected)
+
+def runChain(image, kernels, fuse, **settings):
+    plans = []
+    results = list(convolutionEngine.applyKernels(image, kernels, [0,1,2], fuse=fuse, plans=plans, **settings))
+    return results[-1], plans
+
+@pytest.mark.parametrize('paddingMode', ['constant', 'edge', 'reflect'])
+def testFusedWorkingBufferMatchesChain(paddingMode, makeImage):
+    image = convolutionEngine.toWorkingBuffer(makeImage((60, 64, 3)))
+    presetKernels = convolutionEngine.getPresetKernels()
+    kernels = [presetKernels['gaussian-blur'], presetKernels['mean-blur'], presetKernels['sobel-X']]
+    fused, plans = runChain(image, kernels, True, padding=2, paddingMode=paddingMode)
+    chain, _ = runChain(image, kernels, False, padding=2, paddingMode=paddingMode)
+    assert len(plans)==1 and plans[0]['fused']==3
+    numpy.testing.assert_allclose(fused, chain, atol=1e-3)
+
+def testFusedUint8MatchesChainForIntegerKernels(makeImage):
+    image = makeImage((60, 64, 3))//4
+    kernels = [numpy.array([[0, 0, 0], [0, 1, 1], [0, 0, 0]]), numpy.array([[0, 1, 0], [0, 1, 0], [0, 0, 0]])]
+    fused, plans = runChain(image, kernels, True, normalize=False)
+    chain, _ = runChain(image, kernels, False, normalize=False)
+    assert plans[0].get('fused')==2
+    numpy.testing.assert_array_equal(fused, chain)
+
+def testUint8ChainIsNotFusedWhenRounded(makeImage):
+    image = makeImage((60, 64, 3))
+    presetKernels = convolutionEngine.getPresetKernels()
+    _, plans = runChain(image, [presetKernels['gaussian-blur'], presetKernels['mean-blur']], True)
+    assert len(plans)==2 and 'fused' not in plans[0]
+
+def testCanFuseKernelsRules():
+    kernel = numpy.ones((3, 3))
+    assert not convolutionEngine.canFuseKernels([kernel], None)[0]
+    assert not convolutionEngine.canFuseKernels([kernel, kernel], None, stride=2)[0]
+    assert not convolutionEngine.canFuseKernels([kernel, numpy.ones((2, 2))], None)[0]
+    assert not convolutionEngine.canFuseKernels([kernel, kernel], None, imageShape=(8, 100))[0]
+    assert not convolutionEngine.canFuseKernels([kernel, kernel], (0, 255))[0]
+    assert convolutionEngine.canFuseKernels([kernel, kernel], (0, 28))[0]
+    assert convolutionEngine.canFuseKernels([kernel/9, kernel/9], None, imageShape=(100, 100))[0]
+
+@pytest.mark.parametrize('stride', [1, 2, 3])
+@pytest.mark.parametrize('kernelSpec', ['box:2', 'gaussian:3', 'mean-blur'])
+def testBoxMatchesScipy(kernelSpec, stride, makeImage):
+    kernel = convolutionEngine.normalizeKernel(convolutionEngine.parseKernel(kernelSpec))
+    assertMatchesScipy(makeImage().astype('float32'), kernel, 'box', stride)
+
+@pytest.mark.parametrize('sigma', [0.5, 1, 1.5, 2, 4])
+def testGaussianKernelHasItsSigma(sigma):
+    kernel = convolutionEngine.parseKernel('gaussian:{}'.format(sigma))
+    profile = kernel.sum(axis=1)
+    positions = numpy.arange(len(profile)) - len(profile)//2
+    assert kernel.shape[0]>=3 and kernel.shape[0]%2==1
+    assert numpy.isclose(kernel.sum(), 1)
+    assert abs(numpy.sqrt(numpy.sum(profile*positions**2)) - sigma) < 0.1*sigma + 0.1
+
+@pytest.mark.parametrize('spec', ['gaussian:0', 'gaussian:-2', 'gaussian:nan', 'box:1.5'])
+def testInvalidParametricKernelIsRejected(spec):
+    with pytest.raises(ValueError):
+        convolutionEngine.parseKernel(spec)
+
+@pytest.mark.parametrize('layersIdx', [[0,2], [1]])
+def testWorkingBufferIsNotRoundedForSomeLayers(layersIdx, makeImage):
+    image = convolutionEngine.toWorkingBuffer(makeImage())*0.37
+    kernel = convolutionEngine.getPresetKernels()['sobel-X'].astype('float64')
+    allLayers = convolutionEngine.convolve(image, kernel, [0,1,2])
+    someLayers = convolutionEngine.convolve(image, kernel, layersIdx)
+    numpy.testing.assert_array_equal(someLayers[:,:,layersIdx], allLayers[:,:,layersIdx])
+    assert not numpy.array_equal(someLayers, numpy.round(someLayers))
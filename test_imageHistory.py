@@ -0,0 +1,100 @@
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+
+import convolutionEngine
+import imageHistory
+import resultCache
+
+SHAPE = (20, 30, 3)
+
+def testLayersUndoRedoInPlace():
+    history = imageHistory.ImageHistory()
+    oldImage = numpy.zeros(SHAPE, dtype='uint8')
+    newImage = oldImage.copy()
+    newImage[:,:,1] = 7
+    history.record(oldImage, newImage, 'old', layersIdx=[1])
+    assert history.getChangedLayers()==[1]
+    assert history.getMemoryUsage()==oldImage[:,:,1].nbytes
+
+    image, state = history.undo(newImage, 'new')
+    assert image is newImage and state=='old'
+    assert numpy.all(image==0)
+    assert history.getChangedLayers(redo=True)==[1]
+    image, state = history.redo(image, 'old')
+    assert state=='new'
+    assert numpy.all(image[:,:,1]==7) and numpy.all(image[:,:,[0,2]]==0)
+
+def testStateAndSnapshotEntries():
+    history = imageHistory.ImageHistory()
+    image = numpy.zeros(SHAPE, dtype='uint8')
+    history.record(image, image, 'before move')
+    assert history.getChangedLayers()==[]
+    assert history.getMemoryUsage()==0
+    smaller = numpy.full((10, 15, 3), 5, dtype='uint8')
+    history.record(image, smaller, 'full size')
+    assert history.getChangedLayers() is None
+    undone, state = history.undo(smaller, 'small')
+    assert undone is image and state=='full size'
+    undone, state = history.undo(undone, 'full size')
+    assert undone is image and state=='before move'
+    assert not history.canUndo() and history.canRedo()
+
+def testNewRecordDropsRedo():
+    history = imageHistory.ImageHistory()
+    image = numpy.zeros(SHAPE, dtype='uint8')
+    history.record(image, numpy.full(SHAPE, 1, dtype='uint8'), 'a')
+    history.undo(numpy.full(SHAPE, 1, dtype='uint8'), 'b')
+    history.record(image, numpy.full(SHAPE, 2, dtype='uint8'), 'c')
+    assert not history.canRedo()
+
+def testBudgetEvictsOldestEntries():
+    image = numpy.zeros(SHAPE, dtype='uint8')
+    history = imageHistory.ImageHistory(memoryBudget=2*image.nbytes)
+    for value in range(4):
+        history.record(image, numpy.full(SHAPE, value+1, dtype='uint8'), value)
+    assert len(history.undoEntries)==2
+    assert history.getMemoryUsage()<=2*image.nbytes
+    assert [entry.state for entry in history.undoEntries]==[2, 3]
+
+def testSetMemoryBudgetEvictsNow():
+    image = numpy.zeros(SHAPE, dtype='uint8')
+    history = imageHistory.ImageHistory()
+    for value in range(3):
+        history.record(image, numpy.full(SHAPE, value+1, dtype='uint8'), value)
+    history.undo(numpy.full(SHAPE, 3, dtype='uint8'), 'current')
+    history.setMemoryBudget(image.nbytes)
+    assert history.getMemoryUsage()<=image.nbytes
+    assert len(history.undoEntries)+len(history.redoEntries)==1
+    history.setMemoryBudget(0)
+    assert not history.canUndo() and not history.canRedo()
+
+def testUndoNeverChangesSharedArrays(makeImage):
+    #convolve, restore, convolve again (a cache hit returns the first result) and undo twice
+    original = makeImage()
+    kernels = [convolutionEngine.getPresetKernels()['sobel-X']]
+    cache = resultCache.ResultCache()
+    history = imageHistory.ImageHistory()
+    convolved = list(convolutionEngine.applyKernels(original, kernels, [0], cache=cache))[-1]
+    expected = convolved.copy()
+    history.record(original, convolved, 'original', layersIdx=[0])
+    history.record(convolved, original, 'convolved')
+    cachedResult = list(convolutionEngine.applyKernels(original, kernels, [0], cache=cache))[-1]
+    assert cachedResult is convolved
+    history.record(original, cachedResult, 'restored', layersIdx=[0])
+
+    image, state = history.undo(cachedResult, 'convolved again', cache.holds(cachedResult))
+    assert state=='restored' and image is not convolved
+    numpy.testing.assert_array_equal(image, original)
+    image, state = history.undo(image, state)
+    assert state=='convolved'
+    numpy.testing.assert_array_equal(image, expected)
+    numpy.testing.assert_array_equal(cache.get(cache.getImageKey(convolved)), expected)
+
+def testLayersEntryCopiesImageHeldBySnapshot():
+    history = imageHistory.ImageHistory()
+    first = numpy.zeros(SHAPE, dtype='uint8')
+    second = numpy.full(SHAPE, 9, dtype='uint8')
+    history.record(second, first, 'second')
+    history.record(first, second, 'first', layersIdx=[2])
+    image, _ = history.undo(second, 'back to first')
+    assert image is not second and numpy.all(second==9)
@@ -0,0 +1,100 @@
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+import cv2                      #(pip install opencv-python)
+import pytest                   #(pip install pytest)
+
+#native
+import threading
+
+import imageWriter
+
+@pytest.mark.parametrize('dtype', ['uint8', 'float32'])
+def testNpyIsWrittenInRgbOrder(tmp_path, dtype, makeImage):
+    image = makeImage(dtype=dtype)
+    filePath = str(tmp_path/'image.npy')
+    imageWriter.writeImage(filePath, image)
+    saved = numpy.load(filePath)
+    assert saved.dtype==image.dtype
+    numpy.testing.assert_array_equal(saved, image[:,:,::-1])
+    imageWriter.writeImage(filePath, image, bgr=False)
+    numpy.testing.assert_array_equal(numpy.load(filePath), image)
+
+def testRawIsWrittenInRgbOrder(tmp_path, makeImage):
+    image = makeImage(dtype='float32')
+    filePath = str(tmp_path/'image.raw')
+    imageWriter.writeImage(filePath, image)
+    saved = numpy.fromfile(filePath, dtype='float32').reshape(image.shape)
+    numpy.testing.assert_array_equal(saved, image[:,:,::-1])
+
+def testSingleLayerBufferIsNotReordered(tmp_path, makeImage):
+    image = makeImage((37, 41, 1))
+    filePath = str(tmp_path/'image.npy')
+    imageWriter.writeImage(filePath, image)
+    numpy.testing.assert_array_equal(numpy.load(filePath), image)
+
+@pytest.mark.parametrize('fileName', ['image.png', 'image.tif'])
+def testLosslessImagesRoundTrip(tmp_path, fileName, makeImage):
+    image = makeImage()
+    filePath = str(tmp_path/fileName)
+    imageWriter.writeImage(filePath, image)
+    numpy.testing.assert_array_equal(cv2.imread(filePath), image)
+
+def testPngCompressionLevel(tmp_path, makeImage):
+    image = makeImage()
+    filePath = str(tmp_path/'image.png')
+    imageWriter.writeImage(filePath, image, imageWriter.getSaveOptions(pngCompression=9))
+    numpy.testing.assert_array_equal(cv2.imread(filePath), image)
+
+def testSixteenBitTiffIsScaled(tmp_path, makeImage):
+    image = makeImage()
+    filePath = str(tmp_path/'image.tif')
+    imageWriter.writeImage(filePath, image, imageWriter.getSaveOptions(tiffDepth='16'))
+    saved = cv2.imread(filePath, cv2.IMREAD_UNCHANGED)
+    assert saved.dtype==numpy.uint16
+    numpy.testing.assert_array_equal(saved, image.astype('uint16')*257)
+
+def testQuantizeModeIsApplied(tmp_path):
+    image = numpy.full((4, 4, 3), -1, dtype='float32')
+    filePath = str(tmp_path/'image.png')
+    imageWriter.writeImage(filePath, image, imageWriter.getSaveOptions(quantizeMode='clip'))
+    assert numpy.all(cv2.imread(filePath)==0)
+
+@pytest.mark.parametrize('fileName', ['image.gif', 'image'])
+def testUnknownFormatIsRejected(tmp_path, fileName, makeImage):
+    with pytest.raises(ValueError):
+        imageWriter.writeImage(str(tmp_path/fileName), makeImage())
+
+def testInvalidOptionsAreRejected():
+    with pytest.raises(ValueError):
+        imageWriter.validateSaveOptions(imageWriter.getSaveOptions(pngCompression=10))
+    with pytest.raises(ValueError):
+        imageWriter.validateSaveOptions(imageWriter.getSaveOptions(jpegQuality=101))
+    with pytest.raises(ValueError):
+        imageWriter.validateSaveOptions(imageWriter.getSaveOptions(tiffDepth='32'))
+
+def testWriterThreadWritesEverything(tmp_path, makeImage):
+    writer = imageWriter.ImageWriter(queueSize=1)
+    images = [makeImage()+idx for idx in range(4)]
+    written = []
+    errors = []
+    for idx, image in enumerate(images):
+        writer.submit(str(tmp_path/'{}.npy'.format(idx)), image, onDone=written.append, onError=lambda filePath, e: errors.append(filePath))
+    writer.submit(str(tmp_path/'bad.gif'), images[0], onDone=written.append, onError=lambda filePath, e: errors.append(filePath))
+    writer.wait()
+    assert not writer.isBusy()
+    assert written==[str(tmp_path/'{}.npy'.format(idx)) for idx in range(4)]
+    assert errors==[str(tmp_path/'bad.gif')]
+    for idx, image in enumerate(images):
+        numpy.testing.assert_array_equal(numpy.load(str(tmp_path/'{}.npy'.format(idx))), image[:,:,::-1])
+    writer.close()
+    assert not writer.thread.is_alive()
+
+def testWriterDeliversOnPoll(tmp_path, makeImage):
+    writer = imageWriter.ImageWriter(deliverOnPoll=True)
+    threads = []
+    writer.submit(str(tmp_path/'image.png'), makeImage(), onDone=lambda filePath: threads.append(threading.current_thread()))
+    writer.wait()
+    assert threads==[]
+    writer.poll()
+    assert threads==[threading.current_thread()]
+    writer.close()
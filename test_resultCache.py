@@ -0,0 +1,70 @@
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+
+#native
+import os
+
+import convolutionEngine
+import resultCache
+
+def getKernels():
+    presetKernels = convolutionEngine.getPresetKernels()
+    return [presetKernels['mean-blur'], presetKernels['sobel-X'], presetKernels['gaussian-blur']]
+
+def testChainContinuesFromCachedPrefix(makeImage):
+    image = makeImage()
+    kernels = getKernels()
+    cache = resultCache.ResultCache()
+    prefix = list(convolutionEngine.applyKernels(image, kernels[:2], [0,1,2], cache=cache))
+    plans = []
+    results = list(convolutionEngine.applyKernels(image.copy(), kernels, [0,1,2], plans=plans, cache=cache))
+    assert [plan['method'] for plan in plans[:2]]==['cached', 'cached']
+    assert plans[2]['method']!='cached'
+    assert results[0] is prefix[-1]
+    numpy.testing.assert_array_equal(results[-1], list(convolutionEngine.applyKernels(image, kernels, [0,1,2]))[-1])
+
+def testSettingsChangeTheKeys():
+    kernels = [convolutionEngine.normalizeKernel(kernel) for kernel in getKernels()]
+    keys = resultCache.getChainKeys('image', kernels, [0,1,2])
+    assert len(set(keys))==len(kernels)
+    assert resultCache.getChainKeys('image', kernels, [2,1,0])==keys
+    assert resultCache.getChainKeys('image', kernels, [0,1,2], stride=2)[0]!=keys[0]
+    assert resultCache.getChainKeys('image', kernels, [0,1,2], padding=1)[0]!=keys[0]
+    fusedKeys = resultCache.getChainKeys('image', kernels, [0,1,2], fuse=True)
+    assert fusedKeys[:-1]==[None, None] and fusedKeys[-1] not in keys
+
+def testMemoryBudgetEvictsLeastRecentlyUsed():
+    arrays = [numpy.full(100, idx, dtype='uint8') for idx in range(3)]
+    cache = resultCache.ResultCache(memoryBudget=250)
+    cache.put('a', arrays[0])
+    cache.put('b', arrays[1])
+    cache.get('a')
+    cache.put('c', arrays[2])
+    assert cache.get('b') is None
+    assert cache.get('a') is arrays[0] and cache.get('c') is arrays[2]
+    assert cache.memoryUsage==200
+
+def testDiskTierIsReloadedAndEvicted(tmp_path):
+    cacheDir = str(tmp_path)
+    arrays = [numpy.full((10, 10, 3), idx, dtype='uint8') for idx in range(3)]
+    cache = resultCache.ResultCache(memoryBudget=0, cacheDir=cacheDir)
+    cache.put('a', arrays[0])
+    fileSize = os.path.getsize(cache.getFilePath('a'))
+    cache.diskBudget = 2*fileSize
+    os.utime(cache.getFilePath('a'), (1, 1))
+    cache.put('b', arrays[1])
+    cache.put('c', arrays[2])
+    assert sorted(os.listdir(cacheDir))==['b.npy', 'c.npy']
+    reloaded = resultCache.ResultCache(cacheDir=cacheDir)
+    numpy.testing.assert_array_equal(reloaded.get('b'), arrays[1])
+    assert reloaded.get('a') is None
+
+def testDiscardForgetsModifiedImage(makeImage):
+    image = makeImage()
+    cache = resultCache.ResultCache()
+    key = cache.getImageKey(image)
+    cache.put(key, image)
+    assert cache.discard(image)
+    image[0, 0, 0] ^= 1
+    assert cache.getImageKey(image)!=key
+    assert cache.get(key) is None
@@ -0,0 +1,83 @@
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+import cv2                      #(pip install opencv-python)
+import pytest                   #(pip install pytest)
+
+import convolutionEngine
+import tiledConvolution
+
+def getKernels():
+    presetKernels = convolutionEngine.getPresetKernels()
+    return [presetKernels['gaussian-blur'], presetKernels['sobel-X'], convolutionEngine.makeParametricKernel('box', 2)]
+
+def getIntegerKernels():
+    #uint8 results are only exact with integer weights: otherwise the float noise of the methods picked for a tile and for
+    #the whole image can land on either side of an integer, and the cast truncates it
+    presetKernels = convolutionEngine.getPresetKernels()
+    return [presetKernels['gaussian-blur'], presetKernels['sobel-X'], numpy.ones((5, 5))]
+
+def runTiled(source, kernels, layersIdx, tileSize, workingBuffer=False, **settings):
+    outputShape = tiledConvolution.getOutputShape(source.shape, kernels, settings.get('padding', 0), settings.get('stride', 1))
+    destination = numpy.zeros(outputShape, dtype='float32' if workingBuffer else 'uint8')
+    plans = []
+    tiledConvolution.tiledApplyKernels(source, destination, kernels, layersIdx, workingBuffer=workingBuffer, tileSize=tileSize, plans=plans, **settings)
+    return destination, plans
+
+@pytest.mark.parametrize('tileSize', [8, 16, 100])
+@pytest.mark.parametrize('stride', [1, 2, 3])
+@pytest.mark.parametrize('paddingMode', ['constant', 'reflect'])
+def testTiledMatchesUntiled(tileSize, stride, paddingMode, makeImage):
+    source = makeImage((53, 47, 3))
+    kernels = getIntegerKernels()
+    expected = list(convolutionEngine.applyKernels(source, kernels, [0,2], padding=2, stride=stride, normalize=False, paddingMode=paddingMode))[-1]
+    result, _ = runTiled(source, kernels, [0,2], tileSize, padding=2, stride=stride, normalize=False, paddingMode=paddingMode)
+    numpy.testing.assert_array_equal(result, expected)
+
+@pytest.mark.parametrize('tileSize', [8, 24])
+@pytest.mark.parametrize('stride', [1, 2, 3])
+def testTiledWorkingBufferMatchesUntiled(tileSize, stride, makeImage):
+    source = makeImage((53, 47, 3))
+    kernels = getKernels()
+    expected = list(convolutionEngine.applyKernels(convolutionEngine.toWorkingBuffer(source), kernels, [0,1,2], padding=1, stride=stride))[-1]
+    result, _ = runTiled(source, kernels, [0,1,2], tileSize, workingBuffer=True, padding=1, stride=stride)
+    numpy.testing.assert_allclose(result, expected, atol=1e-3)
+
+@pytest.mark.parametrize('tileSize', [10, 32])
+def testTiledFusedMatchesUntiled(tileSize, makeImage):
+    source = makeImage((70, 66, 3))//4
+    kernels = [numpy.array([[0, 0, 0], [0, 1, 1], [0, 0, 0]]), numpy.array([[0, 1, 0], [0, 1, 0], [0, 0, 0]])]
+    expectedPlans = []
+    expected = list(convolutionEngine.applyKernels(source, kernels, [0,1,2], normalize=False, fuse=True, plans=expectedPlans))[-1]
+    result, plans = runTiled(source, kernels, [0,1,2], tileSize, normalize=False, fuse=True)
+    assert plans[0].get('fused')==2 and expectedPlans[0].get('fused')==2
+    numpy.testing.assert_array_equal(result, expected)
+
+def testTiledReadsMemoryMappedBuffers(tmp_path, makeImage):
+    source = makeImage((53, 47, 3))
+    sourcePath = str(tmp_path/'source.npy')
+    numpy.save(sourcePath, source)
+    kernels = getIntegerKernels()
+    outputShape = tiledConvolution.getOutputShape(source.shape, kernels)
+    destination = tiledConvolution.createBuffer(str(tmp_path/'result.raw'), outputShape, 'uint8')
+    tiledConvolution.tiledApplyKernels(tiledConvolution.openBuffer(sourcePath), destination, kernels, [1], normalize=False, tileSize=16)
+    result = tiledConvolution.openBuffer(str(tmp_path/'result.raw'), outputShape)
+    numpy.testing.assert_array_equal(result, list(convolutionEngine.applyKernels(source, kernels, [1], normalize=False))[-1])
+
+def testDestinationShapeIsChecked(makeImage):
+    source = makeImage((53, 47, 3))
+    with pytest.raises(ValueError):
+        tiledConvolution.tiledApplyKernels(source, numpy.zeros((10, 10, 3), dtype='uint8'), getKernels(), [0])
+
+def testImageInputGivesRgbBuffers(tmp_path, makeImage):
+    image = makeImage((53, 47, 3))
+    inputPath = str(tmp_path/'input.png')
+    cv2.imwrite(inputPath, image)
+    kernels = getIntegerKernels()
+    expected = list(convolutionEngine.applyKernels(image, kernels, [0], normalize=False))[-1]
+    kernelArguments = ['-k', 'gaussian-blur', '-k', 'sobel-X', '-k', '1,1,1,1,1;1,1,1,1,1;1,1,1,1,1;1,1,1,1,1;1,1,1,1,1', '--layers', 'blue', '--tile-size', '16']
+    assert tiledConvolution.main([inputPath, str(tmp_path/'result.npy')] + kernelArguments)==0
+    numpy.testing.assert_array_equal(numpy.load(str(tmp_path/'result.npy')), expected[:,:,::-1])
+    assert tiledConvolution.main([inputPath, str(tmp_path/'result.png')] + kernelArguments)==0
+    numpy.testing.assert_array_equal(cv2.imread(str(tmp_path/'result.png')), expected)
+    assert tiledConvolution.main([str(tmp_path/'result.npy'), str(tmp_path/'roundTrip.png'), '-k', '0,0,0;0,1,0;0,0,0', '--tile-size', '16'])==0
+    numpy.testing.assert_array_equal(cv2.imread(str(tmp_path/'roundTrip.png')), expected)
@@ -0,0 +1,250 @@
+#tiled execution of a kernel pipeline for images that do not fit in memory.
+#the image is read from (and written to) memory mapped .npy/raw buffers in overlapping tiles,
+#each tile carries a halo big enough for every kernel of the chain so the tiles join seamlessly.
+#example:
+#   python tiledConvolution.py scan.npy scan-blurred.npy -k gaussian-blur --normalize --max-memory 512
+#   python tiledConvolution.py scan.raw out.npy --raw-shape 20000,20000,3 -k sobel-X --float
+
+#external libraries (install using pip in your system terminal)
+import numpy                    #(pip install numpy)
+import cv2                      #(pip install opencv-python)
+
+#native
+import argparse
+import os
+import sys
+
+import convolutionEngine
+import batchConvolve
+import profiling
+
+DEFAULT_MAX_MEMORY = 512*1024**2
+RANGE_BAND_PIXELS = 16*1024**2  #pixels read at once while looking for the range of the source
+TILE_MEMORY_FACTOR = 10     #float32 copies of a tile that are alive at once while it is convolved (casts, results, padding, fft buffers)
+
+def openBuffer(filePath, shape=None, dtype='uint8'):
+    #.npy files carry their own shape and dtype, raw files need them to be given
+    if filePath.endswith('.npy'):
+        return numpy.load(filePath, mmap_mode='r')
+    if shape is None:
+        raise ValueError("The shape of raw buffer {} must be given".format(filePath))
+    return numpy.memmap(filePath, dtype=dtype, mode='r', shape=tuple(shape))
+
+def createBuffer(filePath, shape, dtype):
+    if filePath.endswith('.npy'):
+        return numpy.lib.format.open_memmap(filePath, mode='w+', dtype=dtype, shape=tuple(shape))
+    return numpy.memmap(filePath, dtype=dtype, mode='w+', shape=tuple(shape))
+
+def getPaddedIndices(start, stop, size, padding, mode):
+    #maps rows/cols of the padded image to rows/cols of the source, and marks the ones that are constant padding
+    indices = numpy.arange(start, stop) - padding
+    valid = numpy.ones(len(indices), dtype=bool)
+    if mode=='constant':
+        valid = (indices>=0) & (indices<size)
+        indices = numpy.clip(indices, 0, size-1)
+    elif mode=='edge':
+        indices = numpy.clip(indices, 0, size-1)
+    elif mode=='reflect':
+        indices = numpy.abs(indices)
+        indices = numpy.where(indices>=size, 2*(size-1)-indices, indices)
+    elif mode=='wrap':
+        indices = numpy.mod(indices, size)
+    else:
+        raise ValueError("Unknown padding mode '{}'".format(mode))
+    return indices, valid
+
+def readTile(source, rowRange, colRange, padding=0, paddingMode='constant'):
+    #reads rows/cols of the (virtually) padded image, only touching the part of the memory map that is needed
+    rows, validRows = getPaddedIndices(rowRange[0], rowRange[1], source.shape[0], padding, paddingMode)
+    cols, validCols = getPaddedIndices(colRange[0], colRange[1], source.shape[1], padding, paddingMode)
+    if padding==0 or (validRows.all() and validCols.all() and numpy.all(numpy.diff(rows)==1) and numpy.all(numpy.diff(cols)==1)):
+        return numpy.array(source[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1])
+    tile = numpy.array(source[numpy.ix_(rows, cols)])
+    tile[~validRows] = 0
+    tile[:, ~validCols] = 0
+    return tile
+
+def getLevelSizes(size, steps):
+    #size of one axis after every kernel of the chain
+    sizes = [size]
+    for _, stride in steps:
+        sizes.append(-(-sizes[-1]//stride))
+    return sizes
+
+def getInputRange(start, stop, steps, levelSizes):
+    #walks the chain backwards to find the input rows/cols needed to compute output rows/cols [start, stop)
+    for (kernelSize, stride), inputSize in zip(reversed(steps), reversed(levelSizes[:-1])):
+        before = (kernelSize-1)//2
+        after = kernelSize-1-before
+        start = max(start*stride-before, 0)
+        stop = min((stop-1)*stride+after+1, inputSize)
+    return start, stop
+
+def getTileSize(kernels, layerCount, stride=1, maxMemory=DEFAULT_MAX_MEMORY):
+    #largest square output tile whose input (with halo) stays under maxMemory while it is processed
+    halo = 0
+    scale = 1
+    for kernel in kernels:
+        halo += max(kernel.shape)*scale
+        scale *= stride
+    bytesPerPixel = 4*layerCount*TILE_MEMORY_FACTOR
+    inputSide = int(numpy.sqrt(maxMemory/bytesPerPixel))
+    tileSize = (inputSide-halo)//scale
+    if tileSize<1:
+        raise ValueError("A memory cap of {:.1f} MB is too small for these kernels".format(maxMemory/1024**2))
+    return tileSize
+
+def getOutputShape(sourceShape, kernels, padding=0, stride=1):
+    height, width = sourceShape[0]+2*padding, sourceShape[1]+2*padding
+    for kernel in kernels:
+        height, width = convolutionEngine.getStridedShape((height, width), stride)
+    return (height, width) + tuple(sourceShape[2:])
+
+def getValueRange(source, layersIdx, padding=0, paddingMode='constant'):
+    #range of the selected layers, read a band of rows at a time. constant padding adds zeros
+    low, high = (0, 0) if padding>0 and paddingMode=='constant' else (None, None)
+    bandRows = max(RANGE_BAND_PIXELS//max(source.shape[1], 1), 1)
+    for start in range(0, source.shape[0], bandRows):
+        band = numpy.asarray(source[start:start+bandRows])[:,:,layersIdx]
+        low = band.min() if low is None else min(low, band.min())
+        high = band.max() if high is None else max(high, band.max())
+    return low, high
+
+def prepareKernels(kernels, normalize=True, fuse=False, stride=1, valueRange=None, paddedShape=None):
+    #returns the chain and its fused kernel, or None when fusing would change the result. it is decided once for the
+    #whole image with the same rule as convolutionEngine.applyKernels. valueRange is None for a float working buffer
+    if normalize:
+        kernels = [convolutionEngine.normalizeKernel(kernel) for kernel in kernels]
+    if fuse:
+        canFuse, _ = convolutionEngine.canFuseKernels(kernels, valueRange, stride, paddedShape)
+        if canFuse:
+            return kernels, convolutionEngine.composeKernels(kernels)
+    return kernels, None
+
+def tiledApplyKernels(source, destination, kernels, layersIdx, padding=0, stride=1, normalize=True, separableTolerance=0, method='auto', fuse=False,
+                      quantizeMode='wrap', identicalGroups=None, paddingMode='constant', workingBuffer=False, maxMemory=DEFAULT_MAX_MEMORY, tileSize=None, plans=None):
+    #same result as convolutionEngine.applyKernels, but peak memory is bounded by the tile size instead of the image size.
+    #tiles are convolved at stride 1 and then subsampled on the global stride grid, so a stride does not save work here.
+    #a fused chain (stride 1, odd kernels) gives the same halo; tiles near the borders, where every kernel of the chain
+    #repeats the edge pixels of its own input, run the chain like applyKernels does there
+    paddedShape = (source.shape[0]+2*padding, source.shape[1]+2*padding)
+    valueRange = None
+    if fuse and not workingBuffer and len(layersIdx)>0:
+        valueRange = getValueRange(source, layersIdx, padding, paddingMode)
+    kernels, fusedKernel = prepareKernels(kernels, normalize, fuse, stride, valueRange, paddedShape)
+    outputShape = getOutputShape(source.shape, kernels, padding, stride)
+    if tuple(destination.shape)!=outputShape:
+        raise ValueError("Destination has shape {}, the result has shape {}".format(destination.shape, outputShape))
+    if tileSize is None:
+        tileSize = getTileSize(kernels, source.shape[2], stride, maxMemory)
+
+    rowSteps = [(kernel.shape[0], stride) for kernel in kernels]
+    colSteps = [(kernel.shape[1], stride) for kernel in kernels]
+    rowSizes = getLevelSizes(paddedShape[0], rowSteps)
+    colSizes = getLevelSizes(paddedShape[1], colSteps)
+
+    kernelPlans = [convolutionEngine.planConvolution(kernel, separableTolerance, (tileSize, tileSize), 1, method) for kernel in kernels]
+    if fusedKernel is not None:
+        fusedPlan = convolutionEngine.planConvolution(fusedKernel, separableTolerance, (tileSize, tileSize), 1, method)
+        fusedPlan['fused'] = len(kernels)
+        margin = convolutionEngine.getChainMargin(kernels)
+    if plans is not None:
+        plans.extend([fusedPlan] if fusedKernel is not None else kernelPlans)
+
+    for rowStart in range(0, outputShape[0], tileSize):
+        rowStop = min(rowStart+tileSize, outputShape[0])
+        for colStart in range(0, outputShape[1], tileSize):
+            colStop = min(colStart+tileSize, outputShape[1])
+            inputRows = getInputRange(rowStart, rowStop, rowSteps, rowSizes)
+            inputCols = getInputRange(colStart, colStop, colSteps, colSizes)
+            with profiling.span('read tile') as span:
+                tile = readTile(source, inputRows, inputCols, padding, paddingMode)
+                span.addBytes(tile.nbytes)
+            if workingBuffer:
+                tile = convolutionEngine.toWorkingBuffer(tile)
+
+            #global position of the tile's first pixel at the current level of the chain
+            tileRow, tileCol = inputRows[0], inputCols[0]
+            steps = zip(kernels, kernelPlans)
+            if fusedKernel is not None and min(rowStart, colStart)>=margin and rowStop<=outputShape[0]-margin and colStop<=outputShape[1]-margin:
+                steps = [(fusedKernel, fusedPlan)]
+            for kernel, plan in steps:
+                tile = convolutionEngine.convolve(tile, kernel, layersIdx, 1, plan, quantizeMode, identicalGroups)
+                rowOffset = (-tileRow)%stride
+                colOffset = (-tileCol)%stride
+                tile = tile[rowOffset::stride, colOffset::stride]
+                tileRow = (tileRow+rowOffset)//stride
+                tileCol = (tileCol+colOffset)//stride
+
+            tile = tile[rowStart-tileRow:rowStop-tileRow, colStart-tileCol:colStop-tileCol]
+            if destination.dtype==numpy.uint8:
+                tile = convolutionEngine.quantize(tile, quantizeMode)
+            with profiling.span('write tile'):
+                destination[rowStart:rowStop, colStart:colStop] = tile
+    if hasattr(destination, 'flush'):
+        destination.flush()
+    return destination
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply a kernel pipeline to a large image in tiles with bounded memory.")
+    parser.add_argument('input', help=".npy or raw buffer (or a {} file, which is decoded once)".format("/".join(convolutionEngine.SUPPORTED_FILE_TYPES)))
+    parser.add_argument('output', help=".npy or raw buffer to write (or a {} file)".format("/".join(convolutionEngine.SUPPORTED_FILE_TYPES)))
+    batchConvolve.addPipelineArguments(parser)
+    parser.add_argument('--raw-shape', help="height,width,layers of a raw input buffer")
+    parser.add_argument('--raw-dtype', default='uint8', help="dtype of a raw input buffer (default: uint8)")
+    parser.add_argument('--max-memory', type=float, default=DEFAULT_MAX_MEMORY/1024**2, help="peak memory of the tiles in MB (default: %(default)s)")
+    parser.add_argument('--tile-size', type=int, default=None, help="output tile size in pixels (default: largest that fits in --max-memory)")
+    args = parser.parse_args(argv)
+    settings = batchConvolve.getSettings(args, parser)
+    if settings['edges'] is not None:
+        parser.error("--edges is not supported on tiles, apply it to the result")
+    if settings['trace']:
+        profiling.enable()
+
+    isImage = args.input.lower().rsplit('.', 1)[-1] in convolutionEngine.SUPPORTED_FILE_TYPES
+    try:
+        if isImage:
+            source = cv2.imread(args.input)
+            if source is None:
+                raise ValueError("{} could not be read".format(args.input))
+        else:
+            shape = [int(value) for value in args.raw_shape.split(',')] if args.raw_shape else None
+            source = openBuffer(args.input, shape, args.raw_dtype)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    if source.ndim==2:
+        source = source[:,:,numpy.newaxis]
+    #buffers are read and written in RGB order (like imageWriter writes them), decoded images are BGR
+    if isImage:
+        source = source[:,:,::-1]
+    layersIdx = [idx for idx in batchConvolve.getLayersIdx(settings['layers'], bgr=False) if idx<source.shape[2]]
+
+    #kernels are only fused at stride 1, so fusing never changes the output shape
+    outputShape = getOutputShape(source.shape, settings['kernels'], settings['padding'], settings['stride'])
+    outputIsImage = args.output.lower().rsplit('.', 1)[-1] in convolutionEngine.SUPPORTED_FILE_TYPES
+    #float results are kept as float in buffers, images are quantized
+    dtype = 'float32' if settings['float'] and not outputIsImage else 'uint8'
+    bufferPath = args.output+'.npy' if outputIsImage else args.output
+    destination = createBuffer(bufferPath, outputShape, dtype)
+
+    plans = []
+    try:
+        tiledApplyKernels(source, destination, settings['kernels'], layersIdx, settings['padding'], settings['stride'], settings['normalize'], settings['separableTolerance'],
+                          settings['method'], settings['fuse'], settings['quantize'], None, settings['paddingMode'], settings['float'], int(args.max_memory*1024**2), args.tile_size, plans)
+    except ValueError as e:
+        del destination
+        os.remove(bufferPath)
+        parser.error(str(e))
+    print("{} -> {} ({})".format(args.input, args.output, ", ".join([convolutionEngine.describePlan(plan) for plan in plans])))
+
+    if outputIsImage:
+        with profiling.span('encode'):
+            cv2.imwrite(args.output, numpy.ascontiguousarray(destination[:,:,::-1]))
+        del destination
+        os.remove(bufferPath)
+    if settings['trace']:
+        batchConvolve.saveTrace(args.trace, profiling.getEvents())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())